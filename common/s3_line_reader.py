@@ -0,0 +1,95 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+
+
+# =============================
+# S3 分块并行按行读取
+# =============================
+class S3LineReader:
+    """
+    按范围（Range）分块读取一个 S3 对象，最多 parallel 个分块同时下载、按顺序交付，
+    直接在字节中按 \\n 切行（不解码、不拼出整个文件），跨分块的半行留到下一块拼接。
+    常驻内存约 chunk_size × (parallel + 1)，与文件大小无关；
+    逐行产出 (字节偏移, 行字节)，行不含结尾的 \\n，空行也会产出，由调用方决定是否跳过。
+    """
+
+    def __init__(self, s3_client, bucket, key, chunk_size=16 * 1024 * 1024, parallel=4, size=None):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.chunk_size = chunk_size
+        self.parallel = max(1, parallel)
+        self._size = size
+        self.last_modified = None
+
+    @property
+    def size(self) -> int:
+        if self._size is None:
+            head = self.s3_client.head_object(Bucket=self.bucket, Key=self.key)
+            self._size = head["ContentLength"]
+            self.last_modified = head.get("LastModified")
+        return self._size
+
+    def _get_range(self, start: int, end: int) -> bytes:
+        response = self.s3_client.get_object(Bucket=self.bucket, Key=self.key, Range=f"bytes={start}-{end - 1}")
+        data = response["Body"].read()
+        if len(data) != end - start:
+            raise IOError(f"分块读取不完整 {self.key} [{start}, {end}): {len(data)} 字节")
+        return data
+
+    def chunks(self):
+        """按顺序产出 (起始偏移, 分块字节)，后续分块在后台线程中预取"""
+        size = self.size
+        ranges = deque((start, min(start + self.chunk_size, size)) for start in range(0, size, self.chunk_size))
+        if not ranges:
+            return
+        with ThreadPoolExecutor(max_workers=self.parallel, thread_name_prefix="s3-range") as executor:
+            in_flight = deque()
+            try:
+                while ranges or in_flight:
+                    while ranges and len(in_flight) < self.parallel:
+                        start, end = ranges.popleft()
+                        in_flight.append((start, executor.submit(self._get_range, start, end)))
+                    start, future = in_flight.popleft()
+                    yield start, future.result()
+            finally:
+                for _, future in in_flight:
+                    future.cancel()
+
+    def read_into(self, buffer) -> int:
+        """把整个对象并行读入可写缓冲（如共享内存），返回字节数；缓冲至少为 size 字节"""
+        view = memoryview(buffer)
+        try:
+            for start, data in self.chunks():
+                view[start:start + len(data)] = data
+        finally:
+            view.release()
+        return self.size
+
+    def iter_lines(self):
+        """逐行产出 (字节偏移, 行字节)"""
+        carry = []        # 跨分块的未完成行（长行可能跨多个分块，先存片段最后一次拼接）
+        carry_start = 0
+        for start, data in self.chunks():
+            parts = data.split(b"\n")
+            if len(parts) == 1:
+                if not carry:
+                    carry_start = start
+                carry.append(data)
+                continue
+            offset = start
+            first = parts[0]
+            if carry:
+                carry.append(first)
+                yield carry_start, b"".join(carry)
+                carry = []
+            else:
+                yield offset, first
+            offset += len(first) + 1
+            for line in parts[1:-1]:
+                yield offset, line
+                offset += len(line) + 1
+            if parts[-1]:
+                carry, carry_start = [parts[-1]], offset
+        if carry:
+            yield carry_start, b"".join(carry)
@@ -0,0 +1,88 @@
+import gc
+import sys
+import time
+import tracemalloc
+import boto3
+from s3_line_reader import S3LineReader
+
+
+# =============================
+# 配置区域
+# =============================
+# 对比三种按行读取 S3 JSONL 的方式（均解码为 str 并跳过空行，得到相同的行）：
+#   full_read   get_object().read().decode() 后整体分行（原先两条流水线的做法）
+#   iter_lines  botocore StreamingBody.iter_lines 流式读取
+#   chunked     S3LineReader 分块范围读取，parallel=1 与 parallel=READ_PARALLEL 各测一次
+# 用法：python s3_line_reader_bench.py 对象key [对象key ...]
+S3_CONFIG = {
+    "aws_access_key_id": "",  # 补充id
+    "aws_secret_access_key": "", # 补充key
+    "endpoint_url": "", # 补充end_point
+}
+BUCKET_NAME = 'heta'
+READ_CHUNK_SIZE = 16 * 1024 * 1024
+READ_PARALLEL = 4
+REPEAT = 3             # 计时取最快的一次
+MEASURE_MEMORY = True  # 另跑一遍 tracemalloc 统计峰值内存（开启 tracemalloc 时较慢，不参与计时）
+
+
+def read_full(s3_client, key):
+    content = s3_client.get_object(Bucket=BUCKET_NAME, Key=key)['Body'].read().decode('utf-8')
+    return sum(1 for line in content.split('\n') if line.strip())
+
+
+def read_iter_lines(s3_client, key):
+    body = s3_client.get_object(Bucket=BUCKET_NAME, Key=key)['Body']
+    return sum(1 for line in body.iter_lines() if line.decode('utf-8').strip())
+
+
+def read_chunked(s3_client, key, parallel):
+    reader = S3LineReader(s3_client, BUCKET_NAME, key, chunk_size=READ_CHUNK_SIZE, parallel=parallel)
+    return sum(1 for _, line in reader.iter_lines() if line.decode('utf-8').strip())
+
+
+def run(method, s3_client, key):
+    """返回 (行数, 最快耗时秒数, 峰值内存字节数或 None)"""
+    best = None
+    for _ in range(REPEAT):
+        gc.collect()
+        start = time.perf_counter()
+        count = method(s3_client, key)
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    peak = None
+    if MEASURE_MEMORY:
+        gc.collect()
+        tracemalloc.start()
+        method(s3_client, key)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return count, best, peak
+
+
+def main(keys):
+    s3_client = boto3.client('s3', **S3_CONFIG)
+    methods = [
+        ("full_read", read_full),
+        ("iter_lines", read_iter_lines),
+        ("chunked×1", lambda client, key: read_chunked(client, key, 1)),
+        (f"chunked×{READ_PARALLEL}", lambda client, key: read_chunked(client, key, READ_PARALLEL)),
+    ]
+    for key in keys:
+        size = s3_client.head_object(Bucket=BUCKET_NAME, Key=key)['ContentLength']
+        print(f"{key}：{size / 1024 / 1024:.1f} MB，分块 {READ_CHUNK_SIZE // 1024 // 1024} MB")
+        counts = set()
+        for name, method in methods:
+            count, seconds, peak = run(method, s3_client, key)
+            counts.add(count)
+            memory = f"，峰值内存 {peak / 1024 / 1024:>8.1f} MB" if peak is not None else ""
+            print(f"  {name:<12} {seconds:>7.2f}s  {size / 1024 / 1024 / seconds:>8.1f} MB/s{memory}  行数 {count}")
+        if len(counts) != 1:
+            print(f"  各方式读到的行数不一致: {sorted(counts)}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("用法: python s3_line_reader_bench.py 对象key [对象key ...]")
+        sys.exit(1)
+    main(sys.argv[1:])
@@ -0,0 +1,152 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+# =============================
+# S3 分段流式写入
+# =============================
+MIN_PART_SIZE = 5 * 1024 * 1024  # S3 要求除最后一段外每段至少 5MB
+
+
+class S3MultipartWriter:
+    """
+    边产生结果边以分段上传（multipart upload）写入一个 S3 对象，不在内存中拼出整个文件。
+
+    write 的数据先进入缓冲，攒满 part_size 后交给上传线程；在途分段不超过 max_pending_parts 个，
+    超过时 write 阻塞等待（背压），常驻内存约为 part_size × (max_pending_parts + 1)。
+    close 时按分段号顺序提交 complete；总数据不足一个分段时改用一次 put_object；
+    没有写入任何数据时不创建对象（allow_empty=True 时创建空对象，供以输出是否存在判断文件已处理的调用方使用）。
+    出错或调用 abort 时放弃整个上传：
+    对象只在 complete 成功后才可见，不会出现写了一半的输出文件。
+    进程被强杀时未完成的分段上传由桶的生命周期规则（AbortIncompleteMultipartUpload）清理。
+    """
+
+    def __init__(self, s3_client, bucket, key, part_size=64 * 1024 * 1024, max_pending_parts=4,
+                 content_type="application/json", checksum_algorithm=None, allow_empty=False):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.content_type = content_type
+        self.checksum_algorithm = checksum_algorithm  # 如 "SHA256"，逐段校验
+        self.allow_empty = allow_empty
+
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = {}  # 分段号 -> complete 所需的分段信息
+        self._next_part = 1
+        self._error = None
+        self._closed = False
+        self._slots = threading.BoundedSemaphore(max_pending_parts)
+        self._executor = ThreadPoolExecutor(max_workers=max_pending_parts, thread_name_prefix="s3-part")
+        self._futures = []
+        self.bytes_written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    def tell(self) -> int:
+        return self.bytes_written
+
+    def write(self, data: bytes) -> int:
+        if self._closed:
+            raise ValueError(f"写入已关闭的 S3 对象 {self.key}")
+        self._raise_if_failed()
+        self._buffer += data
+        self.bytes_written += len(data)
+        while len(self._buffer) >= self.part_size:
+            part = bytes(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+            self._submit_part(part)
+        return len(data)
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise RuntimeError(f"分段上传失败 {self.key}: {self._error}")
+
+    def _submit_part(self, body: bytes):
+        if self._upload_id is None:
+            kwargs = {"Bucket": self.bucket, "Key": self.key, "ContentType": self.content_type}
+            if self.checksum_algorithm:
+                kwargs["ChecksumAlgorithm"] = self.checksum_algorithm
+            self._upload_id = self.s3_client.create_multipart_upload(**kwargs)["UploadId"]
+        part_number = self._next_part
+        self._next_part += 1
+        self._slots.acquire()  # 在途分段已满时阻塞调用方
+        if self._error is not None:
+            self._slots.release()
+            self._raise_if_failed()
+        future = self._executor.submit(self._upload_part, part_number, body)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._futures.append(future)
+
+    def _upload_part(self, part_number: int, body: bytes):
+        try:
+            kwargs = {"Bucket": self.bucket, "Key": self.key, "UploadId": self._upload_id,
+                      "PartNumber": part_number, "Body": body}
+            if self.checksum_algorithm:
+                kwargs["ChecksumAlgorithm"] = self.checksum_algorithm
+            response = self.s3_client.upload_part(**kwargs)
+            part = {"PartNumber": part_number, "ETag": response["ETag"]}
+            checksum_field = f"Checksum{self.checksum_algorithm}" if self.checksum_algorithm else None
+            if checksum_field and checksum_field in response:
+                part[checksum_field] = response[checksum_field]
+            self._parts[part_number] = part
+        except Exception as e:
+            self._error = e
+
+    def close(self):
+        """上传剩余数据并提交；失败时放弃上传并抛出异常"""
+        if self._closed:
+            return
+        try:
+            if self._upload_id is None:
+                # 数据不足一个分段：直接一次上传，省去分段上传的额外请求
+                if self._buffer or self.allow_empty:
+                    kwargs = {"Bucket": self.bucket, "Key": self.key, "Body": bytes(self._buffer),
+                              "ContentType": self.content_type}
+                    if self.checksum_algorithm:
+                        kwargs["ChecksumAlgorithm"] = self.checksum_algorithm
+                    self.s3_client.put_object(**kwargs)
+            else:
+                if self._buffer:
+                    self._submit_part(bytes(self._buffer))
+                for future in self._futures:
+                    future.result()
+                self._raise_if_failed()
+                self.s3_client.complete_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=self._upload_id,
+                    MultipartUpload={"Parts": [self._parts[n] for n in sorted(self._parts)]}
+                )
+        except Exception:
+            self.abort()
+            raise
+        self._buffer = bytearray()
+        self._closed = True
+        self._executor.shutdown()
+
+    def abort(self):
+        """放弃上传：已上传的分段全部丢弃，目标对象保持原状"""
+        if self._closed:
+            return
+        self._closed = True
+        self._buffer = bytearray()
+        for future in self._futures:
+            future.cancel()
+        self._executor.shutdown(wait=True)
+        if self._upload_id is not None:
+            try:
+                self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id)
+            except Exception as e:
+                logging.warning(f"放弃分段上传失败 {self.key}: {e}")
+            self._upload_id = None
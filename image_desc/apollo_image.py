@@ -11,6 +11,29 @@ from openai import AsyncClient
 from tqdm.asyncio import tqdm_asyncio
 import re
 import io
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+import math
+import os
+import sys
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import aclosing
+import threading
+from desc_cache import DescCache, image_content_hash, make_fingerprint
+from image_preprocess import preprocess_image
+from phash_index import PHashIndex
+from checkpoint_journal import CheckpointJournal, JournalReadError
+from vl_client import EndpointPool, ResilientClient
+from prompt_builder import PromptBuilder, LineRefs, RefText
+from batch_jobs import (BatchShardWriter, list_shards, result_path, read_requests, read_results,
+                        run_shard_local, run_shard_openai, run_shard_vllm)
+# 两条流水线共用的 S3 工具
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common"))
+from s3_multipart_writer import S3MultipartWriter
+from s3_line_reader import S3LineReader
 
 
 # =============================
@@ -39,18 +62,139 @@ OUTPUT_IMAGE_DESC = INPUT_PREFIX + 'image_desc/'
 # 批次大小 
 BATCH_SIZE = 1
 
+# 流式模式：解析 → 下载 → 描述 → 写回，各阶段用有界队列衔接，内存占用与文件大小无关
+STREAMING_MODE = True
+STREAM_QUEUE_SIZE = 256          # 每个阶段队列的最大长度（驻留内存的图片数上限）
+STREAM_MAX_INFLIGHT_LINES = 1024  # 每个文件同时在途的行数上限（限制按序写回的乱序缓冲）
+FILES_IN_FLIGHT = 4              # 同时处理的输入文件数，所有文件的图片进入同一请求池
+
+# 输出边生成边分段上传，每个文件常驻内存约 OUTPUT_PART_SIZE × (OUTPUT_MAX_PENDING_PARTS + 1)
+OUTPUT_PART_SIZE = 64 * 1024 * 1024
+OUTPUT_MAX_PENDING_PARTS = 4
+
+# 输入 JSONL 按范围分块读取，读取时常驻内存约 READ_CHUNK_SIZE × (READ_PARALLEL + 1)
+READ_CHUNK_SIZE = 16 * 1024 * 1024
+READ_PARALLEL = 4
+READ_QUEUE_LINES = 1024  # 流式解析时已读取、尚未解析的行数上限
+
 # 日志设置
 logging.getLogger("httpx").setLevel(logging.WARNING)
 
-# === 异步客户端 ===
-client = AsyncClient(
-    api_key="EMPTY",
-    base_url="http://10.140.37.15:8007/v1/"
+# === 异步客户端：多个 vLLM 端点负载均衡 ===
+VL_ENDPOINTS = [
+    "http://10.140.37.15:8007/v1/",
+    # "http://10.140.37.39:8006/v1/",
+]
+VL_MODEL_NAME = "Qwen2.5-VL-72B-Instruct"
+VL_MAX_TOKENS = 1024
+VL_TEMPERATURE = 0.1
+
+# 每个端点的在途请求上限由 AIMD 控制器按延迟与 429/5xx 动态调整
+VL_INITIAL_CONCURRENCY = 20  # 每个端点的初始在途上限
+VL_MIN_CONCURRENCY = 2
+VL_MAX_CONCURRENCY = 128
+VL_LATENCY_TOLERANCE = 2.0   # 平滑延迟超过基线的倍数时视为排队，开始降并发
+vl_pool = EndpointPool(
+    VL_ENDPOINTS,
+    initial_limit=VL_INITIAL_CONCURRENCY,
+    min_limit=VL_MIN_CONCURRENCY,
+    max_limit=VL_MAX_CONCURRENCY,
+    latency_tolerance=VL_LATENCY_TOLERANCE
+)
+
+# 重试：瞬时错误（超时、连接错误、429、5xx）按带抖动的指数退避重试，其他 4xx 不重试
+VL_MAX_RETRIES = 3
+VL_RETRY_BASE_DELAY = 1.0
+VL_RETRY_MAX_DELAY = 30.0
+VL_REQUEST_TIMEOUT = 300.0     # 单个逻辑请求（含重试与退避）的总时限
+# 对冲：请求耗时超过近期延迟的分位数时向另一端点发重复请求，先返回者胜出
+VL_HEDGE_ENABLED = True
+VL_HEDGE_QUANTILE = 0.95
+VL_HEDGE_MIN_DELAY = 5.0      # 对冲等待的最短秒数
+VL_HEDGE_MAX_RATIO = 0.1      # 对冲请求数不超过总请求数的比例
+VL_HEDGE_MEASURE_LOSERS = False  # 不取消落后请求以精确统计对冲节省的尾延迟（仅评估时开启）
+client = ResilientClient(
+    vl_pool,
+    max_retries=VL_MAX_RETRIES,
+    base_delay=VL_RETRY_BASE_DELAY,
+    max_delay=VL_RETRY_MAX_DELAY,
+    request_timeout=VL_REQUEST_TIMEOUT,
+    hedge_enabled=VL_HEDGE_ENABLED,
+    hedge_quantile=VL_HEDGE_QUANTILE,
+    hedge_min_delay=VL_HEDGE_MIN_DELAY,
+    hedge_max_ratio=VL_HEDGE_MAX_RATIO,
+    measure_losers=VL_HEDGE_MEASURE_LOSERS
 )
 
-# 最大并发请求数
-MAX_CONCURRENT_REQUESTS = 20
-semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+# 全局最大并发请求数（流式模式下的描述协程数），实际并发由各端点上限决定
+MAX_CONCURRENT_REQUESTS = VL_MAX_CONCURRENCY * len(VL_ENDPOINTS)
+
+# 离线批处理模式：把请求写成 OpenAI batch 格式的 JSONL 分片，交给批处理接口执行后合并回写
+# 适合不要求实时性的大规模回填；三个阶段可以分开运行，例如先 prepare，再在 GPU 机器上 submit
+OFFLINE_BATCH_MODE = False
+OFFLINE_BATCH_STAGES = ("prepare", "submit", "merge")
+OFFLINE_BATCH_DIR = "./image_desc_batch"  # 分片 shards/、结果 results/、逐文件清单 manifests/
+OFFLINE_BATCH_RUNNER = "local"  # local：本地替身，经端点池逐条请求 / openai：/v1/batches 接口 / vllm：vllm run_batch
+OFFLINE_BATCH_SHARD_MAX_REQUESTS = 5000
+OFFLINE_BATCH_SHARD_MAX_BYTES = 200 * 1024 * 1024
+OFFLINE_BATCH_API_BASE = VL_ENDPOINTS[0]
+OFFLINE_BATCH_POLL_INTERVAL = 60
+OFFLINE_BATCH_VLLM_MODEL = "../models/Qwen2.5-VL-72B-Instruct"
+OFFLINE_BATCH_VLLM_ARGS = ["--tensor-parallel-size", "8"]  # run_batch 每个分片加载一次模型，分片宜大
+OFFLINE_BATCH_RETRY_ROUNDS = 2  # 结果出错（或缺失）的请求写入重试分片再提交的轮数
+
+# 图片下载并发数（线程池大小，同时作为 S3 连接池大小）
+FETCH_CONCURRENCY = 64
+fetch_executor = ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY, thread_name_prefix="s3-fetch")
+
+# 只下载图片、不调用模型，用于单独压测下载阶段吞吐（不会写回结果）
+FETCH_ONLY_BENCHMARK = False
+
+# 断点续跑
+SKIP_EXISTING_OUTPUTS = True  # 输出文件已存在时跳过整个输入文件
+JOURNAL_ENABLED = True        # 逐图片断点日志，重启后回放已完成的描述
+JOURNAL_DIR = "./image_desc_journal"
+JOURNAL_S3_PREFIX = ""  # 非空时日志分段同步到 S3，例如 INPUT_PREFIX + 'image_desc_journal/'
+journal = None  # 在 main 中初始化
+
+# 图片描述缓存：键为图片内容 SHA-256 + (提示词模板, caption, 模型参数) 指纹
+DESC_CACHE_ENABLED = True
+DESC_CACHE_PATH = "./image_desc_cache.sqlite"
+DESC_CACHE_S3_PREFIX = ""  # 非空时启用 S3 共享层，例如 INPUT_PREFIX + 'desc_cache/'
+DESC_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024  # 本地缓存总大小上限，超出后按最久未访问淘汰
+DESC_CACHE_MAX_AGE_DAYS = 90  # 超过该天数的条目被淘汰
+desc_cache = None  # 在 main 中初始化
+
+# 感知哈希近重复复用：同一图表换了分辨率 / 压缩质量时，直接复用本次运行中已生成的描述
+PHASH_ENABLED = True
+PHASH_ALGORITHM = "dhash"  # dhash / phash
+PHASH_MAX_DISTANCE = 4     # 64 位哈希的汉明距离阈值，越大复用越激进
+phash_index = None  # 在 main 中初始化
+
+# 图片预过滤：调用模型前剔除图标、追踪像素、纯色块、分隔线等，只读文件头 + 64px 缩略图
+PREFILTER_ENABLED = True
+PREFILTER_MIN_BYTES = 1024               # 小于该字节数跳过
+PREFILTER_MAX_BYTES = 50 * 1024 * 1024   # 大于该字节数跳过
+PREFILTER_MIN_SIDE = 32                  # 宽或高小于该像素跳过
+PREFILTER_MIN_AREA = 64 * 64             # 宽×高小于该像素数跳过
+PREFILTER_MAX_ASPECT_RATIO = 8.0         # 长边/短边超过该值视为分隔线、横幅条
+PREFILTER_SOLID_TOLERANCE = 8            # 缩略图灰度极差不超过该值视为纯色
+PREFILTER_MIN_ENTROPY = 1.0              # 缩略图灰度直方图熵（bit）低于该值视为信息量过低
+
+# 图片预处理：在进程池中解码、按像素预算缩小并重编码，减小请求体积与视觉 token 数
+PREPROCESS_ENABLED = True
+PREPROCESS_MAX_PIXELS = 1024 * 1024  # 宽×高的像素预算
+PREPROCESS_FORMAT = "JPEG"  # JPEG / WEBP
+PREPROCESS_QUALITY = 85
+PREPROCESS_WORKERS = 8
+preprocess_executor = None  # 在 main 中初始化
+# 离线 prepare 阶段同时在途（下载 → 预处理）的图片数，限制驻留内存的图片字节
+OFFLINE_BATCH_PREPARE_INFLIGHT = 2 * PREPROCESS_WORKERS
+
+# 提示词：固定指令作为共享前缀，参考文字按与 caption 的相关性裁剪到 token 预算
+PROMPT_TOKENIZER_PATH = "../models/Qwen2.5-VL-72B-Instruct"  # 本地 tokenizer，加载失败时按字符估算
+REF_TEXT_TOKEN_BUDGET = 512
+prompt_builder = PromptBuilder(PROMPT_TOKENIZER_PATH, REF_TEXT_TOKEN_BUDGET)
 
 # =============================
 # 工具函数区
@@ -65,6 +209,39 @@ def is_valid_image(image_data) -> tuple[bool, str]:
     except Exception as e:
         return False, str(e)
 
+def prefilter_image(image_data: bytes):
+    """廉价预过滤，返回跳过原因；通过返回 None"""
+    size = len(image_data)
+    if size < PREFILTER_MIN_BYTES:
+        return "字节过小"
+    if size > PREFILTER_MAX_BYTES:
+        return "字节过大"
+    try:
+        image = Image.open(BytesIO(image_data))
+        width, height = image.size  # 只解析文件头
+    except Exception:
+        return "无法解码"
+    if min(width, height) < PREFILTER_MIN_SIDE or width * height < PREFILTER_MIN_AREA:
+        return "尺寸过小"
+    if max(width, height) / min(width, height) > PREFILTER_MAX_ASPECT_RATIO:
+        return "长宽比异常"
+
+    try:
+        image.draft("L", (64, 64))
+        thumb = image.convert("L")
+        thumb.thumbnail((64, 64))
+    except Exception:
+        return "无法解码"
+    low, high = thumb.getextrema()
+    if high - low <= PREFILTER_SOLID_TOLERANCE:
+        return "纯色"
+    histogram = thumb.histogram()
+    total = float(sum(histogram))
+    entropy = -sum(c / total * math.log2(c / total) for c in histogram if c)
+    if entropy < PREFILTER_MIN_ENTROPY:
+        return "低信息熵"
+    return None
+
 def get_image_mime(image_data):
     img_type = imghdr.what(None, image_data)
     mime_map = {
@@ -76,6 +253,21 @@ def get_image_mime(image_data):
     }
     return mime_map.get(img_type)
 
+def prompt_fingerprint(caption: str) -> str:
+    """描述缓存的指纹：提示词模板变化、caption 不同或模型参数变化都会得到不同的键"""
+    return make_fingerprint(prompt_builder.template(), caption, VL_MODEL_NAME, VL_MAX_TOKENS, VL_TEMPERATURE)
+
+def build_request_body(image_data: bytes, ref_text: str, caption: str) -> dict:
+    """chat.completions 的请求参数，在线请求与离线批处理分片共用"""
+    base64_str = base64.b64encode(image_data).decode("utf-8")
+    mime_type = get_image_mime(image_data) or 'image/jpeg'
+    return {
+        "model": VL_MODEL_NAME,
+        "messages": prompt_builder.build_messages(f"data:{mime_type};base64,{base64_str}", ref_text, caption),
+        "max_tokens": VL_MAX_TOKENS,
+        "temperature": VL_TEMPERATURE
+    }
+
 # === 异步图片描述生成函数 ===
 async def get_image_desc_async(image_data: bytes, ref_text: str, caption: str) -> str:
     valid, error_msg = is_valid_image(image_data)
@@ -83,36 +275,10 @@ async def get_image_desc_async(image_data: bytes, ref_text: str, caption: str) -
         # logging.warning(f"跳过无效图片: {error_msg}")
         return ""
 
-    base64_str = base64.b64encode(image_data).decode("utf-8")
-    mime_type = get_image_mime(image_data) or 'image/jpeg'
-
-    caption_is_available = f"这张图片的caption是{caption}" if caption else ""
-    text_prompt = (
-        "请给这张图片提供说明，识别图中关键标识性元素，并推测图片标题；\n"
-        f"{caption_is_available}\n"
-        f"可参考文字内容：{ref_text}，但要仔细甄别出与图片相关的内容\n"
-        "要求语言简洁凝练，不要描述画面布局；输出格式：标题--图片说明。"
-    )
-
-    messages = [
-        {
-            "role": "user",
-            "content": [
-                {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{base64_str}"}},
-                {"type": "text", "text": text_prompt}
-            ]
-        }
-    ]
-
     try:
-        async with semaphore:  # 控制并发
-            response = await client.chat.completions.create(
-                model="Qwen2.5-VL-72B-Instruct",
-                messages=messages,
-                max_tokens=1024,
-                temperature=0.1,
-                stream=False
-            )
+        # 由端点池选择负载最低的端点并控制并发，瞬时错误自动重试，慢请求对冲
+        response = await client.create(**build_request_body(image_data, ref_text, caption), stream=False)
+        prompt_builder.record_usage(getattr(response, "usage", None))
         return response.choices[0].message.content
     except Exception as e:
         logging.error(f"调用模型失败: {e}")
@@ -125,6 +291,363 @@ def format_time(seconds):
     secs = int(seconds % 60)
     return f"{hours}h {minutes}m {secs}s"
 
+# =============================
+# 阶段吞吐统计
+# =============================
+class StageStats:
+    """记录单个阶段（下载 / 预处理 / 模型）的完成数、字节数、单次耗时与墙钟时间"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.count = 0
+        self.errors = 0
+        self.bytes = 0
+        self.out_bytes = 0  # 阶段输出字节数（预处理后的图片体积）
+        self.busy_time = 0.0
+        self.first_start = None
+        self.last_end = None
+
+    def record(self, start: float, end: float, nbytes: int = 0, ok: bool = True, out_nbytes: int = 0):
+        self.count += 1
+        if not ok:
+            self.errors += 1
+        self.bytes += nbytes
+        self.out_bytes += out_nbytes
+        self.busy_time += end - start
+        if self.first_start is None or start < self.first_start:
+            self.first_start = start
+        if self.last_end is None or end > self.last_end:
+            self.last_end = end
+
+    def summary(self) -> str:
+        if not self.count:
+            return f"[{self.name}] 无记录"
+        wall = max(self.last_end - self.first_start, 1e-6)
+        mb = self.bytes / 1024 / 1024
+        return (
+            f"[{self.name}] 完成 {self.count} 个（失败 {self.errors}），"
+            f"墙钟 {wall:.1f}s，吞吐 {self.count / wall:.1f} 个/s"
+            + (f"、{mb / wall:.1f} MB/s（共 {mb:.1f} MB）" if self.bytes else "")
+            + (f"，输出 {self.out_bytes / 1024 / 1024:.1f} MB（{self.out_bytes / self.bytes * 100:.0f}%）"
+               if self.out_bytes and self.bytes else "")
+            + f"，平均单次耗时 {self.busy_time / self.count * 1000:.0f} ms"
+        )
+
+class PipelineStats:
+    """一个批次 / 文件内各阶段的统计"""
+
+    def __init__(self):
+        self.fetch = StageStats("下载")
+        self.preprocess = StageStats("预处理")
+        self.model = StageStats("模型")
+        self.skipped = Counter()  # 预过滤跳过原因 -> 张数
+
+    def print_summary(self):
+        print(self.fetch.summary())
+        if self.skipped:
+            reasons = "，".join(f"{reason} {count}" for reason, count in self.skipped.most_common())
+            print(f"[预过滤] 跳过 {sum(self.skipped.values())} 张：{reasons}")
+        if self.preprocess.count:
+            print(self.preprocess.summary())
+        print(self.model.summary())
+        print(vl_pool.summary())
+        print(client.summary())
+        print(prompt_builder.summary())
+        if desc_cache is not None:
+            print(desc_cache.summary())
+        if phash_index is not None:
+            print(phash_index.summary())
+        if journal is not None:
+            print(journal.summary())
+
+# =============================
+# 图片下载（线程池并发）
+# =============================
+def fetch_image_bytes(s3_client, image_key: str) -> bytes:
+    response = s3_client.get_object(Bucket=BUCKET_NAME, Key=image_key)
+    return response['Body'].read()
+
+async def fetch_image_async(s3_client, image_key: str, fetch_stats: StageStats):
+    """在线程池中下载图片，不阻塞事件循环；失败返回 None"""
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    try:
+        image_content = await loop.run_in_executor(fetch_executor, fetch_image_bytes, s3_client, image_key)
+    except Exception as e:
+        fetch_stats.record(start, time.perf_counter(), ok=False)
+        logging.error(f"无法读取图片 {image_key}: {e}")
+        return None
+    fetch_stats.record(start, time.perf_counter(), nbytes=len(image_content))
+    return image_content
+
+async def fetch_and_filter(s3_client, image_key: str, stats: PipelineStats):
+    """下载图片并做预过滤；下载失败或被过滤时返回 None"""
+    if not image_key:
+        return None
+    image_content = await fetch_image_async(s3_client, image_key, stats.fetch)
+    if image_content is None or not PREFILTER_ENABLED:
+        return image_content
+    # 预过滤需要解析图片头和缩略图，放在下载线程池里执行
+    loop = asyncio.get_running_loop()
+    reason = await loop.run_in_executor(fetch_executor, prefilter_image, image_content)
+    if reason is not None:
+        stats.skipped[reason] += 1
+        return None
+    return image_content
+
+# =============================
+# 预处理 + 模型调用
+# =============================
+async def preprocess_image_async(image_content: bytes, stats: PipelineStats) -> bytes:
+    """在进程池中缩小并重编码图片，事件循环不被解码/编码阻塞"""
+    if preprocess_executor is None:
+        return image_content
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    try:
+        payload, _ = await loop.run_in_executor(
+            preprocess_executor, preprocess_image,
+            image_content, PREPROCESS_MAX_PIXELS, PREPROCESS_FORMAT, PREPROCESS_QUALITY
+        )
+    except Exception as e:
+        logging.error(f"图片预处理失败，使用原图: {e}")
+        stats.preprocess.record(start, time.perf_counter(), nbytes=len(image_content), ok=False,
+                                out_nbytes=len(image_content))
+        return image_content
+    stats.preprocess.record(start, time.perf_counter(), nbytes=len(image_content), out_nbytes=len(payload))
+    return payload
+
+async def call_model(image_content: bytes, ref_text: RefText, caption: str, stats: PipelineStats) -> str:
+    payload = await preprocess_image_async(image_content, stats)
+    ref_text = await asyncio.to_thread(ref_text.build)  # 只为真正发给模型的图片构造参考文字，tokenize 不占事件循环
+    start = time.perf_counter()
+    desc = await get_image_desc_async(payload, ref_text, caption)
+    # 模型阶段的字节数即请求中的图片体积，可与关闭预处理时对比
+    stats.model.record(start, time.perf_counter(), nbytes=len(payload), ok=bool(desc))
+    return desc
+
+async def describe_uncached(image_content: bytes, ref_text: RefText, caption: str, stats: PipelineStats) -> str:
+    """精确缓存未命中时：先找近重复图片复用描述，找不到再调用模型"""
+    if phash_index is None:
+        return await call_model(image_content, ref_text, caption, stats)
+
+    namespace = prompt_fingerprint(caption)
+    loop = asyncio.get_running_loop()
+    image_phash = await loop.run_in_executor(fetch_executor, phash_index.compute, image_content)
+    if image_phash is not None:
+        reused = phash_index.lookup(namespace, image_phash)
+        if reused is not None:
+            return reused
+
+    desc = await call_model(image_content, ref_text, caption, stats)
+    if image_phash is not None:
+        phash_index.add(namespace, image_phash, desc)
+    return desc
+
+# 正在请求模型的缓存键 -> Future，同一图片并发出现时只调用一次模型
+_inflight_descs = {}
+
+async def describe_image(image_content: bytes, ref_text: RefText, caption: str, stats: PipelineStats) -> str:
+    """查描述缓存，未命中再调用模型并回写缓存"""
+    if desc_cache is None:
+        return await describe_uncached(image_content, ref_text, caption, stats)
+
+    image_hash = image_content_hash(image_content)
+    fingerprint = prompt_fingerprint(caption)
+    cache_key = DescCache.make_key(image_hash, fingerprint)
+    if cache_key in _inflight_descs:
+        desc_cache.inflight_hits += 1
+        return await asyncio.shield(_inflight_descs[cache_key])
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight_descs[cache_key] = future
+    desc = ""
+    try:
+        cached = await asyncio.to_thread(desc_cache.get, image_hash, fingerprint)
+        if cached is not None:
+            desc = cached
+        else:
+            desc = await describe_uncached(image_content, ref_text, caption, stats)
+            await asyncio.to_thread(desc_cache.put, image_hash, fingerprint, desc)
+    finally:
+        del _inflight_descs[cache_key]
+        future.set_result(desc)
+    return desc
+
+async def fetch_and_describe(s3_client, image_key, ref_text, caption, stats: PipelineStats) -> str:
+    """下载完成后立即发起模型调用，下载与推理在不同图片之间重叠进行"""
+    image_content = await fetch_and_filter(s3_client, image_key, stats)
+    if image_content is None or FETCH_ONLY_BENCHMARK:
+        return ""
+    return await describe_image(image_content, ref_text, caption, stats)
+
+async def describe_and_record(s3_client, file_key, line_index, image_item, image_key, ref_text, caption,
+                              stats: PipelineStats) -> str:
+    """完成一张图片后立即写入断点日志"""
+    desc = await fetch_and_describe(s3_client, image_key, ref_text, caption, stats)
+    if journal is not None:
+        journal.record(file_key, line_index, image_item["id"], desc)
+    return desc
+
+# =============================
+# 行解析与结果组装
+# =============================
+class InputReadError(Exception):
+    """输入 JSONL 读取或解码失败：跳过该文件（不产生输出），继续处理其他文件"""
+
+def read_jsonl_lines(s3_client, file_key):
+    """
+    逐行读取 JSONL 文件，产出非空行（已去掉首尾空白）；读取或解码失败时抛出 InputReadError。
+    分块范围读取、逐行解码（见 common/s3_line_reader.py），内存占用与文件大小无关。
+    """
+    reader = S3LineReader(s3_client, BUCKET_NAME, file_key, chunk_size=READ_CHUNK_SIZE, parallel=READ_PARALLEL)
+    try:
+        for _, raw in reader.iter_lines():
+            line = raw.decode('utf-8').strip()
+            if line:
+                yield line
+    except Exception as e:
+        raise InputReadError(f"无法读取文件 {file_key}: {e}") from e
+
+async def aread_jsonl_lines(s3_client, file_key, batch_lines: int = 256):
+    """
+    read_jsonl_lines 的异步版本：在后台线程中读取，按 batch_lines 行一批经有界队列交给事件循环，
+    读取与解析重叠，在途的行不超过 READ_QUEUE_LINES。调用方应通过 contextlib.aclosing 使用，
+    提前退出（出错或被取消）时读取线程随之停止。
+    """
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=max(1, READ_QUEUE_LINES // batch_lines))
+    stopped = threading.Event()
+
+    def put(item) -> bool:
+        future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+        while True:
+            try:
+                future.result(timeout=1.0)
+                return True
+            except FutureTimeoutError:
+                if stopped.is_set():
+                    future.cancel()
+                    return False
+
+    def produce():
+        try:
+            batch = []
+            for line in read_jsonl_lines(s3_client, file_key):
+                batch.append(line)
+                if len(batch) >= batch_lines:
+                    if stopped.is_set() or not put(batch):
+                        return
+                    batch = []
+            if batch and not put(batch):
+                return
+            put(None)
+        except Exception as e:
+            if not stopped.is_set():
+                put(e)
+
+    threading.Thread(target=produce, name=f"read-{os.path.basename(file_key)}", daemon=True).start()
+    try:
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            for line in item:
+                yield line
+    finally:
+        stopped.set()
+
+def parse_line_images(file_key, line_index, json_line):
+    """
+    解析一行 JSON，返回 (行结果容器, 图片任务列表)；无需处理的行返回 None。
+    图片任务为 (image_item, image_key, ref_text, caption)，描述结果原地回填到 image_item["desc"]；
+    ref_text 为 RefText，只在调用模型前（在线程中）构造，同一行的页面文本只切句、计数一次。
+    """
+    try:
+        data = json.loads(json_line)
+    except Exception as e:
+        logging.error(f"无法解析文件 {file_key} 第 {line_index} 行: {e}")
+        return None
+
+    if "json_content" not in data:
+        return None
+
+    # 提取所有 page_x 的键，并按数字排序
+    page_keys = sorted(
+        (k for k in data["json_content"].keys() if k.startswith("page_")),
+        key=lambda k: int(re.search(r'\d+$', k).group())
+    )
+
+    page_texts = {}
+    images_in_line = []
+
+    for page_key in page_keys:
+        page_list = data["json_content"][page_key]
+        if not page_list:
+            continue  # 跳过空列表
+        if page_list[-1].get("type") == "merge_text":
+            page_texts[page_key] = page_list[-1]["text"]
+        images_in_line.extend(item for item in page_list if item.get("type") == "image")
+
+    # 该行的结果容器，processed_items 按文档顺序保存所有图片项
+    result_data = {
+        "meta": data.get("meta", {}),
+        "processed_items": images_in_line
+    }
+
+    description = None
+    if "meta" in data and "description" in data["meta"]:
+        description = data["meta"]["description"] or ""
+    line_refs = LineRefs(prompt_builder, page_texts, description)
+    image_jobs = []
+    for image_item in images_in_line:
+        cnt = int(image_item["id"].split("_")[1])
+        ref_text = RefText(line_refs, cnt, image_item.get("caption", ""))
+        image_item["desc"] = ""
+
+        image_key = None
+        if "web_url" in image_item:
+            image_key = INPUT_IMAGE + image_item["web_url"]
+        elif "url" in image_item:
+            image_key = INPUT_IMAGE + image_item["url"]
+
+        image_jobs.append((image_item, image_key, ref_text, image_item.get("caption", "")))
+
+    return result_data, image_jobs
+
+def new_output_writer(s3_client, output_key):
+    # 没有输出行（无非空行或没有图片）的文件也写出空对象，SKIP_EXISTING_OUTPUTS 续跑时据此跳过，不再重复下载解析；
+    # 下载压测模式不写结果，也不能留下空对象
+    return S3MultipartWriter(
+        s3_client, BUCKET_NAME, output_key,
+        part_size=OUTPUT_PART_SIZE,
+        max_pending_parts=OUTPUT_MAX_PENDING_PARTS,
+        allow_empty=not FETCH_ONLY_BENCHMARK
+    )
+
+def build_output_line(result_data):
+    """按页面分组处理过的图片项，生成输出行（bytes）；没有图片时返回 None"""
+    new_json_content = {}
+    for image_item in result_data["processed_items"]:
+        page_id = image_item["id"].split("_")[1]
+        page_key = f"page_{page_id}"
+        if page_key not in new_json_content:
+            new_json_content[page_key] = []
+        new_json_content[page_key].append(image_item)
+
+    # 只有当new_json_content不为空时才写入
+    if not new_json_content:
+        return None
+
+    # 构建输出数据，保持原有行结构
+    output_data = {
+        "meta": result_data["meta"],
+        "json_content": new_json_content
+    }
+    return json.dumps(output_data, ensure_ascii=False).encode('utf-8') + b'\n'
+
 # =============================
 # 批次处理函数
 # =============================
@@ -137,110 +660,73 @@ async def process_batch(s3_client, batch_file_keys, output_keys_set):
     task_metadata = []
     # key: (input_file_key, line_index), value: {"meta": ..., "processed_items": [...]}
     file_line_results = {}
+    read_file_keys = []  # 成功读取的文件，没有输出行的也要写出空对象
 
     batch_start_time = time.time()
     valid_image_count = 0  # 有效图片计数器
+    stats = PipelineStats()
 
     # 遍历批次中的所有文件，收集任务
     for file_key in batch_file_keys:
         output_key = file_key.replace(INPUT_JSONL, OUTPUT_IMAGE_DESC)
-        # if output_key in output_keys_set:
-        #     print(f"跳过已处理文件: {file_key} -> {output_key}")
-        #     continue
+        if SKIP_EXISTING_OUTPUTS and output_key in output_keys_set:
+            print(f"跳过已处理文件: {file_key} -> {output_key}")
+            continue
 
         print(f"读取文件: {file_key}")
         try:
-            response = s3_client.get_object(Bucket=BUCKET_NAME, Key=file_key)
-            content = response['Body'].read().decode('utf-8')
-            lines = [line.strip() for line in content.split('\n') if line.strip()]
-        except Exception as e:
-            logging.error(f"无法读取文件 {file_key}: {e}")
+            lines = list(read_jsonl_lines(s3_client, file_key))  # 非流式模式整批收集任务，先读完整个文件
+        except InputReadError as e:
+            logging.error(str(e))
+            continue
+        try:
+            replay = journal.load(file_key) if journal is not None else {}
+        except JournalReadError as e:
+            logging.error(str(e))
             continue
+        read_file_keys.append(file_key)
 
         # 处理每个JSON行
         for line_index, json_line in enumerate(lines):
             if line_index % 1000 == 0:
                 print(f"  已读取 {line_index} 行...")
-            try:
-                data = json.loads(json_line)
-            except Exception as e:
-                logging.error(f"无法解析文件 {file_key} 第 {line_index} 行: {e}")
-                continue
-
-            if "json_content" not in data:
+            parsed = parse_line_images(file_key, line_index, json_line)
+            if parsed is None:
                 continue
-
-            # 保存原始meta信息
-            original_meta = data.get("meta", {})
-            
-            # 提取所有 page_x 的键，并按数字排序
-            page_keys = sorted(
-                (k for k in data["json_content"].keys() if k.startswith("page_")),
-                key=lambda k: int(re.search(r'\d+$', k).group())
-            )
-
-            page_texts = {}
-            images_in_line = []
-
-            for page_key in page_keys:
-                page_list = data["json_content"][page_key]
-                if not page_list:
-                    continue  # 跳过空列表
-                if page_list[-1].get("type") == "merge_text":
-                    page_texts[page_key] = page_list[-1]["text"]
-                images_in_line.extend(item for item in page_list if item.get("type") == "image")
-
-            # 初始化该行的结果容器
+            result_data, image_jobs = parsed
             file_line_key = (file_key, line_index)
-            file_line_results[file_line_key] = {
-                "meta": original_meta,
-                "original_json_content": data.get("json_content", {}),  # 保存原始结构
-                "processed_items": []
-            }
-
-            for image_item in images_in_line:
-                cnt = int(image_item["id"].split("_")[1])
-                text = " ".join([page_texts.get(f"page_{cnt + i}", "") for i in [-1, 0, 1]])
-                if "meta" in data and "description" in data["meta"]:
-                    text = data["meta"]["description"] + " " + text
-                image_item["desc"] = text
-
-                # 构建任务
-                if "web_url" in image_item:
-                    image_key = INPUT_IMAGE + image_item["web_url"]
-                elif "url" in image_item:
-                    image_key = INPUT_IMAGE + image_item["url"]
-                try:
-                    response = s3_client.get_object(Bucket=BUCKET_NAME, Key=image_key)
-                    image_content = response['Body'].read()
-                except Exception as e:
-                    logging.error(f"无法读取图片 {image_key}: {e}")
-                    image_item["desc"] = ""
-                    file_line_results[file_line_key]["processed_items"].append(image_item)
-                    continue
+            file_line_results[file_line_key] = result_data
 
-                ref_text = image_item["desc"]
-                caption = image_item.get("caption", "")
-
-                task = get_image_desc_async(image_content, ref_text, caption)
+            # 构建任务（下载在协程内部通过线程池完成），断点日志中已完成的图片直接回放
+            for image_item, image_key, ref_text, caption in image_jobs:
+                replayed_desc = replay.get((line_index, image_item["id"]))
+                if replayed_desc is not None:
+                    image_item["desc"] = replayed_desc
+                    valid_image_count += 1
+                    continue
+                task = describe_and_record(s3_client, file_key, line_index, image_item, image_key, ref_text, caption, stats)
                 tasks.append(task)
                 task_metadata.append({
                     "file_line_key": file_line_key,
                     "image_item": image_item
                 })
 
-    if not tasks:
+    if not read_file_keys:
         print("该批次没有需要处理的任务")
         return 0
 
     print(f"该批次共收集到 {len(tasks)} 个图片任务，开始并行处理...")
 
     # 并行执行所有任务
-    results = await tqdm_asyncio.gather(*tasks, desc="处理图片", total=len(tasks))
+    results = await tqdm_asyncio.gather(*tasks, desc="处理图片", total=len(tasks)) if tasks else []
+    stats.print_summary()
+
+    if FETCH_ONLY_BENCHMARK:
+        print("下载压测模式，不写回结果")
+        return 0
 
-    # 将结果回填到对应的行结果中
+    # 将结果回填到对应的图片项中
     for meta, result in zip(task_metadata, results):
-        file_line_key = meta["file_line_key"]
         image_item = meta["image_item"]
 
         if isinstance(result, Exception):
@@ -252,72 +738,516 @@ async def process_batch(s3_client, batch_file_keys, output_keys_set):
         if image_item["desc"].strip():
             valid_image_count += 1
 
-        file_line_results[file_line_key]["processed_items"].append(image_item)
-
     # 写回每个文件的结果
     print("开始写回结果...")
     
     # 按文件分组处理结果
-    file_outputs = {}
+    file_outputs = {file_key: {} for file_key in read_file_keys}
     for (file_key, line_index), result_data in file_line_results.items():
-        if file_key not in file_outputs:
-            file_outputs[file_key] = {}
         file_outputs[file_key][line_index] = result_data
 
     # 为每个文件写入结果
     for file_key, line_results in file_outputs.items():
         output_key = file_key.replace(INPUT_JSONL, OUTPUT_IMAGE_DESC)
-        output_stream = BytesIO()
-
-        # 按行顺序写入结果
-        for line_index in sorted(line_results.keys()):
-            result_data = line_results[line_index]
-            
-            # 重建json_content，只包含处理过的图片项
-            new_json_content = {}
-            
-            # 按页面分组处理过的图片项
-            for image_item in result_data["processed_items"]:
-                page_id = image_item["id"].split("_")[1]
-                page_key = f"page_{page_id}"
-                if page_key not in new_json_content:
-                    new_json_content[page_key] = []
-                new_json_content[page_key].append(image_item)
-
-            # 构建输出数据，保持原有行结构
-            # 只有当new_json_content不为空时才写入
-            if new_json_content:
-                # 构建输出数据，保持原有行结构
-                output_data = {
-                    "meta": result_data["meta"],
-                    "json_content": new_json_content
-                }
-
-                json_line = json.dumps(output_data, ensure_ascii=False)
-                output_stream.write(json_line.encode('utf-8'))
-                output_stream.write(b'\n')
-
-        # 上传结果
-        if output_stream.tell() > 0:  # 只有当有内容时才上传
-            output_stream.seek(0)
-            s3_client.upload_fileobj(
-                Key=output_key,
-                Fileobj=output_stream,
-                Bucket=BUCKET_NAME,
-                ExtraArgs={'ContentType': 'application/json'}
-            )
+
+        # 按行顺序写入结果，边写边分段上传；没有内容时写出空对象
+        with new_output_writer(s3_client, output_key) as output_stream:
+            for line_index in sorted(line_results.keys()):
+                output_line = build_output_line(line_results[line_index])
+                if output_line is not None:
+                    output_stream.write(output_line)
+        if output_stream.tell() > 0:
             print(f"结果已上传: s3://{BUCKET_NAME}/{output_key}")
+        if journal is not None:
+            journal.finish(file_key)
 
     batch_time = time.time() - batch_start_time
     print(f"批次处理完成，耗时: {format_time(batch_time)}")
     print(f"本批次有效图片数量: {valid_image_count}")
     return valid_image_count  # 返回有效图片数量
 
+# =============================
+# 流式处理：解析 → 下载 → 描述 → 写回，多个文件共享下载 / 描述协程
+# =============================
+class StreamingFile:
+    """一个正在流式处理的输入文件：行状态、乱序缓冲与统计"""
+
+    def __init__(self, file_key):
+        self.file_key = file_key
+        self.output_key = file_key.replace(INPUT_JSONL, OUTPUT_IMAGE_DESC)
+        self.stats = PipelineStats()
+        # seq -> {"result": 行结果容器, "line_index": 行号, "pending": 剩余未完成图片数}
+        self.line_states = {}
+        self.done_queue = asyncio.Queue()  # 已完成行的 seq，解析结束后放入 None
+        self.line_slots = asyncio.Semaphore(STREAM_MAX_INFLIGHT_LINES)
+        self.valid_image_count = 0
+
+    def finish_image(self, seq, desc: str):
+        if desc.strip():
+            self.valid_image_count += 1
+        state = self.line_states[seq]
+        state["pending"] -= 1
+        if state["pending"] == 0:
+            self.done_queue.put_nowait(seq)
+
+async def fetch_worker(s3_client, fetch_queue, describe_queue, progress):
+    while True:
+        job = await fetch_queue.get()
+        if job is None:
+            break
+        sfile, seq, image_item, image_key, ref_text, caption = job
+        image_content = await fetch_and_filter(s3_client, image_key, sfile.stats)
+        if image_content is None:
+            image_item["desc"] = ""
+            progress.update(1)
+            sfile.finish_image(seq, "")
+            continue
+        await describe_queue.put((sfile, seq, image_item, image_content, ref_text, caption))
+
+async def describe_worker(describe_queue, progress):
+    while True:
+        job = await describe_queue.get()
+        if job is None:
+            break
+        sfile, seq, image_item, image_content, ref_text, caption = job
+        if FETCH_ONLY_BENCHMARK:
+            desc = ""
+        else:
+            desc = await describe_image(image_content, ref_text, caption, sfile.stats)
+            if journal is not None:
+                journal.record(sfile.file_key, sfile.line_states[seq]["line_index"], image_item["id"], desc)
+        image_item["desc"] = desc
+        progress.update(1)
+        sfile.finish_image(seq, desc)
+
+async def process_file_streaming(s3_client, file_key, fetch_queue):
+    """
+    解析单个文件并把图片任务放入共享的下载队列，返回有效图片数量。
+    驻留内存的图片数受共享队列长度 STREAM_QUEUE_SIZE 限制，每个文件的乱序缓冲受 STREAM_MAX_INFLIGHT_LINES 限制；
+    完成的行按输入顺序写入 S3MultipartWriter，每满 OUTPUT_PART_SIZE 上传一个分段，全部写出后提交分段上传；
+    出错或被取消时放弃分段上传（对象要么完整出现，要么不出现）。
+    """
+    sfile = StreamingFile(file_key)
+    file_start_time = time.time()
+
+    print(f"读取文件: {file_key}")
+    try:
+        replay = await asyncio.to_thread(journal.load, file_key) if journal is not None else {}
+    except JournalReadError as e:
+        logging.error(str(e))  # 本次跳过，输出不存在，重跑时再处理
+        return 0
+
+    async def parse_stage():
+        # 边读取边解析：行从读取线程经有界队列逐批到达，不等整个文件读完
+        seq = 0
+        line_index = -1
+        async with aclosing(aread_jsonl_lines(s3_client, file_key)) as lines:
+            async for json_line in lines:
+                line_index += 1
+                parsed = parse_line_images(file_key, line_index, json_line)
+                if parsed is None:
+                    continue
+                result_data, image_jobs = parsed
+
+                # 断点日志中已完成的图片直接回放，不再进入下载队列
+                pending_jobs = []
+                for image_job in image_jobs:
+                    image_item = image_job[0]
+                    replayed_desc = replay.get((line_index, image_item["id"]))
+                    if replayed_desc is not None:
+                        image_item["desc"] = replayed_desc
+                        sfile.valid_image_count += 1
+                    else:
+                        pending_jobs.append(image_job)
+
+                await sfile.line_slots.acquire()
+                sfile.line_states[seq] = {"result": result_data, "line_index": line_index, "pending": len(pending_jobs)}
+                if not pending_jobs:
+                    sfile.done_queue.put_nowait(seq)
+                for image_item, image_key, ref_text, caption in pending_jobs:
+                    await fetch_queue.put((sfile, seq, image_item, image_key, ref_text, caption))
+                seq += 1
+        return seq
+
+    async def write_stage(output_stream, parser):
+        # 乱序完成的行先放入缓冲，按 seq 连续时依次写出；解析结束且全部写出后退出
+        pending_lines = {}
+        next_seq = 0
+        while not (parser.done() and next_seq == parser.result()):
+            seq = await sfile.done_queue.get()
+            if seq is None:
+                continue  # 解析结束的通知，重新检查退出条件
+            pending_lines[seq] = sfile.line_states.pop(seq)["result"]
+            ready = []
+            while next_seq in pending_lines:
+                output_line = build_output_line(pending_lines.pop(next_seq))
+                if output_line is not None and not FETCH_ONLY_BENCHMARK:
+                    ready.append(output_line)
+                sfile.line_slots.release()
+                next_seq += 1
+            if ready:
+                # 分段在途已满时 write 会阻塞，放到线程中执行
+                await asyncio.to_thread(output_stream.write, b"".join(ready))
+
+    output_stream = new_output_writer(s3_client, sfile.output_key)
+    parser = asyncio.create_task(parse_stage())
+    parser.add_done_callback(lambda _: sfile.done_queue.put_nowait(None))
+    try:
+        await write_stage(output_stream, parser)
+        sfile.stats.print_summary()
+        # 提交分段上传；没有内容时写出空对象
+        await asyncio.to_thread(output_stream.close)
+    except BaseException as e:
+        # 出错或被取消时先停止解析（不再为已放弃的文件提交任务，也不会阻塞在 line_slots 上），
+        # 再放弃分段上传，不留下写了一半的输出
+        parser.cancel()
+        await asyncio.gather(parser, return_exceptions=True)
+        await asyncio.shield(asyncio.to_thread(output_stream.abort))
+        if isinstance(e, InputReadError):
+            logging.error(str(e))
+            return 0
+        raise
+    if output_stream.tell() > 0:
+        print(f"结果已上传: s3://{BUCKET_NAME}/{sfile.output_key}")
+    if journal is not None and not FETCH_ONLY_BENCHMARK:
+        await asyncio.to_thread(journal.finish, file_key)
+
+    print(f"文件 {file_key} 处理完成，耗时: {format_time(time.time() - file_start_time)}，"
+          f"有效图片数量: {sfile.valid_image_count}")
+    return sfile.valid_image_count
+
+async def run_streaming(s3_client, file_keys):
+    """
+    全局调度：同时保持 FILES_IN_FLIGHT 个文件在处理中，所有文件的图片任务进入同一组
+    下载 / 描述协程，文件边界和小文件不再让模型端空等。返回全局有效图片数量。
+    """
+    fetch_queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)     # (文件, seq, image_item, image_key, ref_text, caption)
+    describe_queue = asyncio.Queue(maxsize=STREAM_QUEUE_SIZE)  # (文件, seq, image_item, image_content, ref_text, caption)
+    progress = tqdm_asyncio(desc="处理图片", unit="张")
+    fetchers = [asyncio.create_task(fetch_worker(s3_client, fetch_queue, describe_queue, progress))
+                for _ in range(FETCH_CONCURRENCY)]
+    describers = [asyncio.create_task(describe_worker(describe_queue, progress))
+                  for _ in range(MAX_CONCURRENT_REQUESTS)]
+
+    file_slots = asyncio.Semaphore(FILES_IN_FLIGHT)
+    finished_files = 0
+    global_valid_count = 0
+
+    async def run_file(file_key):
+        nonlocal finished_files, global_valid_count
+        async with file_slots:
+            valid_count = await process_file_streaming(s3_client, file_key, fetch_queue)
+        finished_files += 1
+        global_valid_count += valid_count
+        print(f" 已完成 {finished_files}/{len(file_keys)} 个文件，全局有效图片数量: {global_valid_count}")
+
+    await asyncio.gather(*(run_file(file_key) for file_key in file_keys))
+
+    for _ in fetchers:
+        await fetch_queue.put(None)
+    await asyncio.gather(*fetchers)
+    for _ in describers:
+        await describe_queue.put(None)
+    await asyncio.gather(*describers)
+    progress.close()
+    return global_valid_count
+
+# =============================
+# 离线批处理模式
+# =============================
+def batch_manifest_path(file_key: str) -> str:
+    return os.path.join(OFFLINE_BATCH_DIR, "manifests", file_key.replace("/", "__") + ".manifest.jsonl")
+
+def load_batch_manifest(file_key: str):
+    """读取某个输入文件的清单，返回 [{"line", "id", "desc" 或 "key"}]；不存在时返回 None"""
+    path = batch_manifest_path(file_key)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+async def prepare_batch_image(s3_client, image_key, ref_text, caption, stats: PipelineStats,
+                              writer: BatchShardWriter, requested: set) -> dict:
+    """
+    下载、过滤、预处理一张图片并写入请求分片。
+    返回清单字段：缓存命中时为 {"desc": 描述}，否则为 {"key": 请求的 custom_id}；无效图片返回 {}。
+    custom_id 即描述缓存键，同一图片在整个回填中只请求一次。
+    """
+    image_content = await fetch_and_filter(s3_client, image_key, stats)
+    if image_content is None:
+        return {}
+    image_hash = image_content_hash(image_content)
+    fingerprint = prompt_fingerprint(caption)
+    if desc_cache is not None:
+        cached = await asyncio.to_thread(desc_cache.get, image_hash, fingerprint)
+        if cached is not None:
+            return {"desc": cached}
+
+    custom_id = DescCache.make_key(image_hash, fingerprint)
+    if custom_id not in requested:
+        payload = await preprocess_image_async(image_content, stats)
+        if not is_valid_image(payload)[0]:
+            return {}
+        # 预处理期间同一图片可能已由其他协程写入，重新检查；只有写入分片的请求才记入 requested
+        if custom_id not in requested:
+            requested.add(custom_id)
+            writer.add(custom_id, build_request_body(payload, await asyncio.to_thread(ref_text.build), caption))
+    return {"key": custom_id}
+
+async def prepare_batch_file(s3_client, file_key, writer: BatchShardWriter, requested: set) -> int:
+    """为一个输入文件生成请求并写出清单，返回写入清单的图片数"""
+    print(f"读取文件: {file_key}")
+    stats = PipelineStats()
+    records = []
+    # 下载（FETCH_CONCURRENCY 个线程）远快于预处理（PREPROCESS_WORKERS 个进程），限制在途图片数，
+    # 否则整个文件的图片字节会先堆积在内存中
+    slots = asyncio.Semaphore(OFFLINE_BATCH_PREPARE_INFLIGHT)
+
+    async def prepare_one(line_index, image_item, image_key, ref_text, caption, progress):
+        try:
+            record = {"line": line_index, "id": image_item["id"]}
+            record.update(await prepare_batch_image(s3_client, image_key, ref_text, caption, stats, writer, requested))
+            records.append(record)
+        finally:
+            slots.release()
+            progress.update(1)
+
+    tasks = []
+    with tqdm_asyncio(desc="准备请求") as progress:
+        try:
+            line_index = -1
+            async with aclosing(aread_jsonl_lines(s3_client, file_key)) as lines:
+                async for json_line in lines:
+                    line_index += 1
+                    parsed = parse_line_images(file_key, line_index, json_line)
+                    if parsed is None:
+                        continue
+                    for image_item, image_key, ref_text, caption in parsed[1]:
+                        await slots.acquire()
+                        tasks.append(asyncio.create_task(
+                            prepare_one(line_index, image_item, image_key, ref_text, caption, progress)
+                        ))
+            await asyncio.gather(*tasks)
+        except InputReadError as e:
+            logging.error(str(e))  # 不写清单，重跑时重新准备这个文件
+            return 0
+        finally:
+            for task in tasks:
+                task.cancel()
+    stats.print_summary()
+
+    # 清单整体写完再改名，中断后重跑会重新准备这个文件
+    path = batch_manifest_path(file_key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        for record in sorted(records, key=lambda r: (r["line"], r["id"])):
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+    os.replace(path + ".tmp", path)
+    return len(records)
+
+def collect_failed_requests(shard_paths, results_dir) -> set:
+    """已有结果的分片中没有得到有效描述的 custom_id（出错、回复为空或结果中缺失）；在任一分片中成功即不算失败"""
+    requested, succeeded = set(), set()
+    for shard_path in shard_paths:
+        output_path = result_path(results_dir, shard_path)
+        if not os.path.exists(output_path):
+            continue
+        requested.update(custom_id for custom_id, _ in read_requests(shard_path))
+        succeeded.update(custom_id for custom_id, desc in read_results(output_path) if desc and desc.strip())
+    return requested - succeeded
+
+def write_retry_shards(shard_paths, failed: set) -> int:
+    """把失败请求的原始请求体写入新的分片（接着已有分片编号），返回写入的请求数"""
+    writer = BatchShardWriter(
+        os.path.join(OFFLINE_BATCH_DIR, "shards"),
+        max_requests=OFFLINE_BATCH_SHARD_MAX_REQUESTS,
+        max_bytes=OFFLINE_BATCH_SHARD_MAX_BYTES
+    )
+    written = set()
+    try:
+        for shard_path in shard_paths:
+            for custom_id, body in read_requests(shard_path):
+                if custom_id in failed and custom_id not in written:
+                    written.add(custom_id)
+                    writer.add(custom_id, body)
+    finally:
+        writer.close()
+    return len(written)
+
+async def submit_batch_shards():
+    """
+    把还没有结果的分片交给执行器；结果文件已存在的分片跳过，可断点续跑。
+    全部分片完成后，结果出错或缺失的请求写入重试分片再提交，最多 OFFLINE_BATCH_RETRY_ROUNDS 轮。
+    """
+    results_dir = os.path.join(OFFLINE_BATCH_DIR, "results")
+    os.makedirs(results_dir, exist_ok=True)
+    api_client = None
+    if OFFLINE_BATCH_RUNNER == "openai":
+        api_client = AsyncClient(api_key="EMPTY", base_url=OFFLINE_BATCH_API_BASE)
+
+    for retry_round in range(OFFLINE_BATCH_RETRY_ROUNDS + 1):
+        shard_paths = list_shards(os.path.join(OFFLINE_BATCH_DIR, "shards"))
+        if retry_round > 0:
+            failed = await asyncio.to_thread(collect_failed_requests, shard_paths, results_dir)
+            if not failed:
+                return
+            written = await asyncio.to_thread(write_retry_shards, shard_paths, failed)
+            print(f"[离线批处理] {written} 个请求没有得到有效结果，写入重试分片（第 {retry_round} 轮）")
+            shard_paths = list_shards(os.path.join(OFFLINE_BATCH_DIR, "shards"))
+        await run_pending_shards(shard_paths, results_dir, api_client)
+
+async def run_pending_shards(shard_paths, results_dir, api_client):
+    for shard_path in shard_paths:
+        output_path = result_path(results_dir, shard_path)
+        if os.path.exists(output_path):
+            continue
+        start = time.time()
+        if OFFLINE_BATCH_RUNNER == "openai":
+            await run_shard_openai(shard_path, output_path, api_client, OFFLINE_BATCH_POLL_INTERVAL)
+        elif OFFLINE_BATCH_RUNNER == "vllm":
+            await run_shard_vllm(shard_path, output_path, OFFLINE_BATCH_VLLM_MODEL, VL_MODEL_NAME,
+                                 OFFLINE_BATCH_VLLM_ARGS)
+        else:
+            await run_shard_local(shard_path, output_path, client.create, MAX_CONCURRENT_REQUESTS)
+        print(f"分片 {os.path.basename(shard_path)} 完成，耗时: {format_time(time.time() - start)}")
+
+async def merge_batch_results(s3_client, file_keys) -> int:
+    """读取全部分片结果，按清单回填到各文件的 json_content 页面结构并上传，返回有效图片数"""
+    results = {}
+    results_dir = os.path.join(OFFLINE_BATCH_DIR, "results")
+    for shard_path in list_shards(os.path.join(OFFLINE_BATCH_DIR, "shards")):
+        output_path = result_path(results_dir, shard_path)
+        if not os.path.exists(output_path):
+            print(f"分片 {os.path.basename(shard_path)} 尚无结果，对应图片描述为空")
+            continue
+        for custom_id, desc in read_results(output_path):
+            if desc and desc.strip():
+                results[custom_id] = desc  # 重试分片中的成功结果覆盖之前的失败
+    print(f"读取到 {len(results)} 条批处理结果")
+
+    # 结果写入描述缓存，之后的在线运行和重跑都能直接命中
+    if desc_cache is not None:
+        for custom_id, desc in results.items():
+            image_hash, fingerprint = custom_id.split(":", 1)
+            await asyncio.to_thread(desc_cache.put, image_hash, fingerprint, desc)
+
+    global_valid_count = 0
+    total_failed = 0
+    for file_key in file_keys:
+        manifest = load_batch_manifest(file_key)
+        if manifest is None:
+            print(f"文件 {file_key} 没有请求清单，跳过（需先运行 prepare 阶段）")
+            continue
+        descs = {}
+        failed = 0
+        for record in manifest:
+            descs[(record["line"], record["id"])] = record.get("desc") or results.get(record.get("key"), "")
+            if "key" in record and record["key"] not in results:
+                failed += 1
+        if failed:
+            logging.warning(f"文件 {file_key} 有 {failed} 张图片的批处理请求失败或没有结果，描述为空")
+            total_failed += failed
+
+        valid_image_count = 0
+        output_key = file_key.replace(INPUT_JSONL, OUTPUT_IMAGE_DESC)
+        try:
+            with new_output_writer(s3_client, output_key) as output_stream:
+                line_index = -1
+                async with aclosing(aread_jsonl_lines(s3_client, file_key)) as lines:
+                    async for json_line in lines:
+                        line_index += 1
+                        parsed = parse_line_images(file_key, line_index, json_line)
+                        if parsed is None:
+                            continue
+                        result_data, image_jobs = parsed
+                        for image_item, _, _, _ in image_jobs:
+                            image_item["desc"] = descs.get((line_index, image_item["id"]), "")
+                            if image_item["desc"].strip():
+                                valid_image_count += 1
+                        output_line = build_output_line(result_data)
+                        if output_line is not None:
+                            output_stream.write(output_line)
+        except InputReadError as e:
+            logging.error(str(e))  # 输出已放弃上传
+            continue
+        if output_stream.tell() > 0:
+            print(f"结果已上传: s3://{BUCKET_NAME}/{output_key}")
+        print(f"文件 {file_key} 合并完成，有效图片数量: {valid_image_count}")
+        global_valid_count += valid_image_count
+    if total_failed:
+        logging.warning(f"[离线批处理] 共 {total_failed} 张图片的批处理请求失败或没有结果，输出中描述为空")
+    return global_valid_count
+
+async def run_offline_batch(s3_client, file_keys) -> int:
+    """离线批处理：prepare 写分片与清单 → submit 执行分片 → merge 合并回写，返回全局有效图片数量"""
+    global_valid_count = 0
+    if "prepare" in OFFLINE_BATCH_STAGES:
+        writer = BatchShardWriter(
+            os.path.join(OFFLINE_BATCH_DIR, "shards"),
+            max_requests=OFFLINE_BATCH_SHARD_MAX_REQUESTS,
+            max_bytes=OFFLINE_BATCH_SHARD_MAX_BYTES
+        )
+        # 之前运行已写入分片的请求不再重复生成
+        requested = set()
+        for file_key in file_keys:
+            manifest = load_batch_manifest(file_key)
+            if manifest is not None:
+                requested.update(record["key"] for record in manifest if "key" in record)
+        try:
+            for file_key in file_keys:
+                if load_batch_manifest(file_key) is not None:
+                    print(f"跳过已准备的文件: {file_key}")
+                    continue
+                await prepare_batch_file(s3_client, file_key, writer, requested)
+        finally:
+            writer.close()
+        print(f"[离线批处理] 本次写入 {writer.total_requests} 个请求，"
+              f"共 {writer.total_bytes / 1024 / 1024:.1f} MB")
+    if "submit" in OFFLINE_BATCH_STAGES:
+        await submit_batch_shards()
+    if "merge" in OFFLINE_BATCH_STAGES:
+        global_valid_count = await merge_batch_results(s3_client, file_keys)
+    return global_valid_count
+
 # =============================
 # 主程序入口
 # =============================
 async def main():
-    s3_client = boto3.client("s3", **S3_CONFIG)
+    global desc_cache, preprocess_executor, phash_index, journal
+    s3_client = boto3.client(
+        "s3",
+        config=Config(max_pool_connections=FETCH_CONCURRENCY),
+        **S3_CONFIG
+    )
+
+    if DESC_CACHE_ENABLED:
+        desc_cache = DescCache(
+            DESC_CACHE_PATH,
+            s3_client=s3_client,
+            s3_bucket=BUCKET_NAME,
+            s3_prefix=DESC_CACHE_S3_PREFIX,
+            max_bytes=DESC_CACHE_MAX_BYTES,
+            max_age_days=DESC_CACHE_MAX_AGE_DAYS
+        )
+        print(f"描述缓存启动淘汰 {desc_cache.evict()} 条过期/超限条目")
+
+    if JOURNAL_ENABLED:
+        journal = CheckpointJournal(
+            JOURNAL_DIR,
+            s3_client=s3_client,
+            s3_bucket=BUCKET_NAME,
+            s3_prefix=JOURNAL_S3_PREFIX
+        )
+
+    if PHASH_ENABLED:
+        phash_index = PHashIndex(algorithm=PHASH_ALGORITHM, max_distance=PHASH_MAX_DISTANCE)
+
+    if PREPROCESS_ENABLED:
+        # 下载线程已在运行，用 spawn 启动子进程，避免 fork 继承线程持有的锁
+        preprocess_executor = ProcessPoolExecutor(
+            max_workers=PREPROCESS_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
 
     # 列出所有输入 JSONL 文件
     paginator = s3_client.get_paginator('list_objects_v2')
@@ -340,18 +1270,45 @@ async def main():
     total_start_time = time.time()
     global_valid_count = 0  # 全局有效图片计数器
 
-    # 分批处理文件
-    for i in range(0, len(file_keys), BATCH_SIZE):
-        batch = file_keys[i:i + BATCH_SIZE]
-        print(f"\n=== 处理第 {i//BATCH_SIZE + 1} 批次 ({len(batch)} 个文件) ===")
-        batch_valid_count = await process_batch(s3_client, batch, output_keys_set)
-        global_valid_count += batch_valid_count
-        print(f" 全局有效图片数量: {global_valid_count}")
+    if STREAMING_MODE or OFFLINE_BATCH_MODE:
+        pending_keys = []
+        for file_key in file_keys:
+            output_key = file_key.replace(INPUT_JSONL, OUTPUT_IMAGE_DESC)
+            if SKIP_EXISTING_OUTPUTS and output_key in output_keys_set:
+                print(f"跳过已处理文件: {file_key} -> {output_key}")
+                continue
+            pending_keys.append(file_key)
+        if OFFLINE_BATCH_MODE:
+            # 离线批处理模式：非交互的大规模回填
+            global_valid_count = await run_offline_batch(s3_client, pending_keys)
+        else:
+            # 流式模式：多个文件同时在途，共享下载 / 描述协程
+            global_valid_count = await run_streaming(s3_client, pending_keys)
+    else:
+        # 分批处理文件
+        for i in range(0, len(file_keys), BATCH_SIZE):
+            batch = file_keys[i:i + BATCH_SIZE]
+            print(f"\n=== 处理第 {i//BATCH_SIZE + 1} 批次 ({len(batch)} 个文件) ===")
+            batch_valid_count = await process_batch(s3_client, batch, output_keys_set)
+            global_valid_count += batch_valid_count
+            print(f" 全局有效图片数量: {global_valid_count}")
 
     total_time = time.time() - total_start_time
     print(f"\n所有批次处理完成，总耗时: {format_time(total_time)}")
     print(f"🎉 全局有效图片总数: {global_valid_count}")
 
+    if desc_cache is not None:
+        print(desc_cache.summary())
+        desc_cache.evict()
+        desc_cache.close()
+    if preprocess_executor is not None:
+        preprocess_executor.shutdown()
+
 if __name__ == "__main__":
     print('******* 开始图文理解处理流程 ********')
-    asyncio.run(main())
\ No newline at end of file
+    try:
+        asyncio.run(main())
+    finally:
+        # 中断退出时也把尚未同步的断点日志上传
+        if journal is not None:
+            journal.close()
\ No newline at end of file
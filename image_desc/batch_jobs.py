@@ -0,0 +1,178 @@
+import asyncio
+import json
+import logging
+import os
+import sys
+
+
+# =============================
+# OpenAI batch 格式的请求分片
+# =============================
+BATCH_ENDPOINT = "/v1/chat/completions"
+FINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+class BatchShardWriter:
+    """
+    把请求写成 OpenAI batch 格式的 JSONL 分片（每行 custom_id / method / url / body），
+    单个分片达到 max_requests 条或 max_bytes 字节后滚动到下一个分片。
+    目录中已有分片时接着编号，重复运行不会覆盖已写好的分片。
+    """
+
+    def __init__(self, shard_dir, max_requests=5000, max_bytes=200 * 1024 * 1024):
+        self.shard_dir = shard_dir
+        self.max_requests = max_requests
+        self.max_bytes = max_bytes
+        os.makedirs(shard_dir, exist_ok=True)
+        self._index = len(list_shards(shard_dir))
+        self._file = None
+        self._requests = 0
+        self._bytes = 0
+        self.total_requests = 0
+        self.total_bytes = 0
+
+    def _open_next(self):
+        self.close()
+        path = os.path.join(self.shard_dir, f"requests_{self._index:05d}.jsonl")
+        self._index += 1
+        # 写完整个分片后再改名，提交阶段不会读到写了一半的分片
+        self._file = open(path + ".tmp", "w", encoding="utf-8")
+        self._requests = 0
+        self._bytes = 0
+
+    def add(self, custom_id: str, body: dict):
+        line = json.dumps(
+            {"custom_id": custom_id, "method": "POST", "url": BATCH_ENDPOINT, "body": body},
+            ensure_ascii=False
+        ) + "\n"
+        size = len(line.encode("utf-8"))
+        if self._file is None or self._requests >= self.max_requests or (
+                self._requests and self._bytes + size > self.max_bytes):
+            self._open_next()
+        self._file.write(line)
+        self._requests += 1
+        self._bytes += size
+        self.total_requests += 1
+        self.total_bytes += size
+
+    def close(self):
+        if self._file is not None:
+            tmp_path = self._file.name
+            self._file.close()
+            os.replace(tmp_path, tmp_path[:-len(".tmp")])
+            self._file = None
+
+
+def list_shards(shard_dir):
+    if not os.path.isdir(shard_dir):
+        return []
+    return sorted(os.path.join(shard_dir, name) for name in os.listdir(shard_dir)
+                  if name.startswith("requests_") and name.endswith(".jsonl"))
+
+
+def result_path(results_dir: str, shard_path: str) -> str:
+    return os.path.join(results_dir, os.path.basename(shard_path).replace("requests_", "results_", 1))
+
+
+def read_requests(shard_path):
+    """逐行读取请求分片，生成 (custom_id, 请求体)"""
+    with open(shard_path, encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                request = json.loads(line)
+                yield request["custom_id"], request["body"]
+
+
+def read_results(path):
+    """逐行读取 batch 输出，生成 (custom_id, 回复文本)；失败的请求回复文本为 None"""
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except Exception:
+                continue
+            response = record.get("response") or {}
+            body = response.get("body") or {}
+            content = None
+            if not record.get("error") and response.get("status_code", 200) == 200:
+                try:
+                    content = body["choices"][0]["message"]["content"]
+                except (KeyError, IndexError, TypeError):
+                    content = None
+            yield record.get("custom_id"), content
+
+
+# =============================
+# 分片执行器
+# =============================
+async def run_shard_local(shard_path, output_path, create, concurrency: int):
+    """
+    本地替身：读取分片，用 create(**body) 逐条请求（即在线模式使用的端点池客户端），
+    按 batch 输出格式写结果。用于没有批处理接口的部署和端到端验证。
+    """
+    with open(shard_path, encoding="utf-8") as f:
+        requests = [json.loads(line) for line in f if line.strip()]
+
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as out:
+        queue = asyncio.Queue()
+        for request in requests:
+            queue.put_nowait(request)
+
+        async def worker():
+            while not queue.empty():
+                request = queue.get_nowait()
+                record = {"id": f"local-{request['custom_id']}", "custom_id": request["custom_id"]}
+                try:
+                    response = await create(**request["body"])
+                    record["response"] = {"status_code": 200, "body": response.model_dump()}
+                    record["error"] = None
+                except Exception as e:
+                    record["response"] = None
+                    record["error"] = {"code": type(e).__name__, "message": str(e)}
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+        await asyncio.gather(*(worker() for _ in range(max(1, min(concurrency, len(requests))))))
+    os.replace(tmp_path, output_path)
+
+
+async def run_shard_openai(shard_path, output_path, api_client, poll_interval: float = 60,
+                           completion_window: str = "24h"):
+    """通过 /v1/files + /v1/batches 接口提交分片，轮询完成后下载输出（失败请求的错误文件一并追加）"""
+    with open(shard_path, "rb") as f:
+        input_file = await api_client.files.create(file=f, purpose="batch")
+    batch = await api_client.batches.create(
+        input_file_id=input_file.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window=completion_window
+    )
+    print(f"已提交批处理 {batch.id}（{os.path.basename(shard_path)}）")
+    while batch.status not in FINAL_STATUSES:
+        await asyncio.sleep(poll_interval)
+        batch = await api_client.batches.retrieve(batch.id)
+    if batch.status != "completed":
+        raise RuntimeError(f"批处理 {batch.id} 结束状态为 {batch.status}")
+
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "wb") as out:
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                content = await api_client.files.content(file_id)
+                out.write(content.content)
+    os.replace(tmp_path, output_path)
+
+
+async def run_shard_vllm(shard_path, output_path, model_path: str, served_model_name: str, extra_args=()):
+    """调用 vLLM 的离线批处理入口（vllm run-batch）直接在本机 GPU 上推理整个分片"""
+    tmp_path = output_path + ".tmp"
+    process = await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "vllm.entrypoints.openai.run_batch",
+        "-i", shard_path, "-o", tmp_path,
+        "--model", model_path, "--served-model-name", served_model_name,
+        *extra_args
+    )
+    returncode = await process.wait()
+    if returncode != 0:
+        raise RuntimeError(f"vllm run_batch 退出码 {returncode}（{shard_path}）")
+    os.replace(tmp_path, output_path)
+    logging.info(f"vllm run_batch 完成: {output_path}")
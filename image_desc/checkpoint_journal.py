@@ -0,0 +1,167 @@
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+# =============================
+# 逐图片断点日志
+# =============================
+class JournalReadError(Exception):
+    """读取 S3 断点日志失败：已有分段不确定，不能继续追加（新分段可能覆盖已记录的分段）"""
+
+
+class CheckpointJournal:
+    """
+    追加写的断点日志，记录 (输入文件, 行号, 图片 id) -> 描述。
+    本地每个输入文件对应一个 JSONL 日志；传入 s3_client 和 s3_prefix 时，
+    每攒够 s3_segment_records 条就把新增记录作为一个分段对象上传到 S3，
+    换机器重启时也能从 S3 分段回放。输出文件上传成功后调用 finish 清理。
+    """
+
+    def __init__(self, journal_dir, s3_client=None, s3_bucket=None, s3_prefix="", s3_segment_records=500):
+        self.journal_dir = journal_dir
+        self.s3_client = s3_client
+        self.s3_bucket = s3_bucket
+        self.s3_prefix = s3_prefix
+        self.s3_segment_records = s3_segment_records
+        os.makedirs(journal_dir, exist_ok=True)
+
+        self._files = {}        # file_key -> 本地日志文件对象
+        self._segments = {}     # file_key -> 尚未上传到 S3 的记录
+        self._segment_seq = {}  # file_key -> 下一个分段序号
+        self._lock = threading.Lock()
+        self._uploader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="journal-upload")
+        self.replayed = 0
+        self.recorded = 0
+
+    @staticmethod
+    def _safe_name(file_key: str) -> str:
+        return file_key.replace("/", "__")
+
+    def _local_path(self, file_key: str) -> str:
+        return os.path.join(self.journal_dir, self._safe_name(file_key) + ".journal.jsonl")
+
+    def _s3_dir(self, file_key: str) -> str:
+        return f"{self.s3_prefix}{self._safe_name(file_key)}/"
+
+    def _use_s3(self) -> bool:
+        return self.s3_client is not None and bool(self.s3_prefix)
+
+    def _list_s3_segments(self, file_key: str):
+        paginator = self.s3_client.get_paginator('list_objects_v2')
+        pages = paginator.paginate(Bucket=self.s3_bucket, Prefix=self._s3_dir(file_key))
+        return sorted(obj['Key'] for page in pages for obj in page.get('Contents', []))
+
+    @staticmethod
+    def _next_seq(segment_keys) -> int:
+        """已有分段之后的序号；上传失败的分段会留下空号，按最大序号而不是分段数计算"""
+        seqs = [os.path.basename(key)[:-len(".jsonl")] for key in segment_keys]
+        return max((int(seq) + 1 for seq in seqs if seq.isdigit()), default=0)
+
+    @staticmethod
+    def _parse_records(lines, finished: dict):
+        for line in lines:
+            try:
+                record = json.loads(line)
+                finished[(record["line"], record["id"])] = record["desc"]
+            except Exception:
+                continue  # 崩溃时写了一半的最后一行
+
+    def load(self, file_key: str) -> dict:
+        """
+        回放某个输入文件已完成的描述，返回 {(行号, 图片 id): 描述}。
+        S3 分段读取失败时抛出 JournalReadError，调用方本次跳过该文件；分段序号只在成功列出已有分段后确定。
+        """
+        finished = {}
+        if self._use_s3():
+            try:
+                segment_keys = self._list_s3_segments(file_key)
+                for key in segment_keys:
+                    body = self.s3_client.get_object(Bucket=self.s3_bucket, Key=key)['Body'].read()
+                    self._parse_records(body.decode('utf-8').splitlines(), finished)
+            except Exception as e:
+                raise JournalReadError(f"读取 S3 断点日志失败 {file_key}: {e}") from e
+            with self._lock:
+                self._segment_seq[file_key] = self._next_seq(segment_keys)
+        local_path = self._local_path(file_key)
+        if os.path.exists(local_path):
+            with open(local_path, encoding='utf-8') as f:
+                self._parse_records(f, finished)
+        self.replayed += len(finished)
+        return finished
+
+    def record(self, file_key: str, line_index: int, image_id: str, desc: str):
+        """追加一条完成记录；空描述（失败或被过滤）不记录，重启后会重新处理"""
+        if not desc or not desc.strip():
+            return
+        line = json.dumps({"line": line_index, "id": image_id, "desc": desc}, ensure_ascii=False) + "\n"
+        with self._lock:
+            f = self._files.get(file_key)
+            if f is None:
+                f = self._files[file_key] = open(self._local_path(file_key), "a", encoding="utf-8")
+            f.write(line)
+            f.flush()
+            self.recorded += 1
+            if self._use_s3():
+                segment = self._segments.setdefault(file_key, [])
+                segment.append(line)
+                if len(segment) >= self.s3_segment_records:
+                    self._submit_segment(file_key)
+
+    def _submit_segment(self, file_key: str):
+        # 调用方已持有 self._lock
+        segment = self._segments.pop(file_key, None)
+        if not segment:
+            return None
+        seq = self._segment_seq.get(file_key, 0)
+        self._segment_seq[file_key] = seq + 1
+        key = f"{self._s3_dir(file_key)}{seq:06d}.jsonl"
+        return self._uploader.submit(self._upload_segment, key, "".join(segment).encode("utf-8"))
+
+    def _upload_segment(self, key: str, body: bytes):
+        try:
+            self.s3_client.put_object(Bucket=self.s3_bucket, Key=key, Body=body)
+        except Exception as e:
+            logging.warning(f"上传断点日志分段失败 {key}: {e}")
+
+    def flush(self, file_key: str):
+        """把尚未上传的记录立即上传到 S3 并等待完成"""
+        if not self._use_s3():
+            return
+        with self._lock:
+            future = self._submit_segment(file_key)
+        if future is not None:
+            future.result()
+
+    def finish(self, file_key: str):
+        """输出文件上传成功后删除该文件的断点日志"""
+        with self._lock:
+            f = self._files.pop(file_key, None)
+            if f is not None:
+                f.close()
+            self._segments.pop(file_key, None)
+            self._segment_seq.pop(file_key, None)
+        local_path = self._local_path(file_key)
+        if os.path.exists(local_path):
+            os.remove(local_path)
+        if self._use_s3():
+            self._uploader.submit(lambda: None).result()  # 等待已提交的分段上传完，避免删除后又写入
+            try:
+                for key in self._list_s3_segments(file_key):
+                    self.s3_client.delete_object(Bucket=self.s3_bucket, Key=key)
+            except Exception as e:
+                logging.warning(f"清理 S3 断点日志失败 {file_key}: {e}")
+
+    def close(self):
+        for file_key in list(self._segments):
+            self.flush(file_key)
+        with self._lock:
+            for f in self._files.values():
+                f.close()
+            self._files.clear()
+        self._uploader.shutdown()
+
+    def summary(self) -> str:
+        return f"[断点日志] 回放 {self.replayed} 条，新记录 {self.recorded} 条"
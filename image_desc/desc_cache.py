@@ -0,0 +1,155 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+
+
+# =============================
+# 图片描述缓存
+# =============================
+def image_content_hash(image_data: bytes) -> str:
+    """图片内容的 SHA-256（与 nih_image_hash.txt 中的命名方式一致）"""
+    return hashlib.sha256(image_data).hexdigest()
+
+
+def make_fingerprint(*parts) -> str:
+    """把提示词模板、caption、模型名等拼接后取哈希，作为缓存键的一部分"""
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(str(part).encode("utf-8"))
+        h.update(b"\x00")
+    return h.hexdigest()[:16]
+
+
+class DescCache:
+    """
+    按 (图片内容哈希, 指纹) 缓存图片描述。
+    本地层为 SQLite；传入 s3_client 和 s3_prefix 时，额外启用 S3 共享层，
+    本地未命中时回源 S3，命中后回填本地。
+    """
+
+    def __init__(self, db_path, s3_client=None, s3_bucket=None, s3_prefix="",
+                 max_bytes=None, max_age_days=None):
+        self.db_path = db_path
+        self.s3_client = s3_client
+        self.s3_bucket = s3_bucket
+        self.s3_prefix = s3_prefix
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+
+        self.local_hits = 0
+        self.s3_hits = 0
+        self.inflight_hits = 0  # 同一图片并发出现、复用正在进行的请求结果
+        self.misses = 0
+        self.puts = 0
+
+        # 查询和写入在线程池中并发执行，统一加锁
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS desc_cache ("
+            " key TEXT PRIMARY KEY,"
+            " desc TEXT NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created REAL NOT NULL,"
+            " last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON desc_cache(last_access)")
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(image_hash: str, fingerprint: str) -> str:
+        return f"{image_hash}:{fingerprint}"
+
+    def _s3_key(self, key: str) -> str:
+        image_hash, fingerprint = key.split(":", 1)
+        return f"{self.s3_prefix}{fingerprint}/{image_hash[:2]}/{image_hash}.txt"
+
+    def _put_local(self, key: str, desc: str):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO desc_cache (key, desc, size, created, last_access) VALUES (?, ?, ?, ?, ?)",
+                (key, desc, len(desc.encode("utf-8")), now, now)
+            )
+            self._conn.commit()
+
+    def get(self, image_hash: str, fingerprint: str):
+        """查询缓存，未命中返回 None"""
+        key = self.make_key(image_hash, fingerprint)
+        with self._lock:
+            row = self._conn.execute("SELECT desc FROM desc_cache WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                self._conn.execute("UPDATE desc_cache SET last_access = ? WHERE key = ?", (time.time(), key))
+                self._conn.commit()
+                self.local_hits += 1
+                return row[0]
+
+        if self.s3_client is not None and self.s3_prefix:
+            try:
+                response = self.s3_client.get_object(Bucket=self.s3_bucket, Key=self._s3_key(key))
+                desc = response['Body'].read().decode("utf-8")
+                self._put_local(key, desc)
+                self.s3_hits += 1
+                return desc
+            except Exception:
+                pass  # 共享层未命中或不可用，按未命中处理
+
+        self.misses += 1
+        return None
+
+    def put(self, image_hash: str, fingerprint: str, desc: str):
+        """写入缓存；空描述（无效图片或调用失败）不缓存"""
+        if not desc or not desc.strip():
+            return
+        key = self.make_key(image_hash, fingerprint)
+        self._put_local(key, desc)
+        self.puts += 1
+        if self.s3_client is not None and self.s3_prefix:
+            try:
+                self.s3_client.put_object(
+                    Bucket=self.s3_bucket,
+                    Key=self._s3_key(key),
+                    Body=desc.encode("utf-8"),
+                    ContentType="text/plain; charset=utf-8"
+                )
+            except Exception as e:
+                logging.warning(f"写入 S3 共享缓存失败: {e}")
+
+    def evict(self) -> int:
+        """按存活时间和总大小淘汰本地条目（大小超限时先淘汰最久未访问的），返回淘汰条数"""
+        removed = 0
+        with self._lock:
+            if self.max_age_days:
+                deadline = time.time() - self.max_age_days * 86400
+                removed += self._conn.execute("DELETE FROM desc_cache WHERE created < ?", (deadline,)).rowcount
+            if self.max_bytes:
+                total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM desc_cache").fetchone()[0]
+                if total > self.max_bytes:
+                    rows = self._conn.execute("SELECT key, size FROM desc_cache ORDER BY last_access").fetchall()
+                    stale_keys = []
+                    for key, size in rows:
+                        if total <= self.max_bytes:
+                            break
+                        stale_keys.append((key,))
+                        total -= size
+                    self._conn.executemany("DELETE FROM desc_cache WHERE key = ?", stale_keys)
+                    removed += len(stale_keys)
+            self._conn.commit()
+        return removed
+
+    def summary(self) -> str:
+        hits = self.local_hits + self.s3_hits + self.inflight_hits
+        lookups = hits + self.misses
+        hit_rate = hits / lookups * 100 if lookups else 0.0
+        return (
+            f"[描述缓存] 查询 {lookups} 次，命中率 {hit_rate:.1f}%"
+            f"（本地 {self.local_hits}，S3 {self.s3_hits}，并发复用 {self.inflight_hits}），"
+            f"未命中 {self.misses}，写入 {self.puts}"
+        )
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,47 @@
+import time
+from io import BytesIO
+from PIL import Image
+
+
+# =============================
+# 图片预处理（在进程池中执行）
+# =============================
+# vLLM 接口可直接接收的格式，其余格式（TIFF 等）一律重编码
+SUPPORTED_FORMATS = {"JPEG", "PNG", "GIF", "BMP", "WEBP"}
+
+
+def preprocess_image(image_data: bytes, max_pixels: int, image_format: str = "JPEG", quality: int = 85):
+    """
+    解码图片，按像素预算（宽×高）等比缩小，并重编码为 JPEG/WebP。
+    返回 (处理后的字节, 耗时秒数)；无法解码时原样返回，交给后续的有效性校验处理。
+    """
+    start = time.perf_counter()
+    try:
+        image = Image.open(BytesIO(image_data))
+        source_format = image.format
+        width, height = image.size
+        scale = min(1.0, (max_pixels / float(width * height)) ** 0.5)
+        target_size = (max(1, int(width * scale)), max(1, int(height * scale)))
+
+        # JPEG 解码时直接按 DCT 缩放，大图解码开销显著降低
+        image.draft("RGB", target_size)
+        image = image.convert("RGBA" if image.mode in ("RGBA", "LA", "P") else "RGB")
+        if image.size != target_size:
+            image = image.resize(target_size, Image.LANCZOS)
+
+        if image.mode == "RGBA" and image_format.upper() == "JPEG":
+            # JPEG 不支持透明通道，铺白底
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.split()[-1])
+            image = background
+
+        output = BytesIO()
+        image.save(output, format=image_format, quality=quality)
+        payload = output.getvalue()
+
+        # 未缩放且重编码后反而更大时保留原图
+        if scale >= 1.0 and source_format in SUPPORTED_FORMATS and len(payload) >= len(image_data):
+            payload = image_data
+    except Exception:
+        payload = image_data
+    return payload, time.perf_counter() - start
@@ -0,0 +1,133 @@
+from io import BytesIO
+from PIL import Image
+
+
+# =============================
+# 感知哈希
+# =============================
+def dhash(image_data: bytes, hash_size: int = 8) -> int:
+    """差值哈希：缩放到 (hash_size+1)×hash_size 灰度图，比较水平相邻像素"""
+    image = Image.open(BytesIO(image_data))
+    image.draft("L", (hash_size * 4, hash_size * 4))
+    image = image.convert("L").resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = list(image.getdata())
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return value
+
+
+def phash(image_data: bytes, hash_size: int = 8, highfreq_factor: int = 4) -> int:
+    """DCT 感知哈希：取 32×32 灰度图 DCT 的左上低频块，与中位数比较"""
+    import numpy as np
+
+    size = hash_size * highfreq_factor
+    image = Image.open(BytesIO(image_data))
+    image.draft("L", (size * 2, size * 2))
+    image = image.convert("L").resize((size, size), Image.LANCZOS)
+    pixels = np.asarray(image, dtype=np.float64)
+
+    # DCT-II 变换矩阵
+    n = np.arange(size)
+    dct_matrix = np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * size))
+    coefficients = dct_matrix @ pixels @ dct_matrix.T
+    low_freq = coefficients[:hash_size, :hash_size].flatten()
+    median = np.median(low_freq[1:])  # 排除直流分量
+    value = 0
+    for bit in low_freq > median:
+        value = (value << 1) | int(bit)
+    return value
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+# =============================
+# BK 树：按汉明距离检索近重复
+# =============================
+class BKTree:
+    def __init__(self):
+        self.root = None  # 节点为 [key, value, {distance: child}]
+        self.size = 0
+
+    def add(self, key: int, value):
+        if self.root is None:
+            self.root = [key, value, {}]
+            self.size += 1
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(key, node[0])
+            if distance == 0:
+                return  # 完全相同的哈希保留最早的描述
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [key, value, {}]
+                self.size += 1
+                return
+            node = child
+
+    def find_nearest(self, key: int, max_distance: int):
+        """返回 (距离, value)，范围内没有候选时返回 None"""
+        if self.root is None:
+            return None
+        best = None
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            distance = hamming_distance(key, node[0])
+            if distance <= max_distance and (best is None or distance < best[0]):
+                best = (distance, node[1])
+                if distance == 0:
+                    break
+            # 三角不等式剪枝：只需访问边距离在 [d - r, d + r] 内的子树
+            for edge, child in node[2].items():
+                if distance - max_distance <= edge <= distance + max_distance:
+                    stack.append(child)
+        return best
+
+
+class PHashIndex:
+    """
+    一次运行内见过的图片的感知哈希索引。
+    按命名空间（描述缓存指纹）分别建树，只在同一提示词/caption 下复用描述。
+    """
+
+    def __init__(self, algorithm: str = "dhash", max_distance: int = 4):
+        self.hash_func = phash if algorithm == "phash" else dhash
+        self.max_distance = max_distance
+        self._trees = {}
+        self.lookups = 0
+        self.hits = 0
+
+    def compute(self, image_data: bytes):
+        """计算感知哈希，无法解码时返回 None（可在线程池中调用）"""
+        try:
+            return self.hash_func(image_data)
+        except Exception:
+            return None
+
+    def lookup(self, namespace: str, image_hash: int):
+        self.lookups += 1
+        tree = self._trees.get(namespace)
+        match = tree.find_nearest(image_hash, self.max_distance) if tree is not None else None
+        if match is None:
+            return None
+        self.hits += 1
+        return match[1]
+
+    def add(self, namespace: str, image_hash: int, desc: str):
+        if not desc or not desc.strip():
+            return
+        if namespace not in self._trees:
+            self._trees[namespace] = BKTree()
+        self._trees[namespace].add(image_hash, desc)
+
+    def summary(self) -> str:
+        size = sum(tree.size for tree in self._trees.values())
+        hit_rate = self.hits / self.lookups * 100 if self.lookups else 0.0
+        return f"[近重复复用] 索引 {size} 张，查询 {self.lookups} 次，复用 {self.hits} 次（{hit_rate:.1f}%）"
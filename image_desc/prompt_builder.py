@@ -0,0 +1,265 @@
+import logging
+import math
+import re
+import threading
+
+
+# =============================
+# 提示词构造
+# =============================
+# 固定指令放在 system 消息中，所有请求共享同一前缀，命中 vLLM 的前缀缓存（--enable-prefix-caching）
+PROMPT_INSTRUCTION = (
+    "请给用户提供的图片提供说明，识别图中关键标识性元素，并推测图片标题；"
+    "用户会在图片之后给出图片的caption（如有）和可参考文字内容，要仔细甄别出与图片相关的内容。\n"
+    "要求语言简洁凝练，不要描述画面布局；输出格式：标题--图片说明。"
+)
+
+# 参考文字片段的来源权重：图片所在页最相关，其次是文档简介和相邻页
+SOURCE_WEIGHTS = {"page_current": 1.0, "description": 0.8, "page_adjacent": 0.6}
+
+_SENTENCE_END = re.compile(r"(?<=[。！？；!?;\n])|(?<=\.)\s+")
+_TERM = re.compile(r"[a-z0-9]+|[一-鿿]")
+
+
+def split_segments(text: str, min_chars: int = 20):
+    """按句末标点切分，过短的句子并入下一句"""
+    segments, buffer = [], ""
+    for piece in _SENTENCE_END.split(text):
+        if not piece:
+            continue
+        buffer += piece
+        if len(buffer.strip()) >= min_chars:
+            segments.append(buffer.strip())
+            buffer = ""
+    if buffer.strip():
+        segments.append(buffer.strip())
+    return segments
+
+
+def text_terms(text: str) -> set:
+    """相关性打分用的词项：英文单词、数字，以及中文单字和相邻字二元组"""
+    tokens = _TERM.findall(text.lower())
+    terms = set(tokens)
+    for a, b in zip(tokens, tokens[1:]):
+        if len(a) == 1 and len(b) == 1 and not a.isascii() and not b.isascii():
+            terms.add(a + b)
+    return terms
+
+
+class PromptBuilder:
+    """
+    构造 VL 请求的消息：固定指令在前（可被前缀缓存复用），图片与逐图的 caption、参考文字在后。
+    参考文字按与 caption 的相关性排序后裁剪到 token 预算内；
+    tokenizer_path 指向本地模型目录时用其 tokenizer 计数，不可用时按字符估算。
+    """
+
+    def __init__(self, tokenizer_path=None, ref_token_budget: int = 512):
+        self.tokenizer_path = tokenizer_path
+        self.ref_token_budget = ref_token_budget
+        self._tokenizer = None
+        self._tokenizer_loaded = False
+        self._lock = threading.Lock()
+
+        # 参考文字裁剪统计（本地计数）
+        self.images = 0
+        self.trimmed = 0
+        self.ref_tokens_before = 0
+        self.ref_tokens_after = 0
+        # 服务端返回的 usage 统计
+        self.requests = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+
+    # === token 计数 ===
+    def _get_tokenizer(self):
+        if not self._tokenizer_loaded:
+            with self._lock:
+                if not self._tokenizer_loaded:
+                    if self.tokenizer_path:
+                        try:
+                            from transformers import AutoTokenizer
+                            self._tokenizer = AutoTokenizer.from_pretrained(self.tokenizer_path)
+                        except Exception as e:
+                            logging.warning(f"加载 tokenizer 失败，按字符估算 token 数: {e}")
+                    self._tokenizer_loaded = True
+        return self._tokenizer
+
+    def count_tokens(self, text: str) -> int:
+        tokenizer = self._get_tokenizer()
+        if tokenizer is not None:
+            return len(tokenizer.encode(text, add_special_tokens=False))
+        # 估算：中文约 1 字 1 token，其余约 4 字符 1 token
+        cjk = sum(1 for ch in text if "一" <= ch <= "鿿")
+        return cjk + math.ceil((len(text) - cjk) / 4)
+
+    def truncate(self, text: str, budget: int) -> str:
+        """把单个片段截断到 budget 个 token 以内"""
+        tokenizer = self._get_tokenizer()
+        if tokenizer is not None:
+            ids = tokenizer.encode(text, add_special_tokens=False)
+            return tokenizer.decode(ids[:budget]) if len(ids) > budget else text
+        low, high = 0, len(text)
+        while low < high:
+            mid = (low + high + 1) // 2
+            if self.count_tokens(text[:mid]) <= budget:
+                low = mid
+            else:
+                high = mid - 1
+        return text[:low]
+
+    # === 参考文字裁剪 ===
+    def segment(self, text: str):
+        """切句并计数，返回 [(片段, token 数, 词项)]；同一行的多张图片共用（见 LineRefs）"""
+        return [(segment, self.count_tokens(segment), text_terms(segment)) for segment in split_segments(text or "")]
+
+    def build_ref_text(self, ref_parts, caption: str) -> str:
+        """ref_parts 为 [(来源, 文本)]，来源取 SOURCE_WEIGHTS 的键"""
+        return self.select_ref_text([(source, self.segment(text)) for source, text in ref_parts], caption)
+
+    def select_ref_text(self, segmented_parts, caption: str) -> str:
+        """
+        segmented_parts 为 [(来源, segment() 的结果)]。
+        片段按 (与 caption 的词项重合度, 来源权重) 排序，贪心选入预算，最后按原文顺序拼接。
+        """
+        segments = []
+        for source, part in segmented_parts:
+            for segment, tokens, terms in part:
+                segments.append((len(segments), source, segment, tokens, terms))
+        total = sum(seg[3] for seg in segments)
+        with self._lock:
+            self.images += 1
+            self.ref_tokens_before += total
+
+        if total <= self.ref_token_budget:
+            with self._lock:
+                self.ref_tokens_after += total
+            return " ".join(seg[2] for seg in segments)
+
+        caption_terms = text_terms(caption) if caption else set()
+
+        def score(seg):
+            weight = SOURCE_WEIGHTS.get(seg[1], 0.5)
+            if not caption_terms:
+                return weight
+            terms = seg[4]
+            overlap = len(terms & caption_terms) / math.sqrt(len(terms) + 1)
+            return overlap + 0.1 * weight
+
+        remaining = self.ref_token_budget
+        chosen = []
+        for seg in sorted(segments, key=lambda s: (-score(s), s[0])):
+            if seg[3] <= remaining:
+                chosen.append((seg[0], seg[2]))
+                remaining -= seg[3]
+            elif not chosen:
+                # 最相关的片段本身超出预算（如整页没有标点），截断后使用
+                chosen.append((seg[0], self.truncate(seg[2], remaining)))
+                remaining = 0
+            if remaining <= 0:
+                break
+        chosen.sort()
+        ref_text = " ".join(text for _, text in chosen)
+        with self._lock:
+            self.trimmed += 1
+            self.ref_tokens_after += self.ref_token_budget - remaining
+        return ref_text
+
+    # === 消息构造 ===
+    @staticmethod
+    def build_user_text(ref_text: str, caption: str) -> str:
+        caption_is_available = f"这张图片的caption是{caption}\n" if caption else ""
+        return f"{caption_is_available}可参考文字内容：{ref_text}"
+
+    def build_messages(self, image_url: str, ref_text: str, caption: str):
+        return [
+            {"role": "system", "content": PROMPT_INSTRUCTION},
+            {
+                "role": "user",
+                "content": [
+                    {"type": "image_url", "image_url": {"url": image_url}},
+                    {"type": "text", "text": self.build_user_text(ref_text, caption)}
+                ]
+            }
+        ]
+
+    def template(self) -> str:
+        """提示词模板（用于描述缓存指纹），模板或预算变化时指纹随之变化"""
+        return "\x00".join([PROMPT_INSTRUCTION, self.build_user_text("{ref_text}", "{caption}"),
+                            str(self.ref_token_budget)])
+
+    # === 统计 ===
+    def record_usage(self, usage):
+        """累计服务端返回的 token 用量；vLLM 开启 --enable-prompt-tokens-details 时含前缀缓存命中数"""
+        if usage is None:
+            return
+        self.requests += 1
+        self.prompt_tokens += getattr(usage, "prompt_tokens", 0) or 0
+        self.completion_tokens += getattr(usage, "completion_tokens", 0) or 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        if details is not None:
+            self.cached_tokens += getattr(details, "cached_tokens", 0) or 0
+
+    def summary(self) -> str:
+        saved = self.ref_tokens_before - self.ref_tokens_after
+        saved_rate = saved / self.ref_tokens_before * 100 if self.ref_tokens_before else 0.0
+        text = (
+            f"[提示词] 参考文字 {self.images} 份（裁剪 {self.trimmed}），"
+            f"token {self.ref_tokens_before} → {self.ref_tokens_after}（节省 {saved}，{saved_rate:.1f}%）"
+        )
+        if self.requests:
+            cached_rate = self.cached_tokens / self.prompt_tokens * 100 if self.prompt_tokens else 0.0
+            text += (
+                f"；模型请求 {self.requests} 次，prompt token 共 {self.prompt_tokens}"
+                f"（平均 {self.prompt_tokens / self.requests:.0f}），前缀缓存命中 {self.cached_tokens}"
+                f"（{cached_rate:.1f}%），生成 token 共 {self.completion_tokens}"
+            )
+        return text
+
+
+class LineRefs:
+    """
+    一行 JSON 的参考文字来源：各页的 merge_text 与文档简介。
+    每段文本的切句与 token 计数在首次用到时做一次，同一行的多张图片共用。
+    """
+
+    def __init__(self, builder: PromptBuilder, page_texts: dict, description: str = None):
+        self.builder = builder
+        self.page_texts = page_texts
+        self.description = description
+        self._segments = {}
+
+    def _segmented(self, key: str, text: str):
+        segments = self._segments.get(key)
+        if segments is None:
+            segments = self._segments[key] = self.builder.segment(text)
+        return segments
+
+    def ref_text(self, page_index: int, caption: str) -> str:
+        """图片所在页、相邻页与文档简介的参考文字，裁剪到 token 预算内"""
+        parts = []
+        if self.description is not None:
+            parts.append(("description", self._segmented("description", self.description)))
+        for offset in (-1, 0, 1):
+            page_key = f"page_{page_index + offset}"
+            source = "page_current" if offset == 0 else "page_adjacent"
+            parts.append((source, self._segmented(page_key, self.page_texts.get(page_key, ""))))
+        return self.builder.select_ref_text(parts, caption)
+
+
+class RefText:
+    """
+    一张图片的参考文字，只在真正要发给模型时构造（build 会做 tokenize，应在线程中调用）；
+    命中断点日志、描述缓存或只做合并的图片不再构造。
+    """
+
+    def __init__(self, line_refs: LineRefs, page_index: int, caption: str):
+        self.line_refs = line_refs
+        self.page_index = page_index
+        self.caption = caption
+        self._text = None
+
+    def build(self) -> str:
+        if self._text is None:
+            self._text = self.line_refs.ref_text(self.page_index, self.caption)
+        return self._text
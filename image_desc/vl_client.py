@@ -0,0 +1,334 @@
+import asyncio
+import random
+import time
+from collections import deque
+import openai
+from openai import AsyncClient
+
+
+# =============================
+# 错误分类
+# =============================
+def classify_error(e: Exception) -> str:
+    """
+    throttled: 429 / 503，服务端过载，应降低并发
+    transient: 超时、连接错误、其他 5xx，可重试
+    permanent: 其他 4xx（请求本身有问题，如图片过大），以及其他所有异常（如构造请求、解析响应时的
+               TypeError / KeyError），重试无意义，也不应占用端点容量或掩盖代码错误
+    """
+    if isinstance(e, openai.RateLimitError):
+        return "throttled"
+    if isinstance(e, (openai.APITimeoutError, openai.APIConnectionError, asyncio.TimeoutError, ConnectionError)):
+        return "transient"
+    if isinstance(e, openai.APIStatusError):
+        if e.status_code == 503:
+            return "throttled"
+        if e.status_code >= 500:
+            return "transient"
+        return "permanent"
+    return "permanent"
+
+
+# =============================
+# 单个端点 + AIMD 并发控制
+# =============================
+class Endpoint:
+    """
+    一个 OpenAI 兼容端点。在途上限 limit 按 AIMD 调整：
+    成功且延迟未明显高于基线时加性增加（每轮约 +1），
+    延迟膨胀（排队）时小幅乘性减少，429/5xx/超时时减半。
+    """
+
+    def __init__(self, base_url, api_key="EMPTY", initial_limit=20, min_limit=2, max_limit=128,
+                 latency_tolerance=2.0, failure_threshold=5, cooldown_seconds=30.0):
+        self.base_url = base_url
+        # 关闭 SDK 内置重试：否则 429/5xx/超时先被 SDK 静默重试并退避，AIMD 看不到限流信号，延迟样本也被拉长
+        self.client = AsyncClient(api_key=api_key, base_url=base_url, max_retries=0)
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_tolerance = latency_tolerance
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+
+        self.inflight = 0
+        self.latency_ewma = None
+        self.base_latency = None  # 近期最低的平滑延迟，作为“无排队”基线
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+
+        self.requests = 0
+        self.errors = 0
+        self.throttled = 0
+        self.total_latency = 0.0
+
+    def available(self, now: float) -> bool:
+        return now >= self.cooldown_until and self.inflight < int(self.limit)
+
+    def on_success(self, latency: float):
+        self.requests += 1
+        self.total_latency += latency
+        self.consecutive_failures = 0
+        self.latency_ewma = latency if self.latency_ewma is None else 0.8 * self.latency_ewma + 0.2 * latency
+        # 基线缓慢上浮，避免一次偶然的快请求永久压低基线
+        if self.base_latency is None or self.latency_ewma < self.base_latency:
+            self.base_latency = self.latency_ewma
+        else:
+            self.base_latency *= 1.001
+
+        if self.latency_ewma > self.base_latency * self.latency_tolerance:
+            self.limit = max(self.min_limit, self.limit * 0.9)
+        else:
+            self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+
+    def on_failure(self, kind: str):
+        self.requests += 1
+        self.errors += 1
+        if kind == "permanent":
+            return  # 请求本身的问题，与端点负载无关
+        if kind == "throttled":
+            self.throttled += 1
+        self.limit = max(self.min_limit, self.limit * 0.5)
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= self.failure_threshold:
+            # 连续失败视为端点不可用，冷却一段时间后再试探
+            self.cooldown_until = time.monotonic() + self.cooldown_seconds
+            self.consecutive_failures = 0
+
+    def summary(self) -> str:
+        avg = self.total_latency / max(self.requests - self.errors, 1)
+        return (
+            f"{self.base_url} 上限 {self.limit:.1f}，在途 {self.inflight}，请求 {self.requests}，"
+            f"失败 {self.errors}（限流 {self.throttled}），平均延迟 {avg:.2f}s"
+        )
+
+
+# =============================
+# 多端点负载均衡
+# =============================
+class EndpointPool:
+    """把请求分发到多个端点，优先选择 在途/上限 比例最低的端点"""
+
+    def __init__(self, base_urls, api_key="EMPTY", **endpoint_kwargs):
+        self.endpoints = [Endpoint(url, api_key=api_key, **endpoint_kwargs) for url in base_urls]
+        self._cond = None  # 在事件循环内惰性创建
+
+    def _condition(self) -> asyncio.Condition:
+        if self._cond is None:
+            self._cond = asyncio.Condition()
+        return self._cond
+
+    async def acquire(self, exclude: Endpoint = None) -> Endpoint:
+        """exclude 用于对冲请求：优先选择其他端点，只有一个端点可用时仍可落到同一端点"""
+        cond = self._condition()
+        async with cond:
+            while True:
+                now = time.monotonic()
+                candidates = [ep for ep in self.endpoints if ep.available(now)]
+                if exclude is not None and len(candidates) > 1:
+                    candidates = [ep for ep in candidates if ep is not exclude]
+                if candidates:
+                    endpoint = min(candidates, key=lambda ep: (ep.inflight + 1) / ep.limit)
+                    endpoint.inflight += 1
+                    return endpoint
+                try:
+                    # 定时醒来，处理冷却期结束但没有请求归还的情况
+                    await asyncio.wait_for(cond.wait(), timeout=1.0)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def release(self, endpoint: Endpoint, latency: float = None, error: Exception = None):
+        """归还名额；latency 和 error 都为空时（请求被取消）不更新 AIMD"""
+        cond = self._condition()
+        async with cond:
+            endpoint.inflight -= 1
+            if error is not None:
+                endpoint.on_failure(classify_error(error))
+            elif latency is not None:
+                endpoint.on_success(latency)
+            cond.notify_all()
+
+    async def create(self, exclude: Endpoint = None, on_endpoint=None, **kwargs):
+        """等价于 client.chat.completions.create，由连接池选择端点；on_endpoint 在选定端点后回调"""
+        endpoint = await self.acquire(exclude=exclude)
+        if on_endpoint is not None:
+            on_endpoint(endpoint)
+        start = time.perf_counter()
+        # release 需要拿锁，用 shield 保证请求被取消（如对冲落败）时名额也一定归还
+        try:
+            response = await endpoint.client.chat.completions.create(**kwargs)
+        except asyncio.CancelledError:
+            await asyncio.shield(self.release(endpoint))
+            raise
+        except Exception as e:
+            await asyncio.shield(self.release(endpoint, error=e))
+            raise
+        await asyncio.shield(self.release(endpoint, latency=time.perf_counter() - start))
+        return response
+
+    def summary(self) -> str:
+        return "\n".join(f"[端点] {ep.summary()}" for ep in self.endpoints)
+
+
+# =============================
+# 重试 + 对冲请求
+# =============================
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class ResilientClient:
+    """
+    在 EndpointPool 之上增加：
+    1. 瞬时错误（超时、连接错误、429、5xx）按带抖动的指数退避重试，永久错误（其他 4xx）直接失败；
+       端点的 SDK 客户端不重试（max_retries=0），这里是唯一的重试层，max_retries 即实际的最大重试次数；
+    2. 对冲请求：主请求已发出且耗时超过近期延迟的 hedge_quantile 分位数时，
+       向另一个端点发送一个重复请求，先返回者胜出，另一个取消。
+    measure_losers=True 时不取消落后的请求，等它完成以精确统计对冲节省的尾延迟（会增加负载，仅用于评估）。
+    """
+
+    def __init__(self, pool: EndpointPool, max_retries=3, base_delay=1.0, max_delay=30.0, request_timeout=300.0,
+                 hedge_enabled=True, hedge_quantile=0.95, hedge_min_delay=5.0, hedge_max_ratio=0.1,
+                 hedge_min_samples=50, measure_losers=False):
+        self.pool = pool
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.request_timeout = request_timeout
+        self.hedge_enabled = hedge_enabled
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_max_ratio = hedge_max_ratio
+        self.hedge_min_samples = hedge_min_samples
+        self.measure_losers = measure_losers
+
+        self._recent_latencies = deque(maxlen=500)  # 单次请求延迟，用于计算对冲阈值
+        self.latencies = []            # 每个逻辑请求的实际延迟（含对冲）
+        self.unhedged_latencies = []   # 假设不对冲时的延迟（仅 measure_losers 时可精确得到）
+        self.requests = 0
+        self.retries = 0
+        self.transient_failures = 0
+        self.permanent_failures = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.hedge_saved_seconds = 0.0
+
+    def _hedge_delay(self):
+        if not self.hedge_enabled or len(self._recent_latencies) < self.hedge_min_samples:
+            return None
+        if self.hedges >= self.hedge_max_ratio * max(self.requests, 1):
+            return None  # 对冲预算用完，避免放大负载
+        return max(self.hedge_min_delay, percentile(self._recent_latencies, self.hedge_quantile))
+
+    def _record_loser(self, loser: asyncio.Task, start: float, winner_latency: float):
+        def callback(task):
+            if task.cancelled() or task.exception() is not None:
+                return
+            loser_latency = time.perf_counter() - start
+            self.hedge_saved_seconds += max(0.0, loser_latency - winner_latency)
+            self.unhedged_latencies.append(loser_latency)
+        loser.add_done_callback(callback)
+
+    async def _hedged_request(self, kwargs):
+        start = time.perf_counter()
+        primary_endpoint = []
+        primary = asyncio.ensure_future(self.pool.create(on_endpoint=primary_endpoint.append, **kwargs))
+        hedge = None
+        measured_loser = None
+        try:
+            delay = self._hedge_delay()
+            if delay is not None:
+                await asyncio.wait({primary}, timeout=delay)
+            # 主请求还在端点池里排队时不对冲，对冲只会加剧排队
+            if primary.done() or delay is None or not primary_endpoint:
+                response = await primary
+                latency = time.perf_counter() - start
+                self._recent_latencies.append(latency)
+                self.latencies.append(latency)
+                self.unhedged_latencies.append(latency)
+                return response
+
+            self.hedges += 1
+            hedge = asyncio.ensure_future(self.pool.create(exclude=primary_endpoint[0], **kwargs))
+            pending = {primary, hedge}
+            winner = None
+            while pending and winner is None:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = task
+                        break
+            if winner is None:
+                hedge.exception()  # 两个都失败时以主请求的错误为准
+                raise primary.exception()
+
+            latency = time.perf_counter() - start
+            self.latencies.append(latency)
+            loser = hedge if winner is primary else primary
+            if winner is hedge:
+                self.hedge_wins += 1
+            else:
+                self._recent_latencies.append(latency)
+                self.unhedged_latencies.append(latency)
+            if loser.done():
+                loser_ok = not loser.cancelled() and loser.exception() is None
+                if winner is hedge and loser_ok:
+                    self.unhedged_latencies.append(time.perf_counter() - start)
+            elif self.measure_losers and winner is hedge:
+                measured_loser = loser
+                self._record_loser(loser, start, latency)
+            else:
+                loser.cancel()
+            return winner.result()
+        finally:
+            # 外层被取消或出错时，不留下孤儿请求
+            for task in (primary, hedge):
+                if task is not None and task is not measured_loser and not task.done():
+                    task.cancel()
+
+    async def create(self, **kwargs):
+        """
+        带重试与对冲的 chat.completions.create。
+        request_timeout 是整个逻辑请求（含端点排队、对冲、重试与退避）的时限，每次尝试只使用剩余的时间。
+        """
+        self.requests += 1
+        deadline = time.monotonic() + self.request_timeout
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                return await asyncio.wait_for(self._hedged_request(dict(kwargs, timeout=remaining)), remaining)
+            except Exception as e:
+                kind = classify_error(e)
+                if kind == "permanent":
+                    self.permanent_failures += 1
+                    raise
+                self.transient_failures += 1
+                # 全抖动指数退避，剩余时间不够退避时不再重试
+                backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                if attempt >= self.max_retries or time.monotonic() + backoff >= deadline:
+                    raise
+                await asyncio.sleep(backoff)
+                attempt += 1
+                self.retries += 1
+
+    def summary(self) -> str:
+        lines = [
+            f"[重试] 请求 {self.requests}，重试 {self.retries}，瞬时错误 {self.transient_failures}，"
+            f"永久错误 {self.permanent_failures}"
+        ]
+        if self.latencies:
+            lines.append(
+                f"[对冲] 发起 {self.hedges} 次，对冲胜出 {self.hedge_wins} 次；延迟 p50/p95/p99 = "
+                f"{percentile(self.latencies, 0.5):.2f}/{percentile(self.latencies, 0.95):.2f}/"
+                f"{percentile(self.latencies, 0.99):.2f}s"
+            )
+        if self.measure_losers and self.hedge_wins:
+            lines.append(
+                f"[对冲] 不对冲时 p95/p99 = {percentile(self.unhedged_latencies, 0.95):.2f}/"
+                f"{percentile(self.unhedged_latencies, 0.99):.2f}s，累计节省 {self.hedge_saved_seconds:.1f}s"
+            )
+        return "\n".join(lines)
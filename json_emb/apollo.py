@@ -4,15 +4,23 @@ from typing import List, Dict, Any, Tuple
 from sentence_transformers import SentenceTransformer
 import torch
 import os
-import re
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import sys
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import boto3
-from botocore.exceptions import ClientError
 import time
 import logging
-import hashlib
 from datetime import datetime
-from io import BytesIO
+from collections import Counter, deque
+# 两条流水线共用的 S3 工具
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "common"))
+from s3_multipart_writer import S3MultipartWriter
+from s3_line_reader import S3LineReader
+from emb_cache import EmbCache, chunk_key
+from embedding_store import sidecar_key, shard_name, shard_key, variant_name, encode_npy, quantize_variants
+from emb_service import EmbeddingClient
+from device_scheduler import plan_devices, DeviceScheduler, WORKER_CONTEXT
+from shm_handoff import ensure_tracker, SharedInput, read_shared_lines, write_shared_output, open_output, release_output
 
 
 # 或者直接禁用所有日志
@@ -36,9 +44,68 @@ OUTPUT_PREFIX = 'element/ecnu/Apollo/text_embedding/'
 MODEL_NAME = "../models/bge-m3" 
 
 # 并行配置
-NUM_GPU_DEVICES = 8
-MAX_WORKERS = NUM_GPU_DEVICES
-EMBEDDING_BATCH_SIZE = 512
+# worker 按设备确定性分配，每个设备独立排队，batch 交给有空位的设备（见 device_scheduler.py）
+NUM_GPU_DEVICES = 8          # 使用的 GPU 数（超出可见 GPU 数的部分忽略）
+WORKERS_PER_GPU = 1          # 每张 GPU 的 worker 进程数（每个 worker 加载一份模型）
+CPU_WORKERS = 0              # 额外的 CPU worker 数；没有可用 GPU 时自动使用 1 个
+CPU_THREADS_PER_WORKER = 8   # 每个 CPU worker 的 torch 线程数，CPU_WORKERS × 该值不宜超过物理核数
+# 推理后端，按 worker 所在设备选择：torch（SentenceTransformer，GPU 上 FP16）/
+# onnx（ONNX Runtime 动态 int8 量化模型，CPU 上代替 FP32 的 PyTorch；导出与对比见 onnx_backend.py / backend_eval.py）
+GPU_BACKEND = "torch"
+CPU_BACKEND = "onnx"
+ONNX_MODEL_DIR = "../models/bge-m3-onnx-int8"
+ONNX_INTER_OP_THREADS = 1    # 算子间并行数；算子内线程数取 CPU_THREADS_PER_WORKER
+# 常驻 embedding 服务（emb_server.py）的地址：设置后本进程不加载模型，worker 只做解析、分块与组装结果，
+# embedding 请求交给服务合并计算，重复运行无需再加载模型；None 时在本机 worker 中加载模型
+EMBEDDING_SERVER = None      # 例如 "unix:///tmp/json_emb.sock" 或 "http://127.0.0.1:8765"
+CLIENT_WORKERS = 4           # 客户端模式下的 worker 进程数
+WORKER_QUEUE_DEPTH = 2       # 每个 worker 的在途 batch 数（一个在算、其余排队），当前文件提交完即接着提交下一个文件
+EMBEDDING_BATCH_SIZE = 512  # 每个 GPU batch 的最大条数
+MAX_BATCH_BYTES = 10 * 1024 * 1024  # 每个 worker batch 的输入字节数（按行累加）
+
+# 流水线：后台线程预取（下载 + 分割）后续文件、异步上传已完成文件，进程池在文件之间不断流
+PREFETCH_FILES = 2                     # 预取的文件数（同时驻留内存的输入文件上限）
+READ_CHUNK_SIZE = 16 * 1024 * 1024     # 读取输入文件时每个范围请求（Range GET）的字节数
+READ_PARALLEL = 4                      # 读取一个输入文件时并行的范围请求数
+UPLOAD_WORKERS = 2                     # 收尾上传（向量分片、提交分段上传）的线程数
+# 输入文件与 worker 结果经共享内存交接（见 shm_handoff.py），进程间只传偏移与布局描述；False 时按行列表 pickle 传递
+SHM_HANDOFF = True
+# 输出按输入行的顺序写出：先完成的 batch 在重排缓冲中等待前序 batch，每个文件最多领先 REORDER_WINDOW_BATCHES 个 batch
+# （超出时暂停提交该文件的后续 batch），缓冲占用的内存不超过该数量 × 单个 batch 的输出
+REORDER_WINDOW_BATCHES = 64
+
+# 分块与组 batch 按模型 tokenizer 的 token 数计算（tokenizer 不可用时退回按字符分块、按条数组 batch）
+CHUNK_MODE = "token"          # token / char
+CHUNK_TOKENS = 512            # 每块 token 数
+CHUNK_OVERLAP_TOKENS = 32     # 相邻块重叠的 token 数
+EMBEDDING_TOKEN_BUDGET = 128 * 1024  # 每个 GPU batch 的 token 预算（条数 × 组内最长，含 padding）
+
+# 一组文本块计算失败（显存不足等）时对半拆分重试；OOM 时同时收紧本 worker（即所在设备）的 token 预算，
+# 之后的 batch 按收紧后的预算分组。单条仍失败的文本块不写全零向量，而是记入结果行的 failed_chunks
+MIN_TOKEN_BUDGET = 8 * 1024
+# 故障注入（在 CPU 上验证拆分逻辑）：padding 后 token 数超过 oom_above_tokens 的组抛出模拟的 OOM，
+# 含有 fail_text 的组抛出普通异常；None 为关闭。例如 {"oom_above_tokens": 20000, "fail_text": "免责声明"}
+FAULT_INJECTION = None
+
+# 输出边生成边分段上传，每个文件常驻内存约 OUTPUT_PART_SIZE × (OUTPUT_MAX_PENDING_PARTS + 1)
+OUTPUT_PART_SIZE = 64 * 1024 * 1024
+OUTPUT_MAX_PENDING_PARTS = 4
+
+# 输出格式：jsonl 为整行 JSON（向量为浮点列表）；npy 为每个 batch 一个二进制向量分片 + 不含向量的 JSONL 索引
+# （布局与读取接口见 embedding_store.py），体积约为 jsonl 的 1/10，且省去 json.dumps 与进程间传输浮点列表的开销
+OUTPUT_FORMAT = "jsonl"
+EMBEDDING_DTYPE = "float16"  # npy 输出的向量精度：float16 / float32
+# npy 输出写入的表示，可任意组合：float（EMBEDDING_DTYPE）/ int8（每个分片逐维标定的标量量化，1/2 体积）/
+# binary（1 bit 符号量化，1/16 体积，适合粗排后用 int8/float 重排）；选型前先用 quant_eval.py 评估召回损失
+EMBEDDING_VARIANTS = ("float",)
+EMBEDDING_DIM = 1024
+
+# 文本块 embedding 缓存：页眉、免责声明、目录等重复文本只计算一次
+# 同一 worker batch 内的重复块总是去重；持久缓存跨运行复用，超过容量时按 LRU / LFU 淘汰
+EMB_CACHE_ENABLED = True
+EMB_CACHE_PATH = "./emb_cache.sqlite"
+EMB_CACHE_MAX_BYTES = 20 * 1024 * 1024 * 1024
+EMB_CACHE_EVICTION = "lru"  # lru：淘汰最久未访问 / lfu：淘汰命中次数最少
 
 # 日志设置
 logging.basicConfig(level=logging.INFO)
@@ -50,29 +117,67 @@ logger = logging.getLogger(__name__)
 # 全局模型缓存（每个进程独立）
 # =============================
 _st_model = None
-_worker_gpu_id = "unknown"  # 记录当前 worker 的 GPU ID
+_worker_gpu_id = "unknown"  # 记录当前 worker 的设备（cuda:N / cpu）
+_worker_backend = "torch"
+_emb_client = None      # 客户端模式：embedding 服务的连接
+_client_tokenizer = None  # 客户端模式：只加载 tokenizer 用于分块
+_emb_cache = None
+_token_budget = EMBEDDING_TOKEN_BUDGET  # 本 worker 学到的安全 token 预算，OOM 后收紧
+_device_budgets = {}    # 主进程：设备名 -> 共享的 token 预算（multiprocessing.Value），fork 出的 worker 继承
+_shared_budget = None   # worker：所在设备的共享 token 预算，同一设备上的 worker 只需一次 OOM 就都收紧
 all_emb_cnt = 0
 
 
-def init_worker():
-    """每个进程加载一次 SentenceTransformer 模型，并自动分配 GPU ID"""
-    global _st_model, _worker_gpu_id
+def init_worker(device_name: str = None):
+    """每个进程加载一次 SentenceTransformer 模型到调度器分配的设备（cuda:N / cpu）"""
+    global _st_model, _worker_gpu_id, _worker_backend, _emb_cache, _emb_client, _client_tokenizer, _shared_budget
     try:
         pid = os.getpid()
 
-        # === 分配 GPU ID ===
-        gpu_id = pid % NUM_GPU_DEVICES
-        # gpu_id = pid
-        _worker_gpu_id = str(gpu_id)
-        # 根据分配的 GPU ID 设置 PyTorch 的 CUDA 设备
-        device = torch.device(f'cuda:{gpu_id}' if torch.cuda.is_available() else 'cpu')
-        # logger.info(f"Worker (PID={pid}) 开始初始化，分配 GPU: {gpu_id}, 使用设备: {device}")
-        
-        _st_model = SentenceTransformer(MODEL_NAME, device=device, trust_remote_code=True)        
-        _st_model.half() # 启用 FP16 (如果模型和 GPU 支持)        
+        if device_name == "client":
+            # 模型在 embedding 服务中，这里只需要分块用的 tokenizer
+            _worker_gpu_id = "client"
+            _emb_client = EmbeddingClient(EMBEDDING_SERVER, dim=EMBEDDING_DIM)
+            if CHUNK_MODE == "token":
+                try:
+                    from transformers import AutoTokenizer
+                    _client_tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+                except Exception as e:
+                    logger.warning(f"Worker (PID={pid}) tokenizer 加载失败（{e}），按字符分块")
+            logger.info(f"Worker (PID={pid}) 初始化完成，embedding 由服务 {EMBEDDING_SERVER} 计算")
+            return
+
+        # === 分配设备 ===
+        if device_name is None:
+            # 不经调度器直接调用时按 pid 选择 GPU
+            device_name = f'cuda:{pid % NUM_GPU_DEVICES}' if torch.cuda.is_available() else 'cpu'
+        _worker_gpu_id = device_name
+        _shared_budget = _device_budgets.get(device_name)
+        device = torch.device(device_name)
+        # logger.info(f"Worker (PID={pid}) 开始初始化，使用设备: {device}")
+
+        if device_name == 'cpu':
+            torch.set_num_threads(CPU_THREADS_PER_WORKER)  # 多个 CPU worker 各自限定线程数，避免互相争抢
+        _worker_backend = CPU_BACKEND if device_name == 'cpu' else GPU_BACKEND
+        _st_model = None
+        if _worker_backend == "onnx":
+            try:
+                from onnx_backend import OnnxEmbedder
+                _st_model = OnnxEmbedder(ONNX_MODEL_DIR, intra_op_threads=CPU_THREADS_PER_WORKER,
+                                         inter_op_threads=ONNX_INTER_OP_THREADS)
+            except Exception as e:
+                logger.warning(f"Worker (PID={pid}) ONNX 后端不可用（{e}），改用 PyTorch")
+                _worker_backend = "torch"
+        if _st_model is None:
+            _st_model = SentenceTransformer(MODEL_NAME, device=device, trust_remote_code=True)
+            if device_name != 'cpu':
+                _st_model.half() # 启用 FP16 (如果模型和 GPU 支持)；CPU 上保持 FP32
         # _st_model = torch.compile(_st_model) # 或者使用 torch.compile (PyTorch 2.0+)        
         
-        logger.info(f"Worker (PID={pid}) 初始化完成，SentenceTransformer 模型已加载到 GPU: {gpu_id} (设备: {device})")
+        if EMB_CACHE_ENABLED:
+            # 写入时按容量定期淘汰，整个语料的运行期间缓存文件也不会无限增长
+            _emb_cache = EmbCache(EMB_CACHE_PATH, EMBEDDING_DIM, max_bytes=EMB_CACHE_MAX_BYTES, eviction=EMB_CACHE_EVICTION)
+        logger.info(f"Worker (PID={pid}) 初始化完成，{_worker_backend} 后端模型已加载到设备: {device}")
     except Exception as e:
         logger.error(f"Worker (PID={pid}) 初始化失败: {e}")
         raise
@@ -97,10 +202,43 @@ def split_text_with_overlap(text: str, chunk_size: int = 1024, overlap: int = 50
     return chunks
 
 
+def get_tokenizer(model=None):
+    """当前 worker 模型自带的 tokenizer（客户端模式下为单独加载的 tokenizer），没有时返回 None"""
+    if model is None and _st_model is None:
+        return _client_tokenizer
+    return getattr(model if model is not None else _st_model, "tokenizer", None)
+
+
+def split_text_by_tokens(text: str, tokenizer, chunk_tokens: int = CHUNK_TOKENS,
+                         overlap: int = CHUNK_OVERLAP_TOKENS) -> List[str]:
+    """按 token 数分块，块边界落在 token 边界上，块文本为原文的连续子串"""
+    if not text:
+        return [text]
+    offsets = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)["offset_mapping"]
+    if len(offsets) <= chunk_tokens:
+        return [text]
+    chunks = []
+    start = 0
+    while start < len(offsets):
+        end = min(start + chunk_tokens, len(offsets))
+        chunks.append(text[offsets[start][0]:offsets[end - 1][1]])
+        if end >= len(offsets):
+            break
+        start = end - overlap
+    return chunks
+
+
+def split_text(text: str) -> List[str]:
+    tokenizer = get_tokenizer()
+    if CHUNK_MODE == "token" and tokenizer is not None:
+        return split_text_by_tokens(text, tokenizer)
+    return split_text_with_overlap(text)
+
+
 # =============================
-# 嵌入函数 (使用 SentenceTransformer) (已修正 batch_size 使用)
+# 嵌入函数 (SentenceTransformer 或 ONNX 后端，接口相同) (已修正 batch_size 使用)
 # =============================
-def embedding(texts: List[str], model=None, batch_size: int = 4098) -> List[List[float]]: 
+def embedding(texts: List[str], model=None, batch_size: int = 4098) -> np.ndarray: 
     if model is None:
         model = _st_model
     if model is None:
@@ -113,7 +251,204 @@ def embedding(texts: List[str], model=None, batch_size: int = 4098) -> List[List
         convert_to_numpy=True,
         show_progress_bar=False
     )
-    return embeddings.astype(float).tolist()
+    return embeddings  # (文本数, 维度) 的 float32 数组，转换为 JSON 列表的工作留到输出阶段
+
+
+# =============================
+# 按 token 长度分桶组 batch
+# =============================
+def make_token_batches(token_lengths: List[int], token_budget: int, max_batch_size: int) -> List[List[int]]:
+    """
+    把整个 worker batch 的文本按 token 长度从长到短排序后切分：
+    每组的 条数 × 组内最长长度（即 padding 后的 token 数）不超过预算，条数不超过 max_batch_size。
+    返回每组在原列表中的下标。
+    """
+    order = sorted(range(len(token_lengths)), key=lambda i: -token_lengths[i])
+    batches = []
+    current = []
+    for i in order:
+        # 降序排列，组内最长即第一条
+        longest = token_lengths[current[0]] if current else token_lengths[i]
+        if current and (longest * (len(current) + 1) > token_budget or len(current) >= max_batch_size):
+            batches.append(current)
+            current = []
+        current.append(i)
+    if current:
+        batches.append(current)
+    return batches
+
+
+def share_token_budgets(plan):
+    """
+    在主进程中、创建进程池之前调用：为每个设备建一个共享的 token 预算，由该设备上的所有 worker 共用。
+    worker 由 DeviceScheduler 以 fork 启动，经模块全局 _device_budgets 继承这些共享值。
+    """
+    global _device_budgets
+    _device_budgets = {device: WORKER_CONTEXT.Value('q', EMBEDDING_TOKEN_BUDGET) for device, _ in plan if device != "client"}
+
+
+def current_token_budget() -> int:
+    """本 worker 当前的 token 预算：同设备其他 worker 学到的更小预算也立即生效"""
+    global _token_budget
+    if _shared_budget is not None:
+        _token_budget = min(_token_budget, _shared_budget.value)
+    return _token_budget
+
+
+def lower_token_budget(budget: int) -> bool:
+    """OOM 后收紧预算（本 worker 与所在设备共享的预算），返回是否确实收紧"""
+    global _token_budget
+    budget = max(MIN_TOKEN_BUDGET, budget)
+    if _shared_budget is not None:
+        with _shared_budget.get_lock():
+            _shared_budget.value = min(_shared_budget.value, budget)
+    if budget >= _token_budget:
+        return False
+    _token_budget = budget
+    return True
+
+
+def is_oom(e: Exception) -> bool:
+    """torch 的 OutOfMemoryError 与部分算子抛出的 RuntimeError 都带有 out of memory 字样"""
+    return "out of memory" in str(e).lower()
+
+
+def inject_fault(texts: List[str], padded_tokens: int):
+    if not FAULT_INJECTION:
+        return
+    limit = FAULT_INJECTION.get("oom_above_tokens")
+    if limit and padded_tokens > limit:
+        raise RuntimeError(f"CUDA out of memory (故障注入: padding 后 {padded_tokens} tokens > {limit})")
+    fail_text = FAULT_INJECTION.get("fail_text")
+    if fail_text and any(fail_text in text for text in texts):
+        raise ValueError(f"故障注入: 文本块含有 {fail_text!r}")
+
+
+def encode_group(texts: List[str], group: List[int], token_lengths: List[int], model,
+                 embeddings: np.ndarray, failed: Dict[int, str], stats: Counter):
+    """
+    计算一组文本块（texts 中的下标）的 embedding 并写入 embeddings；失败时对半拆分递归重试，
+    OOM 时把 token 预算（本 worker 与同设备的 worker 共享）收紧到失败组的一半。单条仍失败的记入 failed（下标 -> 错误信息）。
+    组是按调用开始时的预算划分的：之后预算被收紧时，先按当前预算重新切分，不再以旧的大小再 OOM 一次。
+    """
+    lengths = [token_lengths[i] for i in group]
+    padded_tokens = max(lengths) * len(group)
+    budget = current_token_budget()
+    if len(group) > 1 and padded_tokens > budget:
+        for subgroup in make_token_batches(lengths, budget, len(group)):
+            encode_group(texts, [group[j] for j in subgroup], token_lengths, model, embeddings, failed, stats)
+        return
+    try:
+        group_texts = [texts[i] for i in group]
+        inject_fault(group_texts, padded_tokens)
+        embeddings[group] = embedding(group_texts, model=model, batch_size=len(group))
+    except Exception as e:
+        if is_oom(e):
+            stats["oom_splits"] += 1
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+            if lower_token_budget(padded_tokens // 2):
+                logger.warning(f"[{_worker_gpu_id}] {padded_tokens} tokens 的 batch 显存不足，token 预算收紧为 {_token_budget}")
+        else:
+            stats["error_splits"] += 1
+        if len(group) == 1:
+            failed[group[0]] = f"{type(e).__name__}: {e}"[:500]
+            return
+        middle = len(group) // 2
+        encode_group(texts, group[:middle], token_lengths, model, embeddings, failed, stats)
+        encode_group(texts, group[middle:], token_lengths, model, embeddings, failed, stats)
+        return
+    stats["real_tokens"] += sum(lengths)
+    stats["padded_tokens"] += padded_tokens
+    stats["gpu_batches"] += 1
+
+
+def embedding_bucketed(texts: List[str], model=None) -> Tuple[np.ndarray, Counter, Dict[int, str]]:
+    """
+    按 token 预算分组计算 embedding，结果按原顺序返回，另返回计算失败的文本块 {下标: 错误信息}（对应行为全零）。
+    统计 real_tokens（有效 token）与 padded_tokens（含 padding），二者之比即 padding 效率；
+    以及 oom_splits / error_splits 拆分重试次数。
+    """
+    model = model if model is not None else _st_model
+    tokenizer = get_tokenizer(model)
+    if tokenizer is not None:
+        max_length = getattr(model, "max_seq_length", None) or 8192
+        input_ids = tokenizer(texts, add_special_tokens=False)["input_ids"]
+        token_lengths = [min(len(ids) + 2, max_length) for ids in input_ids]  # 加上首尾特殊 token，超长部分会被截断
+        groups = make_token_batches(token_lengths, current_token_budget(), EMBEDDING_BATCH_SIZE)
+    else:
+        # 没有 tokenizer 时按条数分组，长度按 1 计，预算不起作用，只保留失败拆分
+        token_lengths = [1] * len(texts)
+        groups = [list(range(i, min(i + EMBEDDING_BATCH_SIZE, len(texts)))) for i in range(0, len(texts), EMBEDDING_BATCH_SIZE)]
+    stats = Counter()
+    failed = {}
+    embeddings = np.zeros((len(texts), EMBEDDING_DIM), dtype=np.float32)
+    for group in groups:
+        encode_group(texts, group, token_lengths, model, embeddings, failed, stats)
+    if tokenizer is None:
+        stats.pop("real_tokens", None)
+        stats.pop("padded_tokens", None)
+    return embeddings, stats, failed
+
+
+def model_fingerprint() -> str:
+    """缓存键中的模型部分：换模型、改变截断长度或换用量化后端后旧缓存自动失效"""
+    fingerprint = f"{MODEL_NAME}|{getattr(_st_model, 'max_seq_length', '')}|normalized"
+    if _worker_backend == "onnx":
+        fingerprint += f"|onnx-int8|{ONNX_MODEL_DIR}"
+    return fingerprint
+
+
+def embed_texts(texts: List[str]) -> Tuple[np.ndarray, Counter, Dict[int, str]]:
+    """
+    批内去重 → 查持久缓存 → 只为未命中的文本块计算 embedding 并写回缓存，结果按原顺序返回，
+    另返回计算失败的文本块 {下标: 错误信息}（失败的不写缓存）。
+    统计：chunks 总块数、dedup_hits 批内重复、cache_hits 缓存命中、embedded 实际计算数、embed_seconds 计算耗时、
+    bad_chunks 失败块数。
+    客户端模式下整个过程在 embedding 服务中完成，返回值相同。
+    """
+    if _emb_client is not None:
+        return _emb_client.embed(texts)
+    stats = Counter(chunks=len(texts))
+    embeddings = np.zeros((len(texts), EMBEDDING_DIM), dtype=np.float32)
+    positions = {}  # 文本 -> 在 texts 中出现的下标
+    for i, text in enumerate(texts):
+        positions.setdefault(text, []).append(i)
+    unique_texts = list(positions)
+    stats["dedup_hits"] = len(texts) - len(unique_texts)
+
+    failed = {}
+    missing = unique_texts
+    keys = {}
+    if _emb_cache is not None:
+        fingerprint = model_fingerprint()
+        keys = {text: chunk_key(text, fingerprint) for text in unique_texts}
+        cached = _emb_cache.get_many(list(keys.values()))
+        stats["cache_hits"] = len(cached)
+        missing = []
+        for text in unique_texts:
+            if keys[text] in cached:
+                embeddings[positions[text]] = cached[keys[text]]
+            else:
+                missing.append(text)
+
+    if missing:
+        start = time.time()
+        vectors, bucket_stats, missing_failed = embedding_bucketed(missing, model=_st_model)
+        stats.update(bucket_stats)
+        stats["embedded"] = len(missing)
+        stats["embed_seconds"] = time.time() - start
+        for i, text in enumerate(missing):
+            embeddings[positions[text]] = vectors[i]
+            if i in missing_failed:
+                for position in positions[text]:
+                    failed[position] = missing_failed[i]
+        stats["bad_chunks"] = len(failed)
+        if missing_failed:
+            logger.warning(f"[{_worker_gpu_id}] {len(missing_failed)} 个文本块计算失败，已记入 failed_chunks")
+        if _emb_cache is not None:
+            _emb_cache.put_many([(keys[text], vectors[i]) for i, text in enumerate(missing) if i not in missing_failed])
+    return embeddings, stats, failed
 
 
 # =============================
@@ -134,7 +469,7 @@ def process_json_data_to_texts(data: Dict[str, Any]) -> Tuple[List[str], List[in
             merge_text = ""
         # meta_info = data["meta"]["description"][:100].replace("\n", ",") # 未使用
         # texts = split_text_with_overlap(merge_text, meta_info) # <-- 修改调用
-        texts = split_text_with_overlap(merge_text) # <-- 修改调用
+        texts = split_text(merge_text) # <-- 按 CHUNK_MODE 分块
         multipage_texts.extend(texts)
         text_nums_per_page_list.append(len(texts))
         p_cnt += 1
@@ -144,10 +479,20 @@ def process_json_data_to_texts(data: Dict[str, Any]) -> Tuple[List[str], List[in
 # =============================
 # 新增：批量处理函数（供进程池调用）—— 核心优化 (已修正 meta 顺序)
 # =============================
-def process_batch_s3(json_lines_batch: List[str]) -> Tuple[List[str], str]:
+def process_batch_s3(json_lines_batch: List[str], emb_shard: str = None, line_positions: List[Tuple[int, int]] = None,
+                     timestamp: str = None) -> Tuple[List[str], str, int, Dict[str, np.ndarray], Dict[str, int]]:
+    """
+    返回 (每行结果 JSON, GPU ID, embedding 数, {表示: 向量数组}, 统计计数)。
+    传入 emb_shard（npy 输出）时结果行不含向量，embedding_list 中的 row 指向返回数组（即该分片）的行号，
+    数组按 EMBEDDING_VARIANTS 生成 float / int8（含逐维标定）/ binary 表示；
+    否则向量以浮点列表写入结果行，返回的字典为 None。
+    计算失败的文本块不进入 embedding_list，而是以 {page, text, error} 记入该行的 failed_chunks（无失败时不含该字段）。
+    line_positions 为每行在输入文件中的 (行号, 字节偏移)，写入 line_index / line_offset，下游可按此与其他输出归并；
+    timestamp 为写入每条记录的时间戳（输入文件的修改时间，重复运行结果不变），未传入时取当前时间。
+    """
     global _st_model, _worker_gpu_id
     all_emb_cnt = 0
-    if _st_model is None:
+    if _st_model is None and _emb_client is None:
         init_worker()  # 确保模型已加载
     gpu_id = _worker_gpu_id
     results = []
@@ -164,55 +509,67 @@ def process_batch_s3(json_lines_batch: List[str]) -> Tuple[List[str], str]:
         all_texts.extend(multipage_texts)
         batch_text_nums.append(text_nums_per_page_list)
         batch_metas.append(meta)
-    # === Step 2: 批量生成 embeddings ===
-    if all_texts:
-        try:
-            bge_m3_embeddings = embedding(all_texts, model=_st_model, batch_size=EMBEDDING_BATCH_SIZE)
-        except Exception as e:
-            logger.warning(f"批量 embedding 失败，降级为逐行处理: {e}")
-            bge_m3_embeddings = []
-            for text in all_texts:
-                try:
-                    emb = embedding([text], model=_st_model, batch_size=EMBEDDING_BATCH_SIZE)[0]
-                    bge_m3_embeddings.append(emb)
-                except:
-                    emb = [0.0] * 1024
-                    bge_m3_embeddings.append(emb)
-    else:
-        bge_m3_embeddings = []
-    all_emb_cnt += len(bge_m3_embeddings)
+    # === Step 2: 批量生成 embeddings（重复文本块走缓存，其余按 token 长度分桶计算）===
+    bge_m3_embeddings, batch_stats, failed = embed_texts(all_texts)
+    all_emb_cnt += len(bge_m3_embeddings) - len(failed)
     # === Step 3: 重组结果 ===
     emb_idx = 0
+    kept_rows = []  # npy 输出：写入分片的向量在 bge_m3_embeddings 中的下标
     for idx, text_nums_per_page_list in enumerate(batch_text_nums): # <-- 使用 enumerate 获取索引
         meta = batch_metas[idx]
         embedding_list = []
+        failed_chunks = []
         for i in range(len(text_nums_per_page_list)):
-            texts = all_texts[emb_idx:emb_idx + text_nums_per_page_list[i]]
-            chunk_embeddings = bge_m3_embeddings[emb_idx:emb_idx + text_nums_per_page_list[i]]
-            embedding_list.extend([
-                {
-                    "type": "text",
-                    "page": i,
-                    "text": text,
-                    "bge_m3_embedding": emb
-                }
-                for text, emb in zip(texts, chunk_embeddings)
-                if len(text) > 0 # <-- 添加过滤条件
-            ])
+            for j in range(emb_idx, emb_idx + text_nums_per_page_list[i]):
+                text = all_texts[j]
+                if len(text) == 0: # <-- 添加过滤条件
+                    continue
+                if j in failed:
+                    failed_chunks.append({"page": i, "text": text, "error": failed[j]})
+                    continue
+                item = {"type": "text", "page": i, "text": text}
+                if emb_shard is None:
+                    item["bge_m3_embedding"] = bge_m3_embeddings[j].astype(float).tolist()
+                else:
+                    item["row"] = len(kept_rows)
+                    kept_rows.append(j)
+                embedding_list.append(item)
             emb_idx = emb_idx + text_nums_per_page_list[i]
         
-        result = {
+        result = {}
+        if line_positions is not None:
+            result["line_index"], result["line_offset"] = line_positions[idx]
+        result.update({
             "original_file": meta.get("original_file", ''),
             "generated_file": meta.get("generated_file", ''),
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": timestamp or datetime.now().isoformat(),
             "total_pages": meta.get("total_pages", ''),
             "file_type": meta.get("file_type", ''),
             "url": meta.get("url", ''),
             "description": meta.get("description", ''),
             "embedding_list": embedding_list
-        }
+        })
+        if failed_chunks:
+            result["failed_chunks"] = failed_chunks
+        if emb_shard is not None:
+            result["embedding_shard"] = emb_shard
         results.append(json.dumps(result, ensure_ascii=False))
-    return results, gpu_id, all_emb_cnt
+    if emb_shard is None:
+        return results, gpu_id, all_emb_cnt, None, batch_stats
+    return (results, gpu_id, all_emb_cnt,
+            quantize_variants(bge_m3_embeddings[kept_rows], EMBEDDING_VARIANTS, EMBEDDING_DTYPE), batch_stats)
+
+
+def process_batch_shm(input_range: Tuple[str, int, int, int], emb_shard: str = None,
+                      timestamp: str = None) -> Tuple[dict, str, int, Dict[str, int]]:
+    """
+    共享内存版本：input_range 为 (输入共享内存名, 起始偏移, 结束偏移, 首行行号)，
+    结果行与向量写入新的共享内存，返回 (输出布局描述, GPU ID, embedding 数, 统计计数)。
+    """
+    json_lines_batch, line_positions = read_shared_lines(*input_range)
+    results, gpu_id, all_emb_cnt, emb_arrays, batch_stats = process_batch_s3(
+        json_lines_batch, emb_shard, line_positions, timestamp)
+    return write_shared_output(results, emb_arrays), gpu_id, all_emb_cnt, batch_stats
 
 
 def format_time(seconds):
@@ -226,6 +583,278 @@ def format_time(seconds):
 # =============================
 # 主流程：S3 流式处理 (已修正进度计数)
 # =============================
+def load_input_file(s3_client, key):
+    """
+    下载并分割一个输入文件（在预取线程中执行），返回 (batch 列表, 每个 batch 的行数, 共享内存输入, 时间戳, 耗时秒数)。
+    SHM_HANDOFF 时文件字节读入共享内存，batch 为 (共享内存名, 起始偏移, 结束偏移, 首行行号)；
+    否则 batch 为 (行列表, 每行的 (行号, 字节偏移))，共享内存输入为 None。
+    时间戳取输入对象的修改时间，同一输入重复运行输出不变。
+    """
+    start = time.time()
+    # 分块范围读取（可并行），常驻内存与文件大小无关，见 common/s3_line_reader.py
+    reader = S3LineReader(s3_client, BUCKET_NAME, key, chunk_size=READ_CHUNK_SIZE, parallel=READ_PARALLEL)
+    reader.size  # head_object：对象大小与修改时间
+    timestamp = (reader.last_modified or datetime.now()).isoformat()
+    if SHM_HANDOFF:
+        shared_input = SharedInput(reader)
+        ranges = shared_input.batch_ranges(MAX_BATCH_BYTES)
+        batches = [(shared_input.name, begin, end, first_line) for begin, end, _, first_line in ranges]
+        return batches, [line_count for _, _, line_count, _ in ranges], shared_input, timestamp, time.time() - start
+    # 逐行解码，不再同时持有整个文件的原始字节、解码后的字符串与行列表
+    lines, positions = [], []
+    for line_index, (offset, raw) in enumerate(reader.iter_lines()):
+        line = raw.decode('utf-8').strip()
+        if line:
+            lines.append(line)
+            positions.append((line_index, offset))
+    # 使用字节数控制 batch 大小：按固定行数划分时，太长的行可能 oom，太短的行则性能不高
+    batches = []
+    first = 0
+    for batch in create_batches_by_bytes(lines, max_batch_bytes=MAX_BATCH_BYTES):
+        batches.append((batch, positions[first:first + len(batch)]))
+        first += len(batch)
+    return batches, [len(batch) for batch, _ in batches], None, timestamp, time.time() - start
+
+
+class FileJob:
+    """一个正在 embedding 的输入文件：输出流与重排缓冲、batch 提交与完成计数、向量分片上传"""
+
+    def __init__(self, s3_client, file_index, key, output_key, output_base, line_count, batch_count,
+                 shared_input=None, timestamp=None):
+        self.file_index = file_index
+        self.key = key
+        self.output_key = output_key
+        self.output_base = output_base
+        self.line_count = line_count
+        self.batch_count = batch_count
+        self.submitted = 0
+        self.done = 0
+        self.processed_line_count = 0
+        self.start_time = time.time()
+        self.shard_uploads = []
+        self.shared_input = shared_input  # 全部 batch 完成（或出错）后释放
+        self.timestamp = timestamp
+        self.next_flush = 0  # 下一个应写出的 batch 序号
+        self.reorder = {}    # batch 序号 -> (结果行, 释放函数)：已完成但前序 batch 未完成
+        # 边处理边分段上传，出错时放弃上传，不留下写了一半的对象
+        self.writer = S3MultipartWriter(
+            s3_client, BUCKET_NAME, output_key,
+            part_size=OUTPUT_PART_SIZE,
+            max_pending_parts=OUTPUT_MAX_PENDING_PARTS,
+            checksum_algorithm='SHA256',
+            allow_empty=True  # 没有非空行的输入也写出（空的）输出，续跑时据此跳过，不再重复下载解析
+        )
+
+    def finished(self) -> bool:
+        return self.submitted == self.batch_count and self.done == self.submitted
+
+    def window_full(self) -> bool:
+        """已提交的 batch 领先写出位置 REORDER_WINDOW_BATCHES 个时暂停提交，限制重排缓冲的大小"""
+        return self.submitted - self.next_flush >= REORDER_WINDOW_BATCHES
+
+    def add_output(self, index: int, lines, release=None):
+        """缓存第 index 个 batch 的结果行，与已写出部分连续的按输入顺序立即写出；release 在写出后调用"""
+        self.reorder[index] = (lines, release)
+        while self.next_flush in self.reorder:
+            lines, release = self.reorder.pop(self.next_flush)
+            try:
+                # 边处理边写入，攒满一个分段即上传
+                self.writer.write(lines)
+            finally:
+                if release is not None:
+                    release()
+            self.next_flush += 1
+
+    def discard_output(self):
+        for _, release in self.reorder.values():
+            if release is not None:
+                release()
+        self.reorder = {}
+
+    def release_input(self):
+        if self.shared_input is not None:
+            self.shared_input.release()
+            self.shared_input = None
+
+
+def upload_shard(s3_client, key, body: bytes):
+    s3_client.put_object(
+        Bucket=BUCKET_NAME,
+        Key=key,
+        Body=body,
+        ContentType='application/octet-stream'
+    )
+
+
+def upload_shards(s3_client, upload_pool, job: FileJob, emb_shard, emb_arrays):
+    """向量分片在当前线程编码后交给上传线程（分片与写出顺序无关，不进重排缓冲）"""
+    # 分片先于引用它的索引行上传（finish_file 中等待全部分片完成后才提交索引）
+    for kind, emb_array in (emb_arrays or {}).items():
+        job.shard_uploads.append(upload_pool.submit(
+            upload_shard, s3_client, shard_key(job.output_base, variant_name(emb_shard, kind)), encode_npy(emb_array)
+        ))
+
+
+def finish_file(job: FileJob, timing: Counter):
+    """等待该文件的向量分片上传完，再提交输出（npy 输出时即索引文件），在上传线程中执行"""
+    start = time.time()
+    try:
+        for future in job.shard_uploads:
+            future.result()
+        job.writer.close()
+    except BaseException:
+        job.writer.abort()
+        raise
+    timing["upload"] += time.time() - start
+    logger.info(f"结果已上传: s3://{BUCKET_NAME}/{job.output_key}（文件耗时 {format_time(time.time() - job.start_time)}）")
+
+
+def run_pipeline(s3_client, scheduler: DeviceScheduler, pending_files, total_files, run_stats, start_time):
+    """
+    三段流水线：预取线程下载并分割后续 PREFETCH_FILES 个文件；主线程经调度器向各设备持续提交 batch（每个设备
+    在途不超过 worker 数 × WORKER_QUEUE_DEPTH，跨文件衔接），结果经重排缓冲按输入顺序写出；文件的全部 batch 完成后交给上传线程收尾。
+    结束时输出各阶段耗时，以及 GPU 因等待下载而空闲的时间。
+    """
+    timing = Counter()
+    prefetch_pool = ThreadPoolExecutor(max_workers=PREFETCH_FILES, thread_name_prefix="prefetch")
+    upload_pool = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="upload")
+    file_iter = iter(pending_files)
+    prefetching = deque()  # (文件信息, 预取 future)
+    in_flight = {}         # batch future -> (FileJob, batch 序号, 行数, 分片名)
+    active_jobs = []
+    finishing = []
+    current = None         # (FileJob, 剩余 batch 的迭代器)
+    total_emb_count = 0
+
+    def fill_prefetch():
+        while len(prefetching) < PREFETCH_FILES:
+            spec = next(file_iter, None)
+            if spec is None:
+                return
+            prefetching.append((spec, prefetch_pool.submit(load_input_file, s3_client, spec[1])))
+
+    def finish_if_done(job):
+        if job.finished():
+            job.release_input()
+            active_jobs.remove(job)
+            finishing.append(upload_pool.submit(finish_file, job, timing))
+
+    try:
+        fill_prefetch()
+        while True:
+            # === 提交 batch，直到在途上限 ===
+            while scheduler.has_capacity():
+                if current is None:
+                    if not prefetching or (in_flight and not prefetching[0][1].done()):
+                        break  # 还有在途 batch 时不阻塞等待预取
+                    spec, future = prefetching.popleft()
+                    wait_start = time.time()
+                    batches, batch_lines, shared_input, timestamp, load_seconds = future.result()
+                    if not in_flight:
+                        timing["gpu_idle"] += time.time() - wait_start  # 进程池无事可做，等待下载
+                    timing["download_split"] += load_seconds
+                    fill_prefetch()
+                    file_index, key, output_key, output_base = spec
+                    logger.info(f"读取并分割 S3 文件: {key} 完毕，共 {len(batches)} 个 batch，耗时：{format_time(load_seconds)}")
+                    job = FileJob(s3_client, file_index, key, output_key, output_base,
+                                  sum(batch_lines), len(batches), shared_input, timestamp)
+                    active_jobs.append(job)
+                    if not batches:
+                        finish_if_done(job)  # 空文件
+                        continue
+                    current = (job, enumerate(zip(batches, batch_lines)))
+                job, batch_iter = current
+                if job.window_full():
+                    break  # 等待前序 batch 完成后再继续提交
+                i, (batch, batch_size) = next(batch_iter)
+                emb_shard = shard_name(i) if OUTPUT_FORMAT == "npy" else None
+                if SHM_HANDOFF:
+                    future = scheduler.submit(process_batch_shm, batch, emb_shard, job.timestamp)
+                else:
+                    future = scheduler.submit(process_batch_s3, batch[0], emb_shard, batch[1], job.timestamp)
+                in_flight[future] = (job, i, batch_size, emb_shard)
+                job.submitted += 1
+                if job.submitted == job.batch_count:
+                    current = None  # 该文件已全部提交，完成后由 finish_if_done 收尾
+
+            if not in_flight:
+                if current is None and not prefetching:
+                    break
+                continue
+
+            # === 收取完成的 batch，经重排缓冲按输入顺序写出 ===
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                job, index, batch_size, emb_shard = in_flight.pop(future)
+                if SHM_HANDOFF:
+                    layout, gpu_id, all_emb_cnt, batch_stats = scheduler.result(future)
+                    shm, lines, emb_arrays = open_output(layout)
+
+                    def release(shm=shm, lines=lines):
+                        # 结果行写出后才释放共享内存块，缓冲期间不复制
+                        lines.release()
+                        release_output(shm)
+                    try:
+                        upload_shards(s3_client, upload_pool, job, emb_shard, emb_arrays)
+                    except BaseException:
+                        emb_arrays = None
+                        release()
+                        raise
+                    emb_arrays = None
+                    job.add_output(index, lines, release)
+                else:
+                    batch_results, gpu_id, all_emb_cnt, emb_arrays, batch_stats = scheduler.result(future)
+                    upload_shards(s3_client, upload_pool, job, emb_shard, emb_arrays)
+                    job.add_output(index, "".join(result + "\n" for result in batch_results).encode('utf-8'))
+                run_stats.update(batch_stats)
+                scheduler.add_items(gpu_id, all_emb_cnt)
+                job.done += 1
+                job.processed_line_count += batch_size # <-- 累加处理的行数
+                total_emb_count += all_emb_cnt
+                # 每完成一个 batch 就更新日志
+                logger.info(
+                    f"正在处理：{job.file_index}/{total_files}, "
+                    f"当前进度: {job.processed_line_count}/{job.line_count} 行, "
+                    f"emb数：{total_emb_count}, "
+                    f"总时间： {format_time(time.time() - start_time)}, "
+                    f"当前文件时间： {format_time(time.time() - job.start_time)}, "
+                    f"设备: {gpu_id}"
+                    + (f", padding 效率: {padding_efficiency(run_stats):.1%}" if run_stats["padded_tokens"] else "")
+                    + f", {cache_progress(run_stats)}"
+                )
+                finish_if_done(job)
+
+        wait_start = time.time()
+        for future in finishing:
+            future.result()
+        timing["upload_wait"] += time.time() - wait_start
+    except BaseException:
+        for job in active_jobs:
+            job.writer.abort()
+            job.discard_output()
+            job.release_input()
+        # 预取完成但尚未开始处理的文件
+        for _, future in prefetching:
+            if future.done() and not future.exception():
+                shared_input = future.result()[2]
+                if shared_input is not None:
+                    shared_input.release()
+        raise
+    finally:
+        prefetch_pool.shutdown(wait=False, cancel_futures=True)
+        upload_pool.shutdown(wait=True)
+
+    # 串行执行时，下载 + 分割 + 上传的时间 GPU 全部空闲
+    serial_idle = timing["download_split"] + timing["upload"]
+    pipeline_idle = timing["gpu_idle"] + timing["upload_wait"]
+    logger.info(
+        f"[流水线] 下载+分割 累计 {timing['download_split']:.1f}s（GPU 空等 {timing['gpu_idle']:.1f}s），"
+        f"上传 累计 {timing['upload']:.1f}s（收尾等待 {timing['upload_wait']:.1f}s）；"
+        f"GPU 空闲 {serial_idle:.1f}s → {pipeline_idle:.1f}s，消除 {serial_idle - pipeline_idle:.1f}s"
+    )
+    logger.info(f"全部文件处理完成，共生成 {total_emb_count} 个 embedding，总耗时 {format_time(time.time() - start_time)}")
+
+
 
 def batched(iterable, batch_size):
     """将可迭代对象按 batch_size 分批，返回生成器"""
@@ -267,9 +896,46 @@ def create_batches_by_bytes(lines, max_batch_bytes=10 * 1024 * 1024):
     return batches
 
 
+def available_gpus() -> List[int]:
+    """
+    确定使用的 GPU 编号。设备数在子进程中查询：主进程里调用 torch.cuda.is_available() / device_count()
+    会初始化 CUDA（除非设置了 PYTORCH_NVML_BASED_CUDA_CHECK=1），之后 fork 出的 worker 无法再使用 CUDA。
+    """
+    probe = subprocess.run(
+        [sys.executable, "-c", "import torch; print(torch.cuda.device_count() if torch.cuda.is_available() else 0)"],
+        capture_output=True, text=True,
+    )
+    if probe.returncode != 0:
+        logger.warning(f"查询 GPU 数失败，只使用 CPU: {probe.stderr.strip()[-500:]}")
+        return []
+    return list(range(min(NUM_GPU_DEVICES, int(probe.stdout.split()[-1]))))
+
+
+def evict_emb_cache():
+    """在主进程中按容量淘汰 embedding 缓存（在创建进程池之前或之后调用，连接不跨 fork）"""
+    if not EMB_CACHE_ENABLED:
+        return
+    emb_cache = EmbCache(EMB_CACHE_PATH, EMBEDDING_DIM, max_bytes=EMB_CACHE_MAX_BYTES, eviction=EMB_CACHE_EVICTION)
+    logger.info(f"embedding 缓存淘汰 {emb_cache.evict()} 条，{emb_cache.summary()}")
+    emb_cache.close()
+
+
+def cache_progress(stats) -> str:
+    """缓存命中率，以及按实际计算的平均单块耗时估算节省的 GPU 时间"""
+    reused = stats["dedup_hits"] + stats["cache_hits"]
+    hit_rate = reused / stats["chunks"] if stats["chunks"] else 0.0
+    seconds_per_chunk = stats["embed_seconds"] / stats["embedded"] if stats["embedded"] else 0.0
+    saved = f"节省 GPU 约 {reused * seconds_per_chunk:.0f}s" if stats["embedded"] else "本次未实际计算，无法估算节省的 GPU 时间"
+    return f"缓存命中率: {hit_rate:.1%}（批内去重 {stats['dedup_hits']}，持久缓存 {stats['cache_hits']}），{saved}"
+
+
+def padding_efficiency(stats) -> float:
+    """有效 token 占 padding 后 token 的比例，越接近 1 浪费的 GPU 计算越少"""
+    return stats["real_tokens"] / stats["padded_tokens"] if stats["padded_tokens"] else 0.0
+
+
 def main():
-    total_emb_count = 0
-    BATCH_SIZE_GPU = 1024
+    run_stats = Counter()  # 各 worker 返回的统计计数累加
     s3_client = boto3.client("s3", **S3_CONFIG) # 假设 S3_CONFIG 已定义
 
     # === 1. 列出所有输入 JSONL 文件 ===
@@ -290,80 +956,49 @@ def main():
             output_keys_set.add(obj['Key'])
     logger.info(f"已存在 {len(output_keys_set)} 个输出文件，将跳过已处理的输入文件")
 
-    file_cnt = 0
-    start_time = time.time()
-    with ProcessPoolExecutor(max_workers=MAX_WORKERS, initializer=init_worker) as executor:
-        for key in file_keys:
-            file_cnt += 1
-            output_key = key.replace(INPUT_PREFIX, OUTPUT_PREFIX)
-            if output_key in output_keys_set:
-                logger.info(f"跳过已处理文件: {key} -> {output_key}")
-                continue
-            sub_start_time = time.time()
-            logger.info(f"正在处理 S3 文件: {key}")
-            response = s3_client.get_object(Bucket=BUCKET_NAME, Key=key)
-            
-            # === 流式读取 S3 文件 === 效率太低
-            # lines_iter = read_lines(response['Body'].iter_lines())
-            # line_batches = batched(lines_iter, BATCH_SIZE_GPU)
-
-            # 读取整个对象内容为字节
-            content = response['Body'].read().decode('utf-8')
-            lines = [line.strip() for line in content.splitlines() if line.strip()]            
-            logger.info(f"读取 S3 文件: {key} 完毕，耗时：{format_time(time.time() - sub_start_time)}")
-            # --- 根据固定的BATCH_SIZE_GPU划分，有可能遇到太长的行oom，如果太短的行则性能不高
-            # line_batches = [lines[i:i + BATCH_SIZE_GPU] for i in range(0, len(lines), BATCH_SIZE_GPU)]
-            # logger.info(f"分隔 S3 文件: {key} 完毕，耗时：{format_time(time.time() - sub_start_time)}")
-            
-            # 使用字节数控制 batch 大小（例如 10MB）
-            MAX_BATCH_BYTES = 10 * 1024 * 1024  # 10MB per batch
-            # line_batches = create_batches_by_bytes(lines, max_batch_bytes=MAX_BATCH_BYTES)
-            batch_info_list = [(batch, len(batch)) for batch in create_batches_by_bytes(lines, max_batch_bytes=MAX_BATCH_BYTES)] # 记录每个 batch 及其大小
-            logger.info(f"分割 S3 文件: {key} 完毕，共 {len(batch_info_list)} 个 batch，耗时：{format_time(time.time() - sub_start_time)}")
-
-            # === 准备输出流（边处理边写入）===
-            output_stream = BytesIO()
-            processed_line_count = 0 # 累计处理的行数
-            # 提交所有 batch
-            futures = {executor.submit(process_batch_s3, batch): batch_size for batch, batch_size in batch_info_list} 
-            for future in as_completed(futures):
-                batch_results, gpu_id, all_emb_cnt = future.result()
-                batch_size = futures[future] # 获取该 batch 的大小
-                # 边处理边写入 BytesIO
-                for result in batch_results:
-                    output_stream.write(result.encode('utf-8'))
-                    output_stream.write(b'\n')
-                processed_line_count += batch_size # <-- 累加处理的行数
-                # 每完成一个 batch 就更新日志
-                elapsed = time.time() - start_time
-                elapsed_sub = time.time() - sub_start_time
-                total_emb_count += all_emb_cnt
-                logger.info(
-                    f"正在处理：{file_cnt}/{len(file_keys)}, "
-                    f"当前进度: {processed_line_count}/{len(lines)} 行, " # <-- 新变量
-                    f"emb数：{total_emb_count}, "
-                    f"总时间： {format_time(elapsed)}, "
-                    f"当前文件时间： {format_time(elapsed_sub)}, "
-                    f"GPU: {gpu_id}"
-                )
-
-            # === 上传结果（自动分段上传）===
-            output_stream.seek(0)
-            s3_client.upload_fileobj(
-                Key=output_key,
-                Fileobj=output_stream,
-                Bucket=BUCKET_NAME,
-                ExtraArgs={
-                    'ContentType': 'application/json',
-                    'ChecksumAlgorithm': 'SHA256'  
-                }
-            )
-            logger.info(f"文件 {key} 处理完成，目前已生成 {total_emb_count} 个 embedding。")
-            logger.info(f"结果已上传: s3://{BUCKET_NAME}/{output_key}")
-
-            # === 记录已处理 ===
-            output_keys_set.add(output_key)
+    pending_files = []
+    for file_index, key in enumerate(file_keys, start=1):
+        output_key = key.replace(INPUT_PREFIX, OUTPUT_PREFIX)
+        output_base = None
+        if OUTPUT_FORMAT == "npy":
+            # 向量分片写在 output_base/ 下，索引文件最后提交，以它判断文件是否已处理
+            output_base = os.path.splitext(output_key)[0]
+            output_key = sidecar_key(output_base)
+        if output_key in output_keys_set:
+            logger.info(f"跳过已处理文件: {key} -> {output_key}")
+            continue
+        pending_files.append((file_index, key, output_key, output_base))
 
+    start_time = time.time()
+    if SHM_HANDOFF:
+        ensure_tracker()
+    if EMBEDDING_SERVER:
+        # 客户端模式：缓存与模型都在服务进程中
+        health = EmbeddingClient(EMBEDDING_SERVER).wait_ready(timeout=60)
+        logger.info(f"已连接 embedding 服务 {EMBEDDING_SERVER}，设备: {health.get('devices')}")
+        plan = [("client", CLIENT_WORKERS)]
+    else:
+        evict_emb_cache()
+        plan = plan_devices(available_gpus(), WORKERS_PER_GPU, CPU_WORKERS)
+        share_token_budgets(plan)
+    logger.info("worker 分配: " + "，".join(f"{device} × {workers}" for device, workers in plan))
+    with DeviceScheduler(plan, init_worker, WORKER_QUEUE_DEPTH) as scheduler:
+        run_pipeline(s3_client, scheduler, pending_files, len(file_keys), run_stats, start_time)
+        logger.info(scheduler.summary())
+
+    if run_stats["padded_tokens"]:
+        logger.info(
+            f"GPU batch {run_stats['gpu_batches']} 个，有效 token {run_stats['real_tokens']}，"
+            f"padding 后 {run_stats['padded_tokens']}，padding 效率 {padding_efficiency(run_stats):.1%}"
+        )
+    logger.info(cache_progress(run_stats))
+    if run_stats["oom_splits"] or run_stats["error_splits"] or run_stats["bad_chunks"]:
+        logger.warning(
+            f"拆分重试：显存不足 {run_stats['oom_splits']} 次，其他错误 {run_stats['error_splits']} 次；"
+            f"最终失败的文本块 {run_stats['bad_chunks']} 个（已记入结果行的 failed_chunks）"
+        )
+    if not EMBEDDING_SERVER:
+        evict_emb_cache()
     logger.info("所有文件处理完成。")
 
 
@@ -0,0 +1,89 @@
+import json
+import sys
+import time
+import numpy as np
+import torch
+from sentence_transformers import SentenceTransformer
+from onnx_backend import OnnxEmbedder
+
+
+# =============================
+# 配置区域
+# =============================
+# 对比 ONNX int8 后端与 PyTorch 的输出一致性和 CPU 吞吐：
+#   python backend_eval.py 本地输入1.jsonl [本地输入2.jsonl ...]
+# 文本取输入行各页的 merge_text，按 CHUNK_CHARS 截断，与线上分块后的长度相近。
+MODEL_NAME = "../models/bge-m3"
+ONNX_MODEL_DIR = "../models/bge-m3-onnx-int8"
+SAMPLE_TEXTS = 256
+CHUNK_CHARS = 1024
+BATCH_SIZE = 16
+CPU_THREADS = 8              # 两个后端使用相同的线程数
+MIN_COSINE = 0.98            # 单条余弦相似度低于该值视为不一致
+
+
+def load_texts(paths):
+    texts = []
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    pages = json.loads(line).get("json_content", {})
+                except Exception:
+                    continue
+                for page in pages.values():
+                    try:
+                        text = page[-1]["text"].replace("\n", ",")[:CHUNK_CHARS]
+                    except (KeyError, IndexError, TypeError, AttributeError):
+                        continue
+                    if text.strip():
+                        texts.append(text)
+                    if len(texts) >= SAMPLE_TEXTS:
+                        return texts
+    return texts
+
+
+def timed_encode(model, texts):
+    model.encode(texts[:BATCH_SIZE], batch_size=BATCH_SIZE, normalize_embeddings=True)  # 预热
+    start = time.perf_counter()
+    vectors = model.encode(texts, batch_size=BATCH_SIZE, normalize_embeddings=True,
+                           convert_to_numpy=True, show_progress_bar=False)
+    return np.asarray(vectors, dtype=np.float32), time.perf_counter() - start
+
+
+def main(paths):
+    texts = load_texts(paths)
+    if not texts:
+        print("没有读到文本")
+        return
+    torch.set_num_threads(CPU_THREADS)
+    torch_model = SentenceTransformer(MODEL_NAME, device="cpu", trust_remote_code=True)
+    onnx_model = OnnxEmbedder(ONNX_MODEL_DIR, intra_op_threads=CPU_THREADS)
+
+    torch_vectors, torch_seconds = timed_encode(torch_model, texts)
+    onnx_vectors, onnx_seconds = timed_encode(onnx_model, texts)
+
+    cosine = np.sum(torch_vectors * onnx_vectors, axis=1)  # 两边都已归一化
+    print(f"文本 {len(texts)} 条，batch {BATCH_SIZE}，线程 {CPU_THREADS}")
+    print(f"  余弦相似度: 平均 {cosine.mean():.4f}，最小 {cosine.min():.4f}，"
+          f"低于 {MIN_COSINE} 的 {int((cosine < MIN_COSINE).sum())} 条")
+
+    # 检索一致性：以 PyTorch 向量的 top-10 为基准
+    k = min(10, len(texts) - 1)
+    if k > 0:
+        def neighbours(vectors):
+            scores = vectors @ vectors.T
+            np.fill_diagonal(scores, -np.inf)
+            return np.argsort(-scores, axis=1)[:, :k]
+        overlap = np.mean([len(set(a) & set(b)) / k for a, b in zip(neighbours(torch_vectors), neighbours(onnx_vectors))])
+        print(f"  top-{k} 近邻重合率: {overlap:.4f}")
+
+    print(f"  {'torch fp32':<12} {len(texts) / torch_seconds:>8.1f} 条/s")
+    print(f"  {'onnx int8':<12} {len(texts) / onnx_seconds:>8.1f} 条/s（{torch_seconds / onnx_seconds:.2f}x）")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("用法: python backend_eval.py 本地输入.jsonl [...]")
+        sys.exit(1)
+    main(sys.argv[1:])
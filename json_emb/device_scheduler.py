@@ -0,0 +1,114 @@
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+
+# =============================
+# 按设备调度 worker
+# =============================
+# worker 依赖 fork 继承主进程的状态：设备共享的 token 预算、共享内存的 resource_tracker、运行时修改的配置。
+# 显式使用 fork，不随 Python 的默认启动方式变化（3.14 起默认为 forkserver，spawn / forkserver 下这些状态都不会传到 worker）
+WORKER_CONTEXT = multiprocessing.get_context("fork")
+
+def plan_devices(gpu_ids, workers_per_gpu: int, cpu_workers: int):
+    """
+    确定性地把 worker 分配到设备，返回 [(设备名, worker 数)]：每张 GPU workers_per_gpu 个，
+    另加 cpu_workers 个 CPU worker；没有可用 GPU 时至少保留 1 个 CPU worker。
+    """
+    plan = [(f"cuda:{gpu_id}", workers_per_gpu) for gpu_id in gpu_ids if workers_per_gpu > 0]
+    if cpu_workers > 0 or not plan:
+        plan.append(("cpu", max(cpu_workers, 1)))
+    return plan
+
+
+def _timed_call(fn, *args):
+    """在 worker 中执行并计时，供调度器统计设备忙碌时间"""
+    start = time.time()
+    result = fn(*args)
+    return result, time.time() - start
+
+
+class DeviceScheduler:
+    """
+    每个设备一个独立的进程池（即独立的任务队列），worker 以 fork 启动，由 initializer(设备名) 绑定到该设备。
+    submit 把任务交给当前负载（在途任务数 / worker 数）最低且仍有空位的设备，负载相同时优先 GPU；
+    每个设备的在途任务不超过 worker 数 × queue_depth，保证慢设备（CPU）不会囤积任务。
+    统计每个设备的 batch 数、条数、忙碌时间，summary 输出利用率与吞吐。
+    """
+
+    def __init__(self, plan, initializer, queue_depth: int = 2):
+        self.devices = []
+        for device, workers in plan:
+            self.devices.append({
+                "device": device,
+                "workers": workers,
+                "capacity": workers * queue_depth,
+                "executor": ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=(device,),
+                                                mp_context=WORKER_CONTEXT),
+                "in_flight": 0,
+                "batches": 0,
+                "items": 0,
+                "busy_seconds": 0.0,
+            })
+        self._future_device = {}
+        self.start_time = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.shutdown(cancel_futures=exc_type is not None)
+        return False
+
+    @property
+    def total_workers(self) -> int:
+        return sum(d["workers"] for d in self.devices)
+
+    def _pick(self):
+        free = [d for d in self.devices if d["in_flight"] < d["capacity"]]
+        if not free:
+            return None
+        return min(free, key=lambda d: (d["in_flight"] / d["workers"], d["device"] == "cpu"))
+
+    def has_capacity(self) -> bool:
+        return self._pick() is not None
+
+    def submit(self, fn, *args):
+        """提交到负载最低的设备，没有空位时返回 None"""
+        device = self._pick()
+        if device is None:
+            return None
+        future = device["executor"].submit(_timed_call, fn, *args)
+        device["in_flight"] += 1
+        self._future_device[future] = device
+        return future
+
+    def result(self, future):
+        """取出已完成任务的结果（异常照常抛出），并计入所在设备的忙碌时间"""
+        device = self._future_device.pop(future)
+        device["in_flight"] -= 1
+        result, seconds = future.result()
+        device["batches"] += 1
+        device["busy_seconds"] += seconds
+        return result
+
+    def add_items(self, device_name: str, items: int):
+        """计入设备处理的条数（由 worker 返回的设备名对应），用于吞吐统计"""
+        for device in self.devices:
+            if device["device"] == device_name:
+                device["items"] += items
+
+    def summary(self) -> str:
+        elapsed = max(time.time() - self.start_time, 1e-9)
+        lines = ["[设备调度]"]
+        for d in self.devices:
+            utilization = d["busy_seconds"] / (d["workers"] * elapsed)
+            lines.append(
+                f"  {d['device']:<8} worker {d['workers']}，batch {d['batches']}，embedding {d['items']}，"
+                f"忙碌 {d['busy_seconds']:.1f}s，利用率 {utilization:.1%}，吞吐 {d['items'] / elapsed:.1f} 条/s"
+            )
+        return "\n".join(lines)
+
+    def shutdown(self, cancel_futures: bool = False):
+        for d in self.devices:
+            d["executor"].shutdown(wait=True, cancel_futures=cancel_futures)
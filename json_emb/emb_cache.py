@@ -0,0 +1,119 @@
+import hashlib
+import sqlite3
+import threading
+import time
+import numpy as np
+
+
+# =============================
+# 文本块 embedding 缓存
+# =============================
+def chunk_key(text: str, fingerprint: str) -> str:
+    """文本块内容与模型指纹的哈希，作为缓存键"""
+    h = hashlib.sha256()
+    h.update(fingerprint.encode("utf-8"))
+    h.update(b"\x00")
+    h.update(text.encode("utf-8"))
+    return h.hexdigest()[:32]
+
+
+class EmbCache:
+    """
+    按文本块内容哈希缓存 float32 向量，存放在本地 SQLite（WAL）中，多个 worker 进程可同时读写。
+    容量超过 max_bytes 时按 eviction 策略淘汰到 LOW_WATERMARK：lru 淘汰最久未访问的，lfu 淘汰命中次数最少的。
+    除了运行开始与结束时显式调用 evict，写入方每新写入约 CHECK_FRACTION × 容量条就检查一次，运行期间也不超出上限太多。
+    """
+
+    QUERY_CHUNK = 500  # 单条 SQL 中的参数个数上限
+    LOW_WATERMARK = 0.9  # 淘汰到容量的该比例，留出余量，避免每次写入都触发淘汰
+    CHECK_FRACTION = 0.01  # 写入检查间隔（占容量条数的比例）；多个进程共用同一文件，检查时重新统计总条数
+
+    def __init__(self, db_path, dim: int, max_bytes=None, eviction: str = "lru"):
+        self.db_path = db_path
+        self.dim = dim
+        self.max_bytes = max_bytes
+        self.eviction = eviction
+        self._lock = threading.Lock()
+        self._unchecked = 0  # 上次检查容量之后本进程新写入的条数
+        self._conn = sqlite3.connect(db_path, timeout=60, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS emb_cache ("
+            " key TEXT PRIMARY KEY,"
+            " emb BLOB NOT NULL,"
+            " hits INTEGER NOT NULL DEFAULT 0,"
+            " created REAL NOT NULL,"
+            " last_access REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_emb_last_access ON emb_cache(last_access)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_emb_hits ON emb_cache(hits)")
+        self._conn.commit()
+
+    def get_many(self, keys) -> dict:
+        """批量查询，返回 {key: 向量}，只包含命中的键"""
+        found = {}
+        now = time.time()
+        with self._lock:
+            for i in range(0, len(keys), self.QUERY_CHUNK):
+                part = keys[i:i + self.QUERY_CHUNK]
+                placeholders = ",".join("?" * len(part))
+                rows = self._conn.execute(
+                    f"SELECT key, emb FROM emb_cache WHERE key IN ({placeholders})", part
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+                if rows:
+                    self._conn.executemany(
+                        "UPDATE emb_cache SET hits = hits + 1, last_access = ? WHERE key = ?",
+                        [(now, key) for key, _ in rows]
+                    )
+            self._conn.commit()
+        return found
+
+    def put_many(self, items):
+        """写入 [(key, 向量)]；全零向量（计算失败的占位）不缓存"""
+        now = time.time()
+        rows = [(key, np.asarray(emb, dtype=np.float32).tobytes(), now, now)
+                for key, emb in items if np.any(emb)]
+        if not rows:
+            return
+        with self._lock:
+            inserted = self._conn.executemany(
+                "INSERT OR IGNORE INTO emb_cache (key, emb, created, last_access) VALUES (?, ?, ?, ?)", rows
+            ).rowcount
+            self._conn.commit()
+        if self.max_bytes:
+            self._unchecked += max(inserted, 0)
+            if self._unchecked >= max(1, int(self.max_entries * self.CHECK_FRACTION)):
+                self._unchecked = 0
+                self.evict()
+
+    @property
+    def max_entries(self) -> int:
+        return self.max_bytes // (self.dim * 4)
+
+    def evict(self) -> int:
+        """总大小超过上限时按策略淘汰到 LOW_WATERMARK，返回淘汰条数"""
+        if not self.max_bytes:
+            return 0
+        with self._lock:
+            count = self._conn.execute("SELECT COUNT(*) FROM emb_cache").fetchone()[0]
+            if count <= self.max_entries:
+                return 0
+            excess = count - int(self.max_entries * self.LOW_WATERMARK)
+            order = "hits, last_access" if self.eviction == "lfu" else "last_access"
+            self._conn.execute(
+                f"DELETE FROM emb_cache WHERE key IN (SELECT key FROM emb_cache ORDER BY {order} LIMIT ?)",
+                (excess,)
+            )
+            self._conn.commit()
+        return excess
+
+    def summary(self) -> str:
+        with self._lock:
+            count = self._conn.execute("SELECT COUNT(*) FROM emb_cache").fetchone()[0]
+        return f"[embedding 缓存] 条目 {count}，约 {count * self.dim * 4 / 1024 / 1024:.1f} MB"
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
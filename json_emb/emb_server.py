@@ -0,0 +1,265 @@
+import json
+import logging
+import os
+import queue
+import signal
+import socketserver
+import threading
+import time
+from collections import Counter
+from concurrent.futures import BrokenExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+import apollo
+from device_scheduler import plan_devices, DeviceScheduler
+from emb_service import pack_response
+
+
+# =============================
+# 配置区域
+# =============================
+# 常驻 embedding 服务：模型只在启动时加载一次，json_emb 主流程（apollo.py 中设置 EMBEDDING_SERVER）
+# 以及检索、去重等工具都作为客户端（emb_service.EmbeddingClient）复用。
+#   python emb_server.py
+# 设备分配、推理后端、分块预算、缓存等沿用 apollo.py 的配置。
+SERVER_ADDRESS = "unix:///tmp/json_emb.sock"  # 或 "http://127.0.0.1:8765"
+MAX_BATCH_TEXTS = 4096   # 动态合并：一个 batch 的文本块上限
+MAX_WAIT_MS = 20         # 动态合并：第一个请求到达后最多再等待多久凑 batch
+
+logger = logging.getLogger("emb_server")
+
+
+# =============================
+# 动态合并请求
+# =============================
+def embed_batch(texts):
+    """在 worker 中执行：apollo.embed_texts 的结果，附带 worker 所在设备"""
+    embeddings, stats, failed = apollo.embed_texts(texts)
+    return embeddings, stats, failed, apollo._worker_gpu_id
+
+
+class PendingRequest:
+    def __init__(self, texts):
+        self.texts = texts
+        self.done = threading.Event()
+        self.embeddings = None
+        self.meta = None
+        self.error = None
+
+
+class DynamicBatcher:
+    """
+    把并发到达的请求合并成一个 batch：第一个请求到达后等待至多 max_wait 秒，
+    或凑满 max_batch_texts 个文本块即提交给调度器；设备都没有空位时等待。
+    合并 batch 的统计计数全部计入其中第一个请求，同一客户端各请求的统计之和即为准确总数。
+    提交或计算失败时异常交给该 batch 的每个请求，合并线程继续处理后续请求；
+    进程池损坏（worker 异常退出）后无法恢复，记入 broken，/health 据此报告服务不可用。
+    """
+
+    def __init__(self, scheduler: DeviceScheduler, max_batch_texts: int, max_wait: float):
+        self.scheduler = scheduler
+        self.max_batch_texts = max_batch_texts
+        self.max_wait = max_wait
+        self.stats = Counter()
+        self._queue = queue.Queue()
+        self._carry = None  # 放不进上一个 batch 的请求，作为下一个 batch 的第一个
+        self._capacity = threading.Condition()
+        self.broken = None  # 进程池损坏时的异常
+        self._thread = threading.Thread(target=self._run, name="batcher", daemon=True)
+        self._thread.start()
+
+    def pending(self) -> int:
+        return self._queue.qsize() + (self._carry is not None)
+
+    def embed(self, texts) -> PendingRequest:
+        request = PendingRequest(texts)
+        self._queue.put(request)
+        request.done.wait()
+        return request
+
+    def _collect(self):
+        first = self._carry or self._queue.get()
+        self._carry = None
+        batch, count = [first], len(first.texts)
+        deadline = time.time() + self.max_wait
+        while count < self.max_batch_texts:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if count + len(request.texts) > self.max_batch_texts:
+                self._carry = request
+                break
+            batch.append(request)
+            count += len(request.texts)
+        return batch
+
+    def _fail(self, batch, error):
+        if isinstance(error, BrokenExecutor) and self.broken is None:
+            self.broken = error
+            logger.error(f"worker 进程池已损坏，服务不再可用: {error}")
+        self.stats["failed_batches"] += 1
+        for request in batch:
+            request.error = error
+            request.done.set()
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            texts = [text for request in batch for text in request.texts]
+            try:
+                with self._capacity:
+                    while not self.scheduler.has_capacity():
+                        self._capacity.wait()
+                    future = self.scheduler.submit(embed_batch, texts)
+            except Exception as e:
+                self._fail(batch, e)
+                continue
+            self.stats["batches"] += 1
+            self.stats["requests"] += len(batch)
+            self.stats["texts"] += len(texts)
+            future.add_done_callback(lambda f, batch=batch: self._complete(f, batch))
+
+    def _complete(self, future, batch):
+        with self._capacity:
+            try:
+                embeddings, batch_stats, failed, device = self.scheduler.result(future)
+                error = None
+            except Exception as e:
+                error = e
+            self._capacity.notify()
+        if error is not None:
+            self._fail(batch, error)
+            return
+        try:
+            offset = 0
+            for i, request in enumerate(batch):
+                end = offset + len(request.texts)
+                request.embeddings = embeddings[offset:end]
+                request.meta = {
+                    "failed": {j - offset: failed[j] for j in failed if offset <= j < end},
+                    "stats": dict(batch_stats) if i == 0 else {"chunks": len(request.texts)},
+                    "batch_requests": len(batch),
+                    "device": device,
+                }
+                offset = end
+                request.done.set()
+            self.scheduler.add_items(device, len(embeddings))
+            self.stats.update(batch_stats)
+        except Exception as e:
+            # 回调中的异常不会传到任何地方，没有拿到结果的请求必须在这里结束等待
+            self._fail([request for request in batch if not request.done.is_set()], e)
+
+
+# =============================
+# HTTP 接口
+# =============================
+class EmbeddingHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # 长连接，客户端复用同一连接
+
+    def _send(self, status: int, body: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != "/health":
+            self._send(404, b"not found", "text/plain")
+            return
+        batcher = self.server.batcher
+        health = {
+            "status": "ok" if batcher.broken is None else f"broken: {type(batcher.broken).__name__}: {batcher.broken}",
+            "devices": [(d["device"], d["workers"]) for d in batcher.scheduler.devices],
+            "pending": batcher.pending(),
+            "uptime": time.time() - self.server.start_time,
+            "stats": dict(batcher.stats),
+        }
+        # 进程池损坏时返回 503，客户端的 wait_ready 不会连上一个已不能计算的服务
+        self._send(200 if batcher.broken is None else 503,
+                   json.dumps(health, ensure_ascii=False).encode("utf-8"), "application/json")
+
+    def do_POST(self):
+        if self.path != "/embed":
+            self._send(404, b"not found", "text/plain")
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            texts = json.loads(self.rfile.read(length).decode("utf-8"))["texts"]
+        except Exception as e:
+            self._send(400, f"请求格式错误: {e}".encode("utf-8"), "text/plain; charset=utf-8")
+            return
+        request = self.server.batcher.embed(texts)
+        if request.error is not None:
+            self._send(500, f"{type(request.error).__name__}: {request.error}".encode("utf-8"),
+                       "text/plain; charset=utf-8")
+            return
+        self._send(200, pack_response(request.embeddings, request.meta), "application/octet-stream")
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ("unix", 0)
+
+
+def make_server(address: str):
+    parsed = urlparse(address)
+    if parsed.scheme == "unix":
+        if os.path.exists(parsed.path):
+            os.remove(parsed.path)  # 上次异常退出遗留的 socket 文件
+        return ThreadingUnixHTTPServer(parsed.path, EmbeddingHandler)
+    return ThreadingHTTPServer((parsed.hostname, parsed.port), EmbeddingHandler)
+
+
+def stop_on_signal(signum, frame):
+    raise KeyboardInterrupt
+
+
+def main():
+    apollo.EMBEDDING_SERVER = None  # 服务自身的 worker 在本地计算，不能再转发给服务
+    apollo.evict_emb_cache()
+    # GPU 数在子进程中查询（apollo.available_gpus），服务主进程不能初始化 CUDA，否则 fork 出的 GPU worker 无法使用 CUDA
+    plan = plan_devices(apollo.available_gpus(), apollo.WORKERS_PER_GPU, apollo.CPU_WORKERS)
+    if apollo.torch.cuda.is_initialized():
+        raise RuntimeError("服务主进程已初始化 CUDA，fork 出的 GPU worker 将无法使用 CUDA")
+    apollo.share_token_budgets(plan)
+    logger.info("worker 分配: " + "，".join(f"{device} × {workers}" for device, workers in plan))
+    with DeviceScheduler(plan, apollo.init_worker, apollo.WORKER_QUEUE_DEPTH) as scheduler:
+        # 预热：每个 worker 加载好模型后再开始监听，客户端连上即可用
+        start = time.time()
+        warmup = []
+        while scheduler.has_capacity() and len(warmup) < scheduler.total_workers:
+            warmup.append(scheduler.submit(embed_batch, ["预热"]))
+        for future in warmup:
+            scheduler.result(future)
+        logger.info(f"模型加载完成，耗时 {time.time() - start:.1f}s")
+
+        server = make_server(SERVER_ADDRESS)
+        server.batcher = DynamicBatcher(scheduler, MAX_BATCH_TEXTS, MAX_WAIT_MS / 1000)
+        server.start_time = time.time()
+        logger.info(f"embedding 服务已启动: {SERVER_ADDRESS}")
+        signal.signal(signal.SIGTERM, stop_on_signal)  # worker 已启动，处理函数只作用于服务主进程
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if urlparse(SERVER_ADDRESS).scheme == "unix" and os.path.exists(urlparse(SERVER_ADDRESS).path):
+                os.remove(urlparse(SERVER_ADDRESS).path)
+            logger.info(scheduler.summary())
+    apollo.evict_emb_cache()
+
+
+if __name__ == "__main__":
+    main()
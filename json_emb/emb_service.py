@@ -0,0 +1,111 @@
+import http.client
+import json
+import socket
+import struct
+import time
+from collections import Counter
+from io import BytesIO
+from urllib.parse import urlparse
+import numpy as np
+
+
+# =============================
+# 常驻 embedding 服务的协议与客户端
+# =============================
+# 地址：unix:///tmp/json_emb.sock（本机 Unix socket）或 http://127.0.0.1:8765
+# POST /embed  请求体 {"texts": [...]}（JSON）
+#              响应体 4 字节小端长度 + JSON 元信息 {"failed": {下标: 错误}, "stats": {...}, "device": ...}
+#                     + float32 向量数组（npy 格式）
+# GET  /health 服务状态（设备、排队请求数、累计统计）
+def pack_response(embeddings: np.ndarray, meta: dict) -> bytes:
+    meta_bytes = json.dumps(meta, ensure_ascii=False).encode("utf-8")
+    buffer = BytesIO()
+    buffer.write(struct.pack("<I", len(meta_bytes)))
+    buffer.write(meta_bytes)
+    np.save(buffer, np.ascontiguousarray(embeddings, dtype=np.float32), allow_pickle=False)
+    return buffer.getvalue()
+
+
+def unpack_response(body: bytes):
+    meta_length = struct.unpack("<I", body[:4])[0]
+    meta = json.loads(body[4:4 + meta_length].decode("utf-8"))
+    embeddings = np.load(BytesIO(body[4 + meta_length:]), allow_pickle=False)
+    return embeddings, meta
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.unix_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+
+def open_connection(address: str, timeout=None) -> http.client.HTTPConnection:
+    parsed = urlparse(address)
+    if parsed.scheme == "unix":
+        return UnixHTTPConnection(parsed.path, timeout=timeout)
+    return http.client.HTTPConnection(parsed.hostname, parsed.port or 80, timeout=timeout)
+
+
+class EmbeddingClient:
+    """
+    embedding 服务的客户端，embed 的返回值与 embed_texts 相同：(向量, 统计计数, 失败的文本块 {下标: 错误})。
+    保持一个长连接，连接断开时重连重试一次。
+    """
+
+    def __init__(self, address: str, dim: int = 1024, timeout: float = 600):
+        self.address = address
+        self.dim = dim
+        self.timeout = timeout
+        self._conn = None
+
+    def _request(self, method: str, path: str, body: bytes = None, headers=None) -> bytes:
+        for attempt in range(2):
+            if self._conn is None:
+                self._conn = open_connection(self.address, timeout=self.timeout)
+            try:
+                self._conn.request(method, path, body=body, headers=headers or {})
+                response = self._conn.getresponse()
+                data = response.read()
+            except (ConnectionError, http.client.HTTPException, OSError):
+                self._conn.close()
+                self._conn = None
+                if attempt:
+                    raise
+                continue
+            if response.status != 200:
+                raise RuntimeError(f"embedding 服务返回 {response.status}: {data[:500].decode('utf-8', 'replace')}")
+            return data
+
+    def embed(self, texts):
+        if not texts:
+            return np.zeros((0, self.dim), dtype=np.float32), Counter(), {}
+        body = json.dumps({"texts": list(texts)}, ensure_ascii=False).encode("utf-8")
+        embeddings, meta = unpack_response(self._request(
+            "POST", "/embed", body, {"Content-Type": "application/json"}
+        ))
+        failed = {int(i): error for i, error in meta.get("failed", {}).items()}
+        return embeddings, Counter(meta.get("stats", {})), failed
+
+    def health(self) -> dict:
+        return json.loads(self._request("GET", "/health").decode("utf-8"))
+
+    def wait_ready(self, timeout: float = 0) -> dict:
+        """等待服务可用（模型加载完成），返回 health；超时抛出最后一次的异常"""
+        deadline = time.time() + timeout
+        while True:
+            try:
+                return self.health()
+            except Exception:
+                if time.time() >= deadline:
+                    raise
+                time.sleep(1)
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
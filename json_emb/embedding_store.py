@@ -0,0 +1,158 @@
+import json
+import os
+from io import BytesIO
+import numpy as np
+
+
+# =============================
+# 二进制向量输出（npy 分片 + JSONL 索引）
+# =============================
+# 输出布局（以输入 jsonl/foo.jsonl 为例）：
+#   text_embedding/foo.sidecar.jsonl      每个输入行一条：meta 字段 + embedding_list（text / page / row，不含向量）
+#                                         以及该行向量所在的分片名 embedding_shard
+#   text_embedding/foo/emb_00000.npy      (行数, 维度) 的 float16/float32 连续数组，每个 worker batch 一个分片
+#   text_embedding/foo/emb_00000.int8.npy        可选：int8 标量量化，(行数, 维度)
+#   text_embedding/foo/emb_00000.int8_calib.npy  int8 的逐维标定 (2, 维度)：第 0 行为下界，第 1 行为步长
+#   text_embedding/foo/emb_00000.binary.npy      可选：1 bit 符号量化，按位打包为 (行数, 维度 / 8) 的 uint8
+# 索引文件在全部分片上传之后才完成提交，存在即代表该文件的输出完整。
+
+def sidecar_key(output_base: str) -> str:
+    return output_base + ".sidecar.jsonl"
+
+
+def shard_name(batch_index: int) -> str:
+    return f"emb_{batch_index:05d}.npy"
+
+
+def shard_key(output_base: str, name: str) -> str:
+    return f"{output_base}/{name}"
+
+
+def variant_name(name: str, kind: str) -> str:
+    """分片的某种表示对应的文件名，kind 为 float / int8 / int8_calib / binary"""
+    return name if kind == "float" else name[:-len(".npy")] + f".{kind}.npy"
+
+
+# =============================
+# 量化
+# =============================
+def calibrate_int8(array: np.ndarray) -> np.ndarray:
+    """按分片统计每一维的最小值与最大值，把 [min, max] 均匀映射到 256 个等级"""
+    array = np.asarray(array, dtype=np.float32)
+    if len(array) == 0:
+        # 空分片（该 batch 没有可计算的文本块）：中性标定，下界 0、步长 1
+        return np.stack([np.zeros(array.shape[1], dtype=np.float32), np.ones(array.shape[1], dtype=np.float32)])
+    low = array.min(axis=0)
+    scale = (array.max(axis=0) - low) / 255.0
+    scale[scale == 0] = 1.0  # 该维取值恒定（或分片只有一行）
+    return np.stack([low, scale]).astype(np.float32)
+
+
+def quantize_int8(array: np.ndarray, calib: np.ndarray) -> np.ndarray:
+    levels = np.round((np.asarray(array, dtype=np.float32) - calib[0]) / calib[1]) - 128
+    return np.clip(levels, -128, 127).astype(np.int8)
+
+
+def dequantize_int8(array: np.ndarray, calib: np.ndarray) -> np.ndarray:
+    return (array.astype(np.float32) + 128) * calib[1] + calib[0]
+
+
+def quantize_binary(array: np.ndarray) -> np.ndarray:
+    return np.packbits(np.asarray(array) > 0, axis=1)
+
+
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint16)
+
+
+def hamming_distances(query_bits: np.ndarray, corpus_bits: np.ndarray) -> np.ndarray:
+    """一个打包后的查询向量与语料中每一行的汉明距离"""
+    return _POPCOUNT[np.bitwise_xor(corpus_bits, query_bits)].sum(axis=1, dtype=np.int32)
+
+
+def quantize_variants(array: np.ndarray, kinds, float_dtype="float16") -> dict:
+    """按 kinds 生成分片的各种表示，返回 {表示: 数组}；0 行的分片得到各表示的 0 行数组"""
+    array = np.asarray(array)
+    variants = {}
+    if "float" in kinds:
+        variants["float"] = array.astype(float_dtype)
+    if "int8" in kinds:
+        calib = calibrate_int8(array)
+        variants["int8"] = quantize_int8(array, calib)
+        variants["int8_calib"] = calib
+    if "binary" in kinds:
+        variants["binary"] = quantize_binary(array)
+    return variants
+
+
+def encode_npy(array: np.ndarray) -> bytes:
+    buffer = BytesIO()
+    np.save(buffer, np.ascontiguousarray(array), allow_pickle=False)
+    return buffer.getvalue()
+
+
+def download_output(s3_client, bucket: str, output_base: str, local_dir: str, kinds=("float",)) -> str:
+    """把一个文件的索引与全部分片的 kinds 表示下载到本地目录（已存在的不重复下载），返回本地索引路径"""
+    os.makedirs(local_dir, exist_ok=True)
+    local_sidecar = os.path.join(local_dir, os.path.basename(sidecar_key(output_base)))
+    s3_client.download_file(bucket, sidecar_key(output_base), local_sidecar)
+
+    shard_dir = os.path.join(local_dir, os.path.basename(output_base))
+    os.makedirs(shard_dir, exist_ok=True)
+    names = set()
+    with open(local_sidecar, encoding="utf-8") as f:
+        for line in f:
+            name = json.loads(line).get("embedding_shard") if line.strip() else None
+            if name:
+                names.add(name)  # 0 行的分片同样已上传，照常下载
+    file_kinds = list(kinds) + (["int8_calib"] if "int8" in kinds else [])
+    for name in sorted(names):
+        for kind in file_kinds:
+            file_name = variant_name(name, kind)
+            local_path = os.path.join(shard_dir, file_name)
+            if not os.path.exists(local_path):
+                s3_client.download_file(bucket, shard_key(output_base, file_name), local_path)
+    return local_sidecar
+
+
+class EmbeddingReader:
+    """
+    读取 npy 输出：逐行遍历索引，向量从内存映射（mmap）的分片中按行号取出，不把整个分片读入内存。
+    sidecar_path 为本地索引文件，分片位于同名目录（去掉 .sidecar.jsonl 后缀）下。
+    kind 选择读取的表示：float；int8（按分片标定反量化为 float32）；binary（打包的 uint8，用于汉明距离粗排）。
+    """
+
+    def __init__(self, sidecar_path: str, kind: str = "float"):
+        self.sidecar_path = sidecar_path
+        self.shard_dir = sidecar_path[:-len(".sidecar.jsonl")]
+        self.kind = kind
+        self._shards = {}
+
+    def shard(self, name: str, kind: str = None) -> np.ndarray:
+        file_name = variant_name(name, kind or self.kind)
+        if file_name not in self._shards:
+            self._shards[file_name] = np.load(os.path.join(self.shard_dir, file_name), mmap_mode="r")
+        return self._shards[file_name]
+
+    def vectors(self, record: dict) -> np.ndarray:
+        """一条索引记录中所有文本块的向量，形状 (块数, 维度)，按 embedding_list 顺序"""
+        rows = [item["row"] for item in record.get("embedding_list", [])]
+        if not rows and not record.get("embedding_shard"):
+            return np.empty((0, 0), dtype=np.float32)
+        shard = self.shard(record["embedding_shard"])  # 没有文本块的行取分片的 0 行切片，维度与其他行一致（分片本身可以为 0 行）
+        if not rows:
+            vectors = shard[:0]
+        elif rows == list(range(rows[0], rows[-1] + 1)):
+            vectors = shard[rows[0]:rows[-1] + 1]
+        else:
+            vectors = shard[rows]
+        if self.kind == "int8":
+            return dequantize_int8(vectors, self.shard(record["embedding_shard"], "int8_calib"))
+        return vectors
+
+    def __iter__(self):
+        """逐行生成 (索引记录, 向量)"""
+        with open(self.sidecar_path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    yield record, self.vectors(record)
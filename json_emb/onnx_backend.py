@@ -0,0 +1,92 @@
+import os
+import sys
+import numpy as np
+
+
+# =============================
+# ONNX Runtime 推理后端（CPU，动态 int8 量化）
+# =============================
+# 导出：python onnx_backend.py ../models/bge-m3 ../models/bge-m3-onnx-int8
+# 导出目录包含量化后的 model.onnx 与 tokenizer 文件；与 PyTorch 输出的一致性和吞吐用 backend_eval.py 对比。
+MODEL_FILE = "model.onnx"
+FP32_MODEL_FILE = "model_fp32.onnx"  # 量化前的中间产物（超过 2GB，权重存为外部数据文件）
+OPSET_VERSION = 17
+
+
+def export_onnx(model_path: str, output_dir: str, opset: int = OPSET_VERSION):
+    """把 bge-m3 的 transformer 部分导出为 ONNX（batch 与序列长度为动态维度），再做权重 int8 动态量化"""
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    os.makedirs(output_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_path)
+    model = AutoModel.from_pretrained(model_path).eval()
+    sample = tokenizer(["导出用的样例文本", "sample"], padding=True, return_tensors="pt")
+    fp32_path = os.path.join(output_dir, FP32_MODEL_FILE)
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (sample["input_ids"], sample["attention_mask"]),
+            fp32_path,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["last_hidden_state"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "last_hidden_state": {0: "batch", 1: "sequence"},
+            },
+            opset_version=opset,
+        )
+    # 只量化权重（MatMul / Gather），激活在运行时动态量化，不需要标定数据
+    quantize_dynamic(fp32_path, os.path.join(output_dir, MODEL_FILE), weight_type=QuantType.QInt8,
+                     use_external_data_format=True)
+    tokenizer.save_pretrained(output_dir)
+    print(f"已导出: {os.path.join(output_dir, MODEL_FILE)}")
+
+
+class OnnxEmbedder:
+    """
+    与 SentenceTransformer 相同的 encode 接口（以及 tokenizer / max_seq_length 属性），供 embedding() 直接替换使用。
+    bge-m3 的 dense 向量取 CLS 位置的隐状态，按需 L2 归一化。
+    intra_op_threads 为单个算子的并行线程数，inter_op_threads 为算子间并行数（顺序执行时取 1）。
+    """
+
+    def __init__(self, model_dir: str, intra_op_threads: int = 0, inter_op_threads: int = 1, max_seq_length: int = 8192):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL if inter_op_threads <= 1 else ort.ExecutionMode.ORT_PARALLEL
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(os.path.join(model_dir, MODEL_FILE), options,
+                                            providers=["CPUExecutionProvider"])
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.max_seq_length = max_seq_length
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.dim = self.session.get_outputs()[0].shape[-1]
+
+    def encode(self, texts, batch_size: int = 32, normalize_embeddings: bool = True,
+               convert_to_numpy: bool = True, show_progress_bar: bool = False) -> np.ndarray:
+        outputs = []
+        for start in range(0, len(texts), batch_size):
+            encoded = self.tokenizer(texts[start:start + batch_size], padding=True, truncation=True,
+                                     max_length=self.max_seq_length, return_tensors="np")
+            feeds = {name: encoded[name].astype(np.int64) for name in ("input_ids", "attention_mask")
+                     if name in self.input_names}
+            vectors = self.session.run(None, feeds)[0][:, 0].astype(np.float32)
+            if normalize_embeddings:
+                vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+            outputs.append(vectors)
+        if not outputs:
+            return np.zeros((0, self.dim), dtype=np.float32)
+        return np.concatenate(outputs)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("用法: python onnx_backend.py 模型目录 导出目录")
+        sys.exit(1)
+    export_onnx(sys.argv[1], sys.argv[2])
@@ -0,0 +1,104 @@
+import sys
+import time
+import numpy as np
+from embedding_store import EmbeddingReader, quantize_variants, dequantize_int8, quantize_binary, hamming_distances
+
+
+# =============================
+# 配置区域
+# =============================
+# 评估量化表示相对 float 的召回损失：
+#   python quant_eval.py 本地索引1.sidecar.jsonl [本地索引2.sidecar.jsonl ...]
+# 索引与 float 分片可用 embedding_store.download_output 下载；int8 / binary 表示按分片现场生成，与写出时一致。
+SAMPLE_QUERIES = 200     # 从语料中抽样的查询数（用语料向量本身作查询，检索时排除自身）
+TOP_K = 10
+RESCORE_MULTIPLIER = 4   # binary 粗排取 TOP_K × 该倍数个候选，再用 int8 / float 重排
+MAX_CORPUS = 200000      # 参与评估的语料向量上限
+SEED = 0
+
+
+def load_corpus(sidecar_paths):
+    """读取 float 分片，返回 (float 语料, int8 反量化语料, binary 语料, float 存储字节数/向量)"""
+    floats, int8s, binaries = [], [], []
+    float_itemsize = 4
+    total = 0
+    for path in sidecar_paths:
+        reader = EmbeddingReader(path)
+        names = []
+        for record, _ in reader:
+            name = record.get("embedding_shard")
+            if name and name not in names:
+                names.append(name)
+        for name in names:
+            shard = reader.shard(name)
+            float_itemsize = shard.dtype.itemsize
+            array = np.asarray(shard, dtype=np.float32)
+            variants = quantize_variants(array, ("int8", "binary"))
+            floats.append(array)
+            int8s.append(dequantize_int8(variants["int8"], variants["int8_calib"]))
+            binaries.append(variants["binary"])
+            total += len(array)
+            if total >= MAX_CORPUS:
+                break
+        if total >= MAX_CORPUS:
+            break
+    return (np.concatenate(floats)[:MAX_CORPUS], np.concatenate(int8s)[:MAX_CORPUS],
+            np.concatenate(binaries)[:MAX_CORPUS], float_itemsize)
+
+
+def top_k(scores: np.ndarray, k: int, exclude: int) -> np.ndarray:
+    """分数越大越相似；exclude 为查询自身的下标"""
+    scores = scores.astype(np.float32, copy=True)
+    scores[exclude] = -np.inf
+    k = min(k, len(scores) - 1)
+    candidates = np.argpartition(-scores, k)[:k]
+    return candidates[np.argsort(-scores[candidates])]
+
+
+def evaluate(corpus_float, corpus_int8, corpus_binary, query_ids):
+    """返回 {方法: (recall@k, 平均每次查询毫秒)}"""
+    def rescore(q, i, corpus):
+        candidates = top_k(-hamming_distances(quantize_binary(q[None, :]), corpus_binary), TOP_K * RESCORE_MULTIPLIER, i)
+        scores = corpus[candidates] @ q
+        return candidates[np.argsort(-scores)[:TOP_K]]
+
+    methods = {
+        "int8": lambda q, i: top_k(corpus_int8 @ q, TOP_K, i),
+        "binary": lambda q, i: top_k(-hamming_distances(quantize_binary(q[None, :]), corpus_binary), TOP_K, i),
+        "binary+int8 重排": lambda q, i: rescore(q, i, corpus_int8),
+        "binary+float 重排": lambda q, i: rescore(q, i, corpus_float),
+    }
+
+    truth = {i: set(top_k(corpus_float @ corpus_float[i], TOP_K, i)) for i in query_ids}
+    results = {}
+    for name, search in methods.items():
+        start = time.perf_counter()
+        hits = 0
+        for i in query_ids:
+            hits += len(truth[i] & set(search(corpus_float[i], i)))
+        elapsed = time.perf_counter() - start
+        results[name] = (hits / (len(query_ids) * TOP_K), elapsed / len(query_ids) * 1000)
+    return results
+
+
+def main(sidecar_paths):
+    corpus_float, corpus_int8, corpus_binary, float_itemsize = load_corpus(sidecar_paths)
+    n, dim = corpus_float.shape
+    rng = np.random.default_rng(SEED)
+    query_ids = rng.choice(n, size=min(SAMPLE_QUERIES, n - 1), replace=False)
+    print(f"语料 {n} 条，维度 {dim}，查询 {len(query_ids)} 条，recall@{TOP_K}（以 float 检索结果为基准）")
+
+    bytes_per_vector = {
+        "int8": dim, "binary": dim // 8,
+        "binary+int8 重排": dim + dim // 8, "binary+float 重排": dim * float_itemsize + dim // 8,
+    }
+    print(f"  {'float':<18} 召回 1.0000  每向量 {dim * float_itemsize:>5} 字节")
+    for name, (recall, ms) in evaluate(corpus_float, corpus_int8, corpus_binary, query_ids).items():
+        print(f"  {name:<18} 召回 {recall:.4f}  每向量 {bytes_per_vector[name]:>5} 字节  查询 {ms:.1f} ms")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("用法: python quant_eval.py 本地索引.sidecar.jsonl [...]")
+        sys.exit(1)
+    main(sys.argv[1:])
@@ -0,0 +1,155 @@
+import numpy as np
+from multiprocessing import resource_tracker, shared_memory
+
+
+# =============================
+# 主进程与 worker 之间经共享内存传递 batch
+# =============================
+# 输入：主进程把整个输入文件的原始字节读入一块共享内存，提交给 worker 的只有
+#       (共享内存名, 起始偏移, 结束偏移, 首行行号)，worker 直接从共享内存解码这段行；
+# 输出：worker 把结果行（UTF-8 字节）与各表示的向量数组写入自己创建的一块共享内存，
+#       只回传布局描述，主进程从共享内存直接写入输出流 / 编码分片后释放。
+# 进程间管道上只剩几百字节的描述，不再 pickle 10MB 的行列表和结果。
+ALIGNMENT = 64  # 输出中各数组的起始偏移对齐
+
+
+def ensure_tracker():
+    """
+    在创建进程池之前启动共享内存的 resource_tracker，使 fork 出的 worker（DeviceScheduler 固定以 fork 启动）与主进程共用同一个：
+    worker 创建的块由主进程 unlink 时能正确注销，进程异常退出时遗留的块也由它统一清理。
+    """
+    resource_tracker.ensure_running()
+
+
+class SharedInput:
+    """一个输入文件的原始字节，位于共享内存中"""
+
+    def __init__(self, reader):
+        # reader 为 S3LineReader：多个范围读取并行下载，直接写入共享内存，不在进程内另存一份完整的文件内容
+        self.size = reader.size
+        self.shm = shared_memory.SharedMemory(create=True, size=max(self.size, 1))
+        try:
+            reader.read_into(self.shm.buf)
+        except Exception:
+            self.release()
+            raise
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def batch_ranges(self, max_batch_bytes: int):
+        """
+        按行边界把文件分成若干 (起始偏移, 结束偏移, 行数, 首行行号) 的 batch，每个 batch 的字节数不超过
+        max_batch_bytes（单行超长时独占一个 batch），与 create_batches_by_bytes 的划分方式一致；
+        空行（与 split_lines 相同，解码后 strip() 为空）不计入行数，但计入行号（行号为文件中从 0 开始的物理行号）。
+        """
+        data = np.frombuffer(self.shm.buf, dtype=np.uint8, count=self.size)
+        ends = np.flatnonzero(data == ord("\n")) + 1
+        if not len(ends) or ends[-1] != self.size:
+            ends = np.append(ends, self.size)
+        starts = np.concatenate(([0], ends[:-1]))
+        ranges = []
+        batch_start, batch_lines, first_line = 0, 0, 0
+        for line_index, (start, end) in enumerate(zip(starts.tolist(), ends.tolist())):
+            if is_blank(data, start, end):
+                continue
+            if batch_lines and end - batch_start > max_batch_bytes:
+                ranges.append((batch_start, start, batch_lines, first_line))
+                batch_lines = 0
+            if not batch_lines:
+                batch_start, first_line = start, line_index
+            batch_lines += 1
+        del data
+        if batch_lines:
+            ranges.append((batch_start, self.size, batch_lines, first_line))
+        return ranges
+
+    def release(self):
+        self.shm.close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+_ASCII_WHITESPACE = frozenset(b" \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f")
+
+
+def is_blank(data: np.ndarray, start: int, end: int) -> bool:
+    """data[start:end] 这一行（可含结尾的 \n）是否为空行，与 split_lines 的 decode + strip() 判断一致"""
+    if start < end and data[start] < 0x80 and data[start] not in _ASCII_WHITESPACE:
+        return False  # 常见情况：行首即可见的 ASCII 字符（如 "{"），不必解码
+    return not data[start:end].tobytes().decode("utf-8", errors="replace").strip()
+
+
+def read_shared_lines(shm_name: str, start: int, end: int, first_line: int):
+    """worker 端：从共享内存中解码一段行，返回 (非空行列表, 对应的 (行号, 字节偏移) 列表)"""
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        content = bytes(shm.buf[start:end])
+    finally:
+        shm.close()
+    return split_lines(content, first_line, start)
+
+
+def split_lines(content: bytes, first_line: int = 0, base_offset: int = 0):
+    """按 \n 分行（不按 str.splitlines 的 \u2028 等分隔符拆开 JSON 字符串），返回 (非空行列表, (行号, 字节偏移) 列表)"""
+    lines, positions = [], []
+    offset = base_offset
+    for i, raw in enumerate(content.split(b"\n")):
+        line = raw.decode("utf-8").strip()
+        if line:
+            lines.append(line)
+            positions.append((first_line + i, offset))
+        offset += len(raw) + 1
+    return lines, positions
+
+
+def write_shared_output(lines, arrays) -> dict:
+    """
+    worker 端：把结果行与 {表示: 向量数组} 写入新建的共享内存，返回布局描述。
+    共享内存块由主进程读取后释放（release_output）。
+    """
+    body = "".join(line + "\n" for line in lines).encode("utf-8")
+    layout = {"lines": (0, len(body)), "arrays": {}}
+    offset = len(body)
+    for kind, array in (arrays or {}).items():
+        offset = (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+        array = np.ascontiguousarray(array)
+        layout["arrays"][kind] = (offset, array.dtype.str, array.shape)
+        offset += array.nbytes
+    shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    try:
+        shm.buf[:len(body)] = body
+        for kind, array in (arrays or {}).items():
+            start, dtype, shape = layout["arrays"][kind]
+            np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=start)[...] = array
+        layout["shm"] = shm.name
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+    shm.close()
+    return layout
+
+
+def open_output(layout: dict):
+    """主进程：打开 worker 写好的输出块，返回 (共享内存, 结果行的 memoryview, {表示: 数组视图})"""
+    shm = shared_memory.SharedMemory(name=layout["shm"])
+    start, length = layout["lines"]
+    lines = shm.buf[start:start + length]
+    arrays = {
+        kind: np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)
+        for kind, (offset, dtype, shape) in layout["arrays"].items()
+    }
+    return shm, lines, arrays
+
+
+def release_output(shm):
+    """主进程：释放输出块（调用前须先丢弃 open_output 返回的视图）"""
+    try:
+        shm.close()
+    except BufferError:
+        pass  # 异常路径上视图仍被引用：只 unlink，映射随视图回收释放
+    shm.unlink()
@@ -0,0 +1,95 @@
+import http.client
+import threading
+import time
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+import pytest
+from emb_server import DynamicBatcher, make_server
+
+# python -m pytest -q json_emb/test_emb_server.py
+
+DIM = 4
+
+
+class FakeScheduler:
+    """按 outcomes 依次决定每次提交的结果：'ok' 正常返回，异常实例在 submit 时抛出，('error', 异常) 由 future 抛出"""
+
+    devices = [{"device": "cpu", "workers": 1}]
+
+    def __init__(self, outcomes):
+        self.outcomes = list(outcomes)
+
+    def has_capacity(self):
+        return True
+
+    def submit(self, fn, texts):
+        outcome = self.outcomes.pop(0) if self.outcomes else "ok"
+        if isinstance(outcome, Exception):
+            raise outcome
+        future = Future()
+        if outcome == "ok":
+            future.set_result((np.ones((len(texts), DIM), dtype=np.float32), {"chunks": len(texts)}, {}, "cpu"))
+        else:
+            future.set_exception(outcome[1])
+        return future
+
+    def result(self, future):
+        return future.result()
+
+    def add_items(self, device, items):
+        pass
+
+
+def embed(batcher, texts, timeout=5):
+    """在线程中调用 embed，超时说明请求一直挂起"""
+    box = []
+    thread = threading.Thread(target=lambda: box.append(batcher.embed(texts)), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert box, "请求没有结束"
+    return box[0]
+
+
+def test_failed_batch_does_not_stop_batcher():
+    batcher = DynamicBatcher(FakeScheduler([("error", RuntimeError("CUDA error")), "ok"]), 16, 0.001)
+    failed = embed(batcher, ["a", "b"])
+    assert isinstance(failed.error, RuntimeError) and failed.embeddings is None
+    request = embed(batcher, ["c"])
+    assert request.error is None and request.embeddings.shape == (1, DIM)
+    assert batcher.broken is None and batcher.stats["failed_batches"] == 1
+
+
+def test_broken_pool_fails_every_request_and_health():
+    batcher = DynamicBatcher(FakeScheduler([BrokenProcessPool("worker 退出")] * 3), 16, 0.001)
+    for _ in range(3):
+        assert isinstance(embed(batcher, ["a"]).error, BrokenProcessPool)
+    assert isinstance(batcher.broken, BrokenProcessPool)
+
+    server = make_server("http://127.0.0.1:0")
+    server.batcher = batcher
+    server.start_time = time.time()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        connection = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=5)
+        connection.request("GET", "/health")
+        response = connection.getresponse()
+        assert response.status == 503
+        assert b"broken" in response.read()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.mark.parametrize("outcome", [RuntimeError("submit 失败"), ("error", MemoryError())])
+def test_batch_error_reaches_all_requests(outcome):
+    batcher = DynamicBatcher(FakeScheduler([outcome]), 16, 0.2)
+    results = []
+    threads = [threading.Thread(target=lambda t=t: results.append(batcher.embed([t])), daemon=True) for t in "xyz"]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+    assert len(results) == 3
+    assert sum(request.error is not None for request in results) >= 1
+    assert all(request.done.is_set() for request in results)
@@ -0,0 +1,64 @@
+import json
+import os
+import numpy as np
+from embedding_store import (sidecar_key, shard_name, shard_key, variant_name, encode_npy, quantize_variants,
+                             dequantize_int8, download_output, EmbeddingReader)
+
+# python -m pytest -q json_emb/test_embedding_store.py
+
+DIM = 16
+KINDS = ("float", "int8", "binary")
+
+
+class LocalS3:
+    """按 key 保存对象字节的最小 S3 客户端，只实现 download_file"""
+
+    def __init__(self, objects):
+        self.objects = objects
+
+    def download_file(self, bucket, key, path):
+        with open(path, "wb") as f:
+            f.write(self.objects[key])
+
+
+def write_output(objects, output_base, records, arrays):
+    """按 apollo 的布局写出索引与各分片的全部表示"""
+    for name, array in arrays.items():
+        for kind, variant in quantize_variants(array, KINDS).items():
+            objects[shard_key(output_base, variant_name(name, kind))] = encode_npy(variant)
+    objects[sidecar_key(output_base)] = "".join(json.dumps(r) + "\n" for r in records).encode("utf-8")
+
+
+def test_quantize_zero_row_batch():
+    variants = quantize_variants(np.empty((0, DIM), dtype=np.float32), KINDS)
+    assert variants["float"].shape == (0, DIM) and variants["float"].dtype == np.float16
+    assert variants["int8"].shape == (0, DIM) and variants["int8"].dtype == np.int8
+    assert variants["binary"].shape == (0, DIM // 8)
+    np.testing.assert_array_equal(variants["int8_calib"], np.stack([np.zeros(DIM), np.ones(DIM)]))
+    assert dequantize_int8(variants["int8"], variants["int8_calib"]).shape == (0, DIM)
+
+
+def test_quantize_keeps_nonempty_batches():
+    array = np.random.default_rng(0).standard_normal((8, DIM)).astype(np.float32)
+    variants = quantize_variants(array, KINDS)
+    restored = dequantize_int8(variants["int8"], variants["int8_calib"])
+    assert np.abs(restored - array).max() <= variants["int8_calib"][1].max()
+
+
+def test_read_empty_shards(tmp_path):
+    output_base = "text_embedding/foo"
+    empty, full = shard_name(0), shard_name(1)
+    array = np.random.default_rng(1).standard_normal((2, DIM)).astype(np.float32)
+    records = [
+        {"embedding_list": [], "embedding_shard": empty},
+        {"embedding_list": [{"row": 0}, {"row": 1}], "embedding_shard": full},
+        {"embedding_list": [], "embedding_shard": full},
+    ]
+    objects = {}
+    write_output(objects, output_base, records, {empty: np.empty((0, DIM), dtype=np.float32), full: array})
+
+    local_sidecar = download_output(LocalS3(objects), "bucket", output_base, str(tmp_path), kinds=KINDS)
+    assert os.path.exists(os.path.join(str(tmp_path), "foo", variant_name(empty, "int8_calib")))
+    for kind, width in (("float", DIM), ("int8", DIM), ("binary", DIM // 8)):
+        shapes = [vectors.shape for _, vectors in EmbeddingReader(local_sidecar, kind)]
+        assert shapes == [(0, width), (2, width), (0, width)]